@@ -0,0 +1,120 @@
+"""
+End-to-end offline benchmark: read_logical_messages -> score_logical_messages -> delivery
+against fake Telegram/Gemini backends. Reports wall time per stage, throughput and the
+per-stage percentiles collected by core.metrics.
+
+    python -m bench.e2e --chats 3 --messages 3000 --k 100 --runs 3
+
+The bridge ids delivery reads are set below, so the bench never asks keyring for secrets.
+If some other secret is read anyway, run with PYTHON_KEYRING_BACKEND=keyring.backends.null.Keyring
+to skip the OS keyring.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List
+
+import config
+from bench.fakes import FakeBot, FakeHistoryClient, FakeLLM, FakeTelethon, synthetic_history
+from bot.delivery import ChatRateLimiter, deliver_ranked
+from bot.pipeline import read_logical_messages_multi, send_ranked_item
+from core.llm import LLMPolicy, LLMScorer, score_logical_messages
+from core.metrics import METRICS
+from core.score_cache import ScoreCache
+
+DEST_USER = 1
+BRIDGE_CHAT_ID, BRIDGE_CHAT_ID_NUMBER = "@bench_bridge", -1000000000001
+
+
+async def one_run(args: argparse.Namespace, run: int) -> Dict[str, float]:
+    chats = [f"@bench_chat_{i}" for i in range(args.chats)]
+    history = FakeHistoryClient(
+        {c: synthetic_history(args.messages, seed=run * 1000 + i) for i, c in enumerate(chats)},
+        page_latency_s=args.page_latency, floodwait_rate=args.floodwait_rate, seed=run,
+    )
+    llm = FakeLLM(median_s=args.llm_median, sigma=args.llm_sigma, error_rate=args.llm_error_rate, seed=run)
+    scorer = LLMScorer(
+        send_fn=llm.send_fn,
+        policy=LLMPolicy(batch_size=args.batch_size, rate_per_s=args.llm_rate, burst=max(1, int(args.llm_rate * 2))),
+        cache=ScoreCache(None),
+        batch_send_fn=llm.batch_send_fn if args.batch_size > 1 else None,
+        reason_fn=llm.reason_fn,
+    )
+    bot, tele = FakeBot(latency_s=args.bot_latency), FakeTelethon(forward_latency_s=args.forward_latency)
+    limiter = ChatRateLimiter()
+    out: Dict[str, float] = {"failed": 0.0}
+
+    t0 = time.perf_counter()
+    posts, failed = await read_logical_messages_multi(history, chats, args.k, args.offset)
+    t1 = time.perf_counter()
+    try:
+        ranked = await score_logical_messages(scorer, posts, None, user_key=DEST_USER)
+    except Exception as e:
+        print(f"  run {run}: scoring failed: {e}")
+        out["failed"] = 1.0
+        ranked = []
+    ranked.sort(key=lambda sr: sr.score, reverse=True)
+    t2 = time.perf_counter()
+    if args.per_item:
+        for sr in ranked:
+            await send_ranked_item(bot, tele, None, DEST_USER, sr, limiter=limiter)
+    else:
+        await deliver_ranked(bot, tele, None, DEST_USER, ranked, limiter=limiter)
+    t3 = time.perf_counter()
+
+    out.update(
+        read_s=t1 - t0, score_s=t2 - t1, deliver_s=t3 - t2, total_s=t3 - t0,
+        posts=float(len(posts)), failed_chats=float(len(failed)), unscored=float(sum(sr.unscored for sr in ranked)),
+        llm_calls=float(llm.calls), bot_calls=float(len(bot.calls)), forwards=float(tele.forward_calls),
+        pages=float(history.pages_served), floodwaits=float(history.floodwaits),
+    )
+    return out
+
+
+def _fmt(values: List[float]) -> str:
+    if len(values) == 1:
+        return f"{values[0]:.3f}"
+    return f"median {statistics.median(values):.3f} (min {min(values):.3f}, max {max(values):.3f})"
+
+
+async def main(args: argparse.Namespace) -> None:
+    # module attributes win over config.__getattr__: keyring is never touched
+    config.BRIDGE_CHAT_ID, config.BRIDGE_CHAT_ID_NUMBER = BRIDGE_CHAT_ID, BRIDGE_CHAT_ID_NUMBER
+    METRICS.reset()
+    runs = [await one_run(args, r) for r in range(args.runs)]
+    print(f"chats={args.chats} messages/chat={args.messages} K={args.k} OFFSET={args.offset} runs={args.runs}")
+    for key in ("read_s", "score_s", "deliver_s", "total_s"):
+        print(f"{key:>10}: {_fmt([r[key] for r in runs])}")
+    for key in ("posts", "unscored", "failed_chats", "pages", "floodwaits", "llm_calls", "forwards", "bot_calls", "failed"):
+        print(f"{key:>10}: {sum(r[key] for r in runs) / len(runs):g} avg")
+    total = sum(r["total_s"] for r in runs)
+    posts = sum(r["posts"] for r in runs)
+    print(f"throughput: {posts / total if total else 0:.1f} posts/s end to end")
+    print("-- stages (core.metrics) --")
+    print(METRICS.render_text())
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--chats", type=int, default=2)
+    p.add_argument("--messages", type=int, default=2000, help="messages per chat history")
+    p.add_argument("--k", type=int, default=50)
+    p.add_argument("--offset", type=int, default=0)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--page-latency", type=float, default=0.05)
+    p.add_argument("--floodwait-rate", type=float, default=0.0)
+    p.add_argument("--llm-median", type=float, default=1.0)
+    p.add_argument("--llm-sigma", type=float, default=0.5)
+    p.add_argument("--llm-error-rate", type=float, default=0.0)
+    p.add_argument("--llm-rate", type=float, default=LLMPolicy.rate_per_s)
+    p.add_argument("--batch-size", type=int, default=LLMPolicy.batch_size)
+    p.add_argument("--bot-latency", type=float, default=0.03)
+    p.add_argument("--forward-latency", type=float, default=0.2)
+    p.add_argument("--per-item", action="store_true", help="send_ranked_item per post instead of bulk deliver_ranked")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,242 @@
+"""
+Offline stand-ins for Telegram and Gemini: synthetic history, a fake history client,
+a fake LLM send_fn and a recording Bot API / Telethon forwarder.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+import asyncio
+import json
+import random
+
+from telethon.errors import FloodWaitError
+from telethon.tl import types as tl
+
+from core.models import RawMessage
+
+DISTRICTS = ["Сон Ча", "Хай Чау", "Нгу Хань Шон", "An Thuong", "My An", "Thanh Khe"]
+TEMPLATES = [
+    "Сдаётся квартира {br}BR в районе {d}, {p} млн/месяц. Бассейн, спортзал, вид на море. Контакт @owner{n}",
+    "For rent: {br} bedroom apartment in {d}, {p}tr per month, long term, fully furnished. WhatsApp +84 90{n:07d}",
+    "Дом {br} спальни, {d}, {p}.000.000 VND, 5 минут до пляжа, можно с животными #аренда #дананг",
+    "Studio {d}, ${usd}/month, balcony, washing machine, cleaning twice a week. Zalo 09{n:08d}",
+]
+
+
+@dataclass
+class HistoryMix:
+    """Share of each post kind in the synthetic history; the rest is plain text posts."""
+    album: float = 0.25
+    album_size: Tuple[int, int] = (2, 10)
+    album_uncaptioned: float = 0.1     # albums without a caption
+    media_single: float = 0.1
+    media_bare: float = 0.1            # media/service messages without text
+    repost: float = 0.05               # exact copy of one of the previous texts
+
+
+def synthetic_history(n: int, *, mix: Optional[HistoryMix] = None, seed: int = 0, top_id: Optional[int] = None) -> List[RawMessage]:
+    """Roughly n RawMessages new->old (albums are never cut), ids descending from top_id."""
+    mix = mix or HistoryMix()
+    rnd = random.Random(seed)
+    texts: List[str] = []
+    out: List[RawMessage] = []
+    mid = top_id or n + 10
+    gid = 10 ** 12
+
+    def _text() -> str:
+        if texts and rnd.random() < mix.repost:
+            return rnd.choice(texts)
+        t = rnd.choice(TEMPLATES).format(
+            br=rnd.randint(1, 4), d=rnd.choice(DISTRICTS), p=rnd.randint(6, 40),
+            usd=rnd.randint(300, 1500), n=rnd.randint(0, 9_999_999),
+        )
+        texts.append(t)
+        if len(texts) > 256:
+            texts.pop(0)
+        return t
+
+    while len(out) < n and mid > 0:
+        r = rnd.random()
+        if r < mix.album:
+            size = rnd.randint(*mix.album_size)
+            gid += 1
+            caption_at = -1 if rnd.random() < mix.album_uncaptioned else rnd.randrange(size)
+            caption = _text() if caption_at >= 0 else None
+            # new->old: ids descend within an album too
+            for j in range(size):
+                out.append(RawMessage(mid, caption if j == size - 1 - caption_at else None, gid, True))
+                mid -= 1
+        elif r < mix.album + mix.media_single:
+            out.append(RawMessage(mid, _text(), None, True))
+            mid -= 1
+        elif r < mix.album + mix.media_single + mix.media_bare:
+            out.append(RawMessage(mid, None, None, True))
+            mid -= 1
+        else:
+            out.append(RawMessage(mid, _text(), None, False))
+            mid -= 1
+    return out
+
+
+def _flood(seconds: int) -> FloodWaitError:
+    return FloodWaitError(request=None, capture=seconds)
+
+
+@dataclass
+class FakeHistoryClient:
+    """
+    Drop-in for TelethonHistoryClient.stream_messages over pre-generated histories.
+    Every page costs `page_latency_s` (+ uniform jitter); with probability `floodwait_rate`
+    a page raises FloodWaitError(`floodwait_s`) instead.
+    """
+    histories: Dict[Union[int, str], List[RawMessage]]
+    page_size: int = 100
+    page_latency_s: float = 0.05
+    page_jitter_s: float = 0.02
+    floodwait_rate: float = 0.0
+    floodwait_s: int = 1
+    seed: int = 0
+    pages_served: int = 0
+    floodwaits: int = 0
+    _rnd: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._rnd = random.Random(self.seed)
+        self.store = None
+        self.peers = None
+
+    async def stream_messages(self, chat: Union[int, str]) -> AsyncIterator[RawMessage]:
+        hist = self.histories.get(chat, [])
+        for start in range(0, len(hist), self.page_size):
+            await asyncio.sleep(self.page_latency_s + self._rnd.uniform(0, self.page_jitter_s))
+            if self._rnd.random() < self.floodwait_rate:
+                self.floodwaits += 1
+                raise _flood(self.floodwait_s)
+            self.pages_served += 1
+            for r in hist[start:start + self.page_size]:
+                yield r
+
+
+class FakeHistoryAPI:
+    """
+    Telethon client stand-in for TelethonHistoryClient: iter_messages(peer, limit, offset_id, min_id)
+    over pre-generated histories (new->old), one `request_latency_s` per request of up to 100
+    messages; with probability `floodwait_rate` a request raises FloodWaitError(`floodwait_s`).
+    """
+    def __init__(self, histories: Dict[Union[int, str], List[RawMessage]], *, request_latency_s: float = 0.1,
+                 floodwait_rate: float = 0.0, floodwait_s: int = 1, seed: int = 0):
+        self.histories = histories
+        self.request_latency_s = request_latency_s
+        self.floodwait_rate = floodwait_rate
+        self.floodwait_s = floodwait_s
+        self.requests = 0
+        self.floodwaits = 0
+        self._rnd = random.Random(seed)
+
+    async def iter_messages(self, peer, limit=None, offset_id: int = 0, min_id: int = 0, **kwargs):
+        hist = self.histories.get(peer, [])
+        picked = [r for r in hist if (not offset_id or r.id < offset_id) and r.id > min_id]
+        if limit is not None:
+            picked = picked[:limit]
+        for start in range(0, max(1, len(picked)), 100):
+            self.requests += 1
+            await asyncio.sleep(self.request_latency_s)
+            if self._rnd.random() < self.floodwait_rate:
+                self.floodwaits += 1
+                raise _flood(self.floodwait_s)
+            for r in picked[start:start + 100]:
+                yield tl.Message(id=r.id, peer_id=tl.PeerChannel(1), date=None, message=r.text or "",
+                                 grouped_id=r.grouped_id,
+                                 media=tl.MessageMediaPhoto(photo=tl.PhotoEmpty(id=r.id)) if r.has_media else None)
+
+
+class FakeLLM:
+    """
+    send_fn / batch_send_fn (score only) and reason_fn with lognormal latency (median `median_s`, spread `sigma`)
+    and an error rate; a share of errors looks like a 429 so the dispatcher throttles.
+    """
+    def __init__(self, *, median_s: float = 1.5, sigma: float = 0.5, error_rate: float = 0.0,
+                 throttle_share: float = 0.5, seed: int = 0):
+        self.median_s = median_s
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.throttle_share = throttle_share
+        self.calls = 0
+        self.errors = 0
+        self._rnd = random.Random(seed)
+
+    async def _latency(self) -> None:
+        self.calls += 1
+        await asyncio.sleep(self.median_s * self._rnd.lognormvariate(0.0, self.sigma))
+        if self._rnd.random() < self.error_rate:
+            self.errors += 1
+            if self._rnd.random() < self.throttle_share:
+                raise RuntimeError("429 Resource has been exhausted (fake)")
+            raise RuntimeError("500 Internal error (fake)")
+
+    def _score(self, text: str) -> int:
+        # deterministic in the text, so repeated runs are comparable
+        return sum(map(ord, text or "")) % 101
+
+    async def send_fn(self, text: str, criterion: Optional[str]) -> str:
+        await self._latency()
+        return json.dumps({"score": self._score(text)})
+
+    async def batch_send_fn(self, items: List[Tuple[str, str]], criterion: Optional[str]) -> str:
+        await self._latency()
+        return json.dumps([{"id": i, "score": self._score(t)} for i, t in items])
+
+    async def reason_fn(self, text: str, criterion: Optional[str]) -> str:
+        await self._latency()
+        return "fake"
+
+
+class _Sent:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+
+class FakeBot:
+    """Records Bot API calls (method, chat_id, monotonic time) with a fixed per-call latency."""
+    def __init__(self, *, latency_s: float = 0.03):
+        self.latency_s = latency_s
+        self.calls: List[Tuple[str, int, float]] = []
+        self._next_id = 1
+
+    async def _call(self, method: str, chat_id: int) -> _Sent:
+        await asyncio.sleep(self.latency_s)
+        self.calls.append((method, chat_id, asyncio.get_running_loop().time()))
+        self._next_id += 1
+        return _Sent(self._next_id)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> _Sent:
+        return await self._call("send_message", chat_id)
+
+    async def copy_message(self, chat_id: int, from_chat_id, message_id: int, **kwargs) -> _Sent:
+        return await self._call("copy_message", chat_id)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> _Sent:
+        return await self._call("edit_message_text", chat_id)
+
+
+class FakeTelethon:
+    """The Telethon calls delivery makes: entity lookups and forward_messages into the bridge."""
+    def __init__(self, *, forward_latency_s: float = 0.2):
+        self.forward_latency_s = forward_latency_s
+        self.forward_calls = 0
+        self._next_id = 1
+
+    async def get_input_entity(self, ident):
+        return ident
+
+    async def get_entity(self, ident):
+        return tl.Channel(id=1, title="bench", photo=tl.ChatPhotoEmpty(), date=None, username="bench")
+
+    async def forward_messages(self, target, ids: List[int], from_peer=None):
+        await asyncio.sleep(self.forward_latency_s)
+        self.forward_calls += 1
+        out = []
+        for _ in ids:
+            self._next_id += 1
+            out.append(tl.Message(id=self._next_id, peer_id=tl.PeerChannel(1), date=None, message=""))
+        return out
@@ -0,0 +1,80 @@
+"""
+Microbenchmarks for core.grouping on synthetic histories: the single-pass grouper against the
+original sort-based implementation, and the streaming path the search uses
+(stream_logical_messages + take_textful). Equivalence is checked in tests/test_grouping.py.
+
+    python -m bench.grouping --sizes 10000 100000 1000000 --repeat 3
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import gc
+import time
+from typing import AsyncIterator, Callable, Dict, List
+
+from bench.fakes import synthetic_history
+from core.grouping import (
+    _album,
+    _single,
+    group_into_logical_messages,
+    slice_logical_by_offset_limit_textful,
+    stream_logical_messages,
+    take_textful,
+)
+from core.models import LogicalMessage, RawMessage
+
+
+def reference_group(raws: List[RawMessage]) -> List[LogicalMessage]:
+    # исходная реализация: словарь списков, сортировка альбомов и всего результата
+    by_group: Dict[int, List[RawMessage]] = {}
+    singles: List[RawMessage] = []
+    for r in raws:
+        if r.grouped_id:
+            by_group.setdefault(r.grouped_id, []).append(r)
+        else:
+            singles.append(r)
+    logical = [_album(gid, sorted(chunk, key=lambda x: x.id)) for gid, chunk in by_group.items()]
+    logical += [_single(r) for r in singles]
+    logical.sort(key=lambda lm: lm.ids[0])
+    return logical
+
+
+async def _aiter(items: List[RawMessage]) -> AsyncIterator[RawMessage]:
+    for r in items:
+        yield r
+
+
+def _best(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def run(sizes: List[int], repeat: int, k: int) -> None:
+    print(f"{'messages':>10} {'reference':>10} {'group':>10} {'stream K':>10} {'slice':>10}  msgs/s (group)")
+    for n in sizes:
+        raws = synthetic_history(n, seed=n)
+        grouped = group_into_logical_messages(raws)
+        t_ref = _best(lambda: reference_group(raws), repeat)
+        t_group = _best(lambda: group_into_logical_messages(raws), repeat)
+        t_stream_k = _best(lambda: asyncio.run(take_textful(stream_logical_messages(_aiter(raws)), limit=k, offset=k)), repeat)
+        t_slice = _best(lambda: slice_logical_by_offset_limit_textful(grouped, limit=k, offset=k), repeat)
+        print(f"{len(raws):>10} {t_ref:>9.3f}s {t_group:>9.3f}s {t_stream_k:>9.4f}s"
+              f" {t_slice:>9.4f}s  {len(raws) / t_group:,.0f}")
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--k", type=int, default=100, help="K/OFFSET used for slicing")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    a = parse_args()
+    run(a.sizes, a.repeat, a.k)
@@ -0,0 +1,151 @@
+"""
+Offline webhook benchmark: POSTs recorded (or synthetic) Telegram updates to a local
+bot.webhook.WebhookServer in bursts and reports acceptance, duplicates, 503s, per-chat
+ordering and end-to-end latency. --workers 1 approximates one sequential consumer (polling).
+
+    python -m bench.webhook --updates recorded.jsonl --workers 8
+    python -m bench.webhook --chats 50 --updates-per-chat 40 --burst 200 --handler-latency 0.05
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from typing import Any, Dict, List
+
+from bot.webhook import WebhookServer, shard_key
+from core.metrics import METRICS
+
+SECRET = "bench-secret"
+
+
+def synthetic_updates(chats: int, per_chat: int, *, seed: int = 0) -> List[Dict[str, Any]]:
+    """Text messages and "why?" button taps from `chats` users, interleaved like a busy evening."""
+    rnd = random.Random(seed)
+    out: List[Dict[str, Any]] = []
+    uid = 1
+    order = [c for c in range(chats) for _ in range(per_chat)]
+    rnd.shuffle(order)
+    for chat in order:
+        user = {"id": 1000 + chat, "is_bot": False, "first_name": f"u{chat}"}
+        if rnd.random() < 0.2:
+            out.append({"update_id": uid, "callback_query": {
+                "id": str(uid), "from": user, "chat_instance": str(chat), "data": f"why:{uid:x}",
+                "message": {"message_id": uid, "date": 0, "chat": {"id": 1000 + chat, "type": "private"}},
+            }})
+        else:
+            out.append({"update_id": uid, "message": {
+                "message_id": uid, "date": 0, "from": user, "chat": {"id": 1000 + chat, "type": "private"},
+                "text": "10 0",
+            }})
+        uid += 1
+    return out
+
+
+def load_updates(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def _post(host: str, port: int, path: str, bodies: List[bytes], secret: str) -> List[int]:
+    # одно keep-alive соединение, как у Telegram
+    reader, writer = await asyncio.open_connection(host, port)
+    statuses = []
+    try:
+        for body in bodies:
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            while (await reader.readline()).strip():
+                pass
+            statuses.append(status)
+    finally:
+        writer.close()
+    return statuses
+
+
+async def main(args: argparse.Namespace) -> None:
+    METRICS.reset()
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.chats, args.updates_per_chat)
+    sent_at: Dict[int, float] = {}
+    done_at: Dict[int, float] = {}
+    seen_by_chat: Dict[int, List[int]] = {}
+
+    async def process(data: Dict[str, Any]) -> None:
+        await asyncio.sleep(args.handler_latency)
+        done_at[data["update_id"]] = time.perf_counter()
+        seen_by_chat.setdefault(shard_key(data), []).append(data["update_id"])
+
+    server = WebhookServer(process, secret_token=SECRET, path="/telegram",
+                           workers=args.workers, queue_max=args.queue_max)
+    await server.start("127.0.0.1", args.port)
+
+    # повторная доставка части апдейтов (как после таймаута у Telegram) и запрос с чужим секретом
+    rnd = random.Random(1)
+    stream = updates + [u for u in updates if rnd.random() < args.dup_rate]
+    unauthorized = await _post("127.0.0.1", args.port, "/telegram", [b"{}"], "wrong")
+
+    t0 = time.perf_counter()
+    statuses: List[int] = []
+    pending = list(stream)
+    retries = 0
+    while pending:
+        retry: List[Dict[str, Any]] = []
+        for start in range(0, len(pending), args.burst):
+            burst = pending[start:start + args.burst]
+            conns = [burst[i::args.connections] for i in range(args.connections)]
+            for u in burst:
+                sent_at.setdefault(u["update_id"], time.perf_counter())
+            results = await asyncio.gather(*(
+                _post("127.0.0.1", args.port, "/telegram", [json.dumps(u).encode() for u in c], SECRET)
+                for c in conns if c
+            ))
+            for c, st in zip([c for c in conns if c], results):
+                statuses += st
+                # 503 — Telegram пришлёт этот апдейт ещё раз, чуть позже
+                retry += [u for u, s in zip(c, st) if s == 503]
+            await asyncio.sleep(args.burst_gap)
+        if retry:
+            retries += len(retry)
+            await asyncio.sleep(args.retry_after)
+        pending = retry
+    await server.close(drain_s=60)
+    wall = time.perf_counter() - t0
+
+    lat = [done_at[u] - sent_at[u] for u in done_at]
+    out_of_order = sum(1 for ids in seen_by_chat.values() for a, b in zip(ids, ids[1:]) if a > b)
+    q = statistics.quantiles(lat, n=100) if len(lat) > 1 else [0.0] * 99
+    print(f"updates={len(updates)} posted={len(statuses)} workers={args.workers} queue_max={args.queue_max}")
+    print(f"processed: {len(done_at)}  duplicates dropped: {server.duplicates}  503s: {statuses.count(503)}"
+          f" (redelivered {retries})  unauthorized: {unauthorized}")
+    print(f"per-chat order violations: {out_of_order}")
+    print(f"latency: p50 {q[49] * 1000:.0f}ms  p95 {q[94] * 1000:.0f}ms  p99 {q[98] * 1000:.0f}ms  max {max(lat) * 1000:.0f}ms")
+    print(f"wall: {wall:.2f}s  throughput {len(done_at) / wall:.0f} updates/s")
+    print("-- core.metrics --")
+    print(METRICS.render_text())
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--updates", help="JSONL file with recorded Telegram updates (one per line)")
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--updates-per-chat", type=int, default=20)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--queue-max", type=int, default=1000)
+    p.add_argument("--burst", type=int, default=200, help="updates posted at once")
+    p.add_argument("--burst-gap", type=float, default=0.2)
+    p.add_argument("--connections", type=int, default=8)
+    p.add_argument("--handler-latency", type=float, default=0.02)
+    p.add_argument("--dup-rate", type=float, default=0.05)
+    p.add_argument("--retry-after", type=float, default=0.5)
+    p.add_argument("--port", type=int, default=18081)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
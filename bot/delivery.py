@@ -0,0 +1,253 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import logging
+
+from telethon.tl.types import Message as TLMessage
+from telegram.error import BadRequest, RetryAfter, TimedOut
+from telethon.errors import ChannelPrivateError, ChatAdminRequiredError, FloodWaitError, MessageIdInvalidError
+
+import config
+from core.dispatcher import TokenBucket
+from core.link import build_origin_link
+from core.metrics import METRICS
+from core.models import LogicalMessage, ScoreResult
+from transport.bridge_cache import BridgeCache
+
+log = logging.getLogger("rent-bot")
+
+FORWARD_MAX_IDS = 100  # лимит Telegram на messages.forwardMessages
+
+
+class ChatRateLimiter:
+    """
+    Bot API pacing: a token bucket per destination chat plus one global bucket.
+    Callers that need ordering within a chat take lock(chat_id) around their sends.
+    """
+    def __init__(self, per_chat_rate: float = 4.0, per_chat_burst: int = 10, global_rate: float = 25.0):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        return self._locks.setdefault(chat_id, asyncio.Lock())
+
+    async def acquire(self, chat_id: int) -> None:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        await bucket.acquire()
+        await self._global.acquire()
+
+    def penalize(self, chat_id: int, seconds: float) -> None:
+        # RetryAfter от Telegram: притормаживаем этот чат
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            bucket.pause(seconds)
+
+
+async def _bot_call(limiter: Optional[ChatRateLimiter], dest: int, fn, /, **kwargs):
+    for attempt in (1, 2, 3):
+        if limiter is not None:
+            await limiter.acquire(dest)
+        try:
+            with METRICS.timer("bot_send"):
+                return await fn(**kwargs)
+        except RetryAfter as e:
+            METRICS.inc("bot_retry_after")
+            ra = getattr(e, "retry_after", 1.0) or 1.0
+            delay = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            if attempt == 3:
+                raise
+            if limiter is not None:
+                limiter.penalize(dest, delay)
+            else:
+                await asyncio.sleep(delay)
+        except TimedOut:
+            METRICS.inc("bot_timeouts")
+            if attempt == 3:
+                raise
+            await asyncio.sleep(1.0)
+
+
+async def _input_entity(tele_client, ident: Union[int, str], peers=None):
+    if peers is not None:
+        return await peers.input_entity(tele_client, ident)
+    return await tele_client.get_input_entity(ident)
+
+
+async def forward_many_via_bridge(
+    tele_client, src_chat_identifier: Union[int, str], posts: List[LogicalMessage], peers=None
+) -> List[Optional[List[Optional[int]]]]:
+    """
+    Forwards all posts to the bridge in as few forward_messages calls as possible
+    (up to FORWARD_MAX_IDS ids per call, albums never split) and maps the returned bridge ids
+    back per post: result[i][j] is the bridge id of posts[i].ids[j] (None if lost);
+    result[i] is None if the whole call for that post failed.
+    """
+    out: List[Optional[List[Optional[int]]]] = [None] * len(posts)
+    if not posts:
+        return out
+    target = await _input_entity(tele_client, config.BRIDGE_CHAT_ID, peers)
+    src = await _input_entity(tele_client, src_chat_identifier, peers)
+
+    chunks: List[List[int]] = []
+    size = 0
+    for i, lm in enumerate(posts):
+        if not chunks or size + len(lm.ids) > FORWARD_MAX_IDS:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(i)
+        size += len(lm.ids)
+
+    for chunk in chunks:
+        ids = [mid for i in chunk for mid in posts[i].ids]
+        try:
+            with METRICS.timer("bridge_forward"):
+                res = await tele_client.forward_messages(target, ids, from_peer=src)
+            METRICS.inc("bridge_forwarded", len(ids))
+        except FloodWaitError:
+            METRICS.inc("floodwaits")
+            raise
+        except (ChannelPrivateError, ChatAdminRequiredError, MessageIdInvalidError) as te:
+            log.warning("Forward to bridge failed for %s: %s", ids, te)
+            continue
+        if isinstance(res, TLMessage):
+            res = [res]
+        if not isinstance(res, list):
+            raise RuntimeError(f"Unexpected return from forward_messages: {type(res)}")
+        # Telethon возвращает список, выровненный по входным id (None — не переслалось)
+        pos = 0
+        for i in chunk:
+            n = len(posts[i].ids)
+            out[i] = [m.id if isinstance(m, TLMessage) else None for m in res[pos:pos + n]]
+            pos += n
+    return out
+
+
+async def deliver_ranked(
+    bot, tele_client, from_chat_identifier: Optional[Union[int, str]], dest_user_id: int,
+    ranked: List[ScoreResult], *, peers=None, limiter: Optional[ChatRateLimiter] = None,
+    markup: Optional[Callable[[ScoreResult], Any]] = None, bridge_cache: Optional[BridgeCache] = None,
+    on_sent: Optional[Callable[[ScoreResult, Any, str], None]] = None,
+) -> int:
+    """
+    Delivers ranked items in order. Links are resolved concurrently, media posts go to the bridge
+    in bulk (one batch per source chat: lm.chat, or from_chat_identifier when unset), then the
+    copies/texts are sent to the user in ranking order under the limiter.
+    markup(sr) may return a reply_markup for the score line (e.g. the "why?" button).
+    With bridge_cache, posts already forwarded to the bridge are copied from there without a new forward.
+    on_sent(sr, message, text) is called with the sent score-line message and its text (e.g. to edit in a reason later).
+    Returns how many items were sent.
+    """
+    items = [sr for sr in ranked if sr.lm and sr.lm.text and sr.lm.text.strip()]
+    if not items:
+        return 0
+
+    def _src(sr: ScoreResult) -> Union[int, str]:
+        return sr.lm.chat if sr.lm.chat is not None else from_chat_identifier
+
+    links = await asyncio.gather(*(
+        build_origin_link(tele_client, _src(sr), sr.lm.caption_src_id or sr.lm.ids[0], peers=peers)
+        for sr in items
+    ))
+
+    by_chat: Dict[Union[int, str], List[int]] = {}
+    for i, sr in enumerate(items):
+        if sr.lm.has_media and sr.lm.caption_src_id:
+            by_chat.setdefault(_src(sr), []).append(i)
+    bridge_msg: Dict[int, Optional[int]] = {}
+    cached: Dict[int, str] = {}   # индекс -> ключ чата в bridge_cache, если копия взята из кеша
+
+    async def _forward(chat: Union[int, str], idxs: List[int]) -> None:
+        ckey = bridge_cache.key(chat, peers) if bridge_cache is not None else ""
+        if bridge_cache is not None:
+            # уже пересланные раньше (другому пользователю или в прошлом поиске) — сразу copy_message
+            known = bridge_cache.get_many(ckey, [items[i].lm.caption_src_id for i in idxs])
+            for i in idxs:
+                bid = known.get(items[i].lm.caption_src_id)
+                if bid:
+                    bridge_msg[i] = bid
+                    cached[i] = ckey
+            METRICS.inc("bridge_cache_hits", len(known))
+            idxs = [i for i in idxs if i not in cached]
+            if not idxs:
+                return
+        forwarded = await forward_many_via_bridge(tele_client, chat, [items[i].lm for i in idxs], peers=peers)
+        pairs: List[Tuple[int, int]] = []
+        for i, bridge_ids in zip(idxs, forwarded):
+            lm = items[i].lm
+            try:
+                bridge_msg[i] = bridge_ids[lm.ids.index(lm.caption_src_id)] if bridge_ids else None
+            except (ValueError, IndexError):
+                bridge_msg[i] = None
+            pairs += [(mid, bid) for mid, bid in zip(lm.ids, bridge_ids or ()) if bid]
+        if bridge_cache is not None and pairs:
+            bridge_cache.put_many(ckey, pairs)
+
+    async def _refresh(i: int) -> Optional[int]:
+        # копия в бридже пропала (удалили, BadRequest на copy) — забываем её и пересылаем заново
+        METRICS.inc("bridge_cache_stale")
+        bridge_cache.invalidate(cached.pop(i), items[i].lm.ids)
+        bridge_msg.pop(i, None)
+        try:
+            await _forward(_src(items[i]), [i])
+        except Exception as e:
+            log.info("Re-forward to bridge failed: %s", e)
+        return bridge_msg.get(i)
+
+    await asyncio.gather(*(_forward(chat, idxs) for chat, idxs in by_chat.items()))
+
+    lock = limiter.lock(dest_user_id) if limiter is not None else asyncio.Lock()
+    async with lock:
+        for i, sr in enumerate(items):
+            refresh = (lambda i=i: _refresh(i)) if i in cached else None
+            sent, text = await _send_item(bot, dest_user_id, sr, links[i], bridge_msg.get(i), limiter,
+                                          markup(sr) if markup is not None else None, refresh)
+            if on_sent is not None:
+                on_sent(sr, sent, text)
+    return len(items)
+
+
+async def append_to_message(bot, chat_id: int, message_id: int, text: str, extra: str,
+                            *, limiter: Optional[ChatRateLimiter] = None) -> None:
+    """Appends extra to an already sent message (text is what it currently says); replies instead if it cannot be edited."""
+    try:
+        await _bot_call(limiter, chat_id, bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=f"{text}\n{extra}")
+    except BadRequest:
+        await _bot_call(limiter, chat_id, bot.send_message, chat_id=chat_id, text=extra, reply_to_message_id=message_id)
+
+
+async def _send_item(bot, chat_id: int, sr: ScoreResult, origin_url: Optional[str], bridge_msg_id: Optional[int], limiter,
+                     reply_markup=None, refresh: Optional[Callable[[], Awaitable[Optional[int]]]] = None) -> Tuple[Any, str]:
+    # возвращает (сообщение с оценкой, его текст)
+    lm = sr.lm
+    tail = _format_tail(origin_url, sr.score, sr.reason, lm.reposts, sr.unscored)
+    while bridge_msg_id:
+        try:
+            await _bot_call(limiter, chat_id, bot.copy_message,
+                            chat_id=chat_id, from_chat_id=config.BRIDGE_CHAT_ID_NUMBER, message_id=bridge_msg_id)
+        except BadRequest as e:
+            log.info("copy_message from bridge failed %s: %s", bridge_msg_id, e)
+            # кешированная копия могла устареть: один раз пересылаем заново и пробуем ещё
+            bridge_msg_id, refresh = (await refresh() if refresh is not None else None), None
+            continue
+        sent = await _bot_call(limiter, chat_id, bot.send_message, chat_id=chat_id, text=tail, reply_markup=reply_markup)
+        return sent, tail
+    text = f"{lm.text}\n\n{tail}"
+    sent = await _bot_call(limiter, chat_id, bot.send_message, chat_id=chat_id, text=text, reply_markup=reply_markup)
+    return sent, text
+
+
+def _format_tail(origin_url: Optional[str], score: float, reason: Optional[str], reposts: int, unscored: bool = False) -> str:
+    if unscored:
+        tail = f"🔗 Оригинал: {origin_url}\n⭐ Оценка: нет (LLM не ответил)"
+    else:
+        tail = f"🔗 Оригинал: {origin_url}\n⭐ Оценка: {score:.2f}"
+    if reason:
+        tail += f" — {reason}"
+    if reposts:
+        tail += f"\n🔁 Повторов: {reposts}"
+    return tail
@@ -0,0 +1,41 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Optional, Tuple
+import itertools
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from core.models import ScoreResult
+
+WHY_PREFIX = "why:"
+
+
+class WhyButtons:
+    """
+    Inline "why?" buttons under delivered listings. callback_data is limited to 64 bytes,
+    so it only carries a token; the listing text and criterion stay here (last `max_size`).
+    """
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max_size
+        self._ids = itertools.count(1)
+        self._items: "OrderedDict[str, Tuple[str, Optional[str]]]" = OrderedDict()
+
+    def markup(self, sr: ScoreResult, criterion: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+        # кнопка нужна, только если есть оценка, но обоснования ещё нет
+        if sr.unscored or sr.reason or not (sr.lm and sr.lm.text):
+            return None
+        token = format(next(self._ids), "x")
+        self._items[token] = (sr.lm.text, criterion)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🤔 Почему?", callback_data=WHY_PREFIX + token)]])
+
+    def get(self, data: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+        if not data or not data.startswith(WHY_PREFIX):
+            return None
+        return self._items.get(data[len(WHY_PREFIX):])
+
+    def pop(self, data: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+        if not data or not data.startswith(WHY_PREFIX):
+            return None
+        return self._items.pop(data[len(WHY_PREFIX):], None)
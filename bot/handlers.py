@@ -1,16 +1,29 @@
 from __future__ import annotations
+import asyncio
 import logging
+import time
 from typing import Optional, Union, List
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, ConversationHandler, ContextTypes, filters
-from telegram.error import TimedOut
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, ConversationHandler, ContextTypes, filters
+from telegram.error import BadRequest, TimedOut
 
-from config import TOP_K, FILTERS_PATH
+from config import TOP_K, CHAT_SETS, PREFILTER_MODE, PREFILTER_PRICE_TOLERANCE, VND_PER_USD
+import config
+from config import WATCH_DEFAULT_THRESHOLD, SHORTLIST_MAX_SCAN
+from config import DEDUP_ENABLED, DEDUP_MAX_DISTANCE, PROGRESSIVE_THRESHOLD, LLM_REASONS_TOP_N
 from core.models import ScoreResult
-from core.llm import LLMScorer, score_logical_messages
-from core.filters import append_criterion, read_latest_criterion
-from bot.pipeline import read_logical_messages, send_ranked_item
+from core.llm import LLMScorer, iter_score_logical_messages
+from core.ranking import StreamingRanker
+from core.prefilter import prefilter_logical_messages
+from core.dedup import collapse_near_duplicates
+from core.shortlist import shortlist_logical_messages
+from bot.pipeline import read_logical_messages_multi
+from bot.delivery import append_to_message, deliver_ranked
+from bot.explain import WHY_PREFIX, WhyButtons
+from bot.jobs import Job, JobScheduler
+from bot.watch import Subscription, parse_threshold
+from core.metrics import METRICS
 
 log = logging.getLogger("rent-bot")
 
@@ -29,7 +42,6 @@ async def _safe_reply(update: Update, text: str, **kwargs):
         except TimedOut:
             if attempt == 2:
                 raise
-            import asyncio
             await asyncio.sleep(1.0)
     return None
 
@@ -41,7 +53,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def ask_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await _safe_reply(
         update,
-        "Введи numeric chat_id или @username канала/чата. Пример: -1001234567890 или @rentals_dn.",
+        "Введи numeric chat_id или @username канала/чата. Пример: -1001234567890 или @rentals_dn.\n"
+        "Можно несколько через пробел/запятую или сохранённый набор: #имя.",
         reply_markup=ReplyKeyboardRemove(),
     )
     return STATE_WAIT_CHAT_ID
@@ -59,82 +72,253 @@ def _parse_chat_identifier(text: str) -> Optional[Union[int, str]]:
         return None
 
 
-def _parse_k_offset(text: str) -> tuple[int, int]:
+def _parse_chat_identifiers(text: str) -> Optional[List[Union[int, str]]]:
+    # "@a, -100123 @b" или "#набор" из CHAT_SETS; None, если хоть один элемент не распознан
+    out: List[Union[int, str]] = []
+    for part in (text or "").replace(",", " ").split():
+        if part.startswith("#"):
+            chats = CHAT_SETS.get(part[1:])
+            if not chats:
+                return None
+            parsed = [_parse_chat_identifier(str(c)) for c in chats]
+            if any(p is None for p in parsed):
+                return None
+            out.extend(parsed)
+            continue
+        ident = _parse_chat_identifier(part)
+        if ident is None:
+            return None
+        out.append(ident)
+    # без дублей, порядок сохраняем
+    return list(dict.fromkeys(out)) or None
+
+
+def _parse_k_offset(text: str) -> tuple[int, int, Optional[int]]:
+    # "K", "K OFFSET" или "K OFFSET M": просмотреть K, в LLM отдать M лучших по локальному рейтингу
     t = (text or "").strip()
     if not t:
-        return TOP_K, 0
+        return TOP_K, 0, None
     parts = t.split()
     try:
         if len(parts) == 1:
             k = max(1, int(parts[0]))
-            return k, 0
-        k = min(100, max(1, int(parts[0])))
+            return k, 0, None
+        if len(parts) == 2:
+            k = min(100, max(1, int(parts[0])))
+            off = max(0, int(parts[1]))
+            return k, off, None
+        m = max(1, int(parts[2]))
+        k = min(SHORTLIST_MAX_SCAN, max(1, int(parts[0])))
         off = max(0, int(parts[1]))
-        return k, off
+        return k, off, min(m, k)
     except Exception:
-        return TOP_K, 0
+        return TOP_K, 0, None
 
 
 async def handle_chat_id_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     raw = update.message.text or ""
-    chat_identifier = _parse_chat_identifier(raw)
-    if chat_identifier is None:
+    chat_identifiers = _parse_chat_identifiers(raw)
+    if chat_identifiers is None:
         await _safe_reply(update, "Это не похоже на chat_id/@username. Введи корректно или /cancel.")
         return STATE_WAIT_CHAT_ID
 
-    context.user_data["chat_identifier"] = chat_identifier
+    context.user_data["chat_identifiers"] = chat_identifiers
     await _safe_reply(
         update,
         "Сколько объявлений анализировать и с какого отступа? Формат: `K` или `K OFFSET`.\n"
-        f"Например: `10` или `10 5`. По умолчанию K={TOP_K}, OFFSET=0.",
+        f"Например: `10` или `10 5`. По умолчанию K={TOP_K}, OFFSET=0.\n"
+        f"`K OFFSET M` — просмотреть K (до {SHORTLIST_MAX_SCAN}), а в LLM отдать только M самых похожих на критерий, "
+        "например `1000 0 50`.",
         parse_mode="Markdown",
     )
     return STATE_WAIT_PARAMS
 
 
 async def handle_params(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    chat_identifier = context.user_data.get("chat_identifier")
-    if chat_identifier is None:
+    chat_identifiers = context.user_data.get("chat_identifiers")
+    if not chat_identifiers:
         await _safe_reply(update, "Не вижу chat_id. Начни заново.", reply_markup=MAIN_KB)
         return ConversationHandler.END
 
-    k, offset = _parse_k_offset(update.message.text or "")
-    dest_user_id = update.effective_user.id
-    th_client = context.bot_data.get("telethon_client")  # TelethonHistoryClient or None
-    tele_client = getattr(th_client, "client", None)
-    scorer: Optional[LLMScorer] = context.bot_data.get("llm_scorer")
-
-    if not scorer:
+    k, offset, top_m = _parse_k_offset(update.message.text or "")
+    if not context.bot_data.get("llm_scorer"):
         await _safe_reply(update, "LLM анализатор не настроен.", reply_markup=MAIN_KB)
         return ConversationHandler.END
 
-    # читаем K логсообщений (с текстом) с заданным offset
-    logical_msgs = await read_logical_messages(
-        th_client, from_chat=chat_identifier, limit_textful=k, offset_textful=offset
-    )
-    if not logical_msgs:
-        await _safe_reply(update, "Не удалось прочитать сообщения или они пусты.", reply_markup=MAIN_KB)
-        return ConversationHandler.END
-
-    # читаем последний сохранённый критерий
-    from pathlib import Path
+    # сам поиск — фоновое задание: очередь с лимитами на пользователя, прогресс в одном сообщении, /cancel
+    jobs: JobScheduler = context.bot_data["jobs"]
+    label = f"Поиск K={k}" + (f" OFFSET={offset}" if offset else "") + (f" M={top_m}" if top_m else "")
 
-    criterion = read_latest_criterion(Path(FILTERS_PATH))
+    async def _run(job: Job) -> None:
+        await _run_search(update, context, job, chat_identifiers, k, offset, top_m)
 
-    # скорим с данным критерием, сортируем по убыванию
-    scored: List[ScoreResult] = await score_logical_messages(scorer, logical_msgs, criterion)
-    scored.sort(key=lambda s: s.score, reverse=True)
+    job = await jobs.submit(context.bot, update.effective_chat.id, update.effective_user.id, label, _run)
+    if job is None:
+        await _safe_reply(update, "У тебя уже слишком много поисков в очереди. Дождись их или /cancel.", reply_markup=MAIN_KB)
+    else:
+        await _safe_reply(update, "Поиск запущен в фоне. Остановить — /cancel.", reply_markup=MAIN_KB)
+    return ConversationHandler.END
 
-    # отправляем пользователю
-    for sr in scored:
-        await send_ranked_item(context.bot, tele_client, chat_identifier, dest_user_id, sr)
 
-    await _safe_reply(
-        update,
-        f"Готово. Проанализировано {len(scored)} и отправлено в порядке убывания оценки.",
-        reply_markup=MAIN_KB,
+async def _run_search(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, job: Job,
+    chat_identifiers: List[Union[int, str]], k: int, offset: int, top_m: Optional[int],
+) -> None:
+    METRICS.inc("searches")
+    t_search = time.perf_counter()
+    dest_user_id = update.effective_user.id
+    th_client = context.bot_data.get("telethon_client")  # TelethonHistoryClient or None
+    tele_client = getattr(th_client, "client", None)
+    peers = getattr(th_client, "peers", None)
+    scorer: LLMScorer = context.bot_data["llm_scorer"]
+    progress = job.progress
+
+    await progress.update(f"📥 {job.label}: читаю историю…", force=True)
+    # читаем K логсообщений (с текстом) с заданным offset — из всех чатов параллельно
+    logical_msgs, failed_chats = await read_logical_messages_multi(
+        th_client, chat_identifiers, limit_textful=k, offset_textful=offset
     )
-    return ConversationHandler.END
+    if not logical_msgs:
+        await progress.update(f"⚠️ {job.label}: нет сообщений", force=True)
+        await _safe_reply(update, "Не удалось прочитать сообщения или они пусты.", reply_markup=MAIN_KB)
+        return
+    job.check()
+
+    # схлопываем репосты одного и того же объявления (в т.ч. между чатами) до одной копии (самой свежей в первом по списку чате, где она есть)
+    collapsed = 0
+    if DEDUP_ENABLED:
+        before = len(logical_msgs)
+        logical_msgs = collapse_near_duplicates(
+            logical_msgs, index=context.bot_data.get("dedup_index"), max_distance=DEDUP_MAX_DISTANCE
+        )
+        collapsed = before - len(logical_msgs)
+
+    # последний сохранённый критерий этого пользователя
+    criterion = context.bot_data["criteria"].latest(dest_user_id)
+
+    # дешёвый локальный отсев явных несовпадений (цена/спальни/район) — без вызова LLM
+    rejected: List[ScoreResult] = []
+    if PREFILTER_MODE != "off":
+        logical_msgs, rejected = prefilter_logical_messages(
+            logical_msgs, criterion, price_tolerance=PREFILTER_PRICE_TOLERANCE, vnd_per_usd=VND_PER_USD
+        )
+        if rejected:
+            log.info("Pre-filter skipped %d of %d LLM calls", len(rejected), len(rejected) + len(logical_msgs))
+
+    # локальный TF-IDF рейтинг: в LLM идут только M самых похожих на критерий
+    shortlisted_out = 0
+    if top_m is not None:
+        logical_msgs, dropped = shortlist_logical_messages(logical_msgs, criterion, top_m)
+        shortlisted_out = len(dropped)
+        METRICS.inc("shortlist_dropped", shortlisted_out)
+
+    # скорим с данным критерием; по мере готовности отдаём то, чьё место уже определено
+    # (или что выше порога), остальное — по убыванию оценки в конце, неоценённые — после оценённых
+    # несколько чатов — один общий рейтинг; в любом случае держим и отдаём не больше K лучших
+    total = len(logical_msgs)
+    multi = len(chat_identifiers) > 1
+    ranker = StreamingRanker(total, threshold=PROGRESSIVE_THRESHOLD, limit=k)
+
+    why: Optional[WhyButtons] = context.bot_data.get("why")
+    limiter = context.bot_data.get("bot_limiter")
+    explained = sent_unscored = 0
+    reason_tasks: List[asyncio.Task] = []
+
+    async def _add_reason(sr: ScoreResult, sent, text: str) -> None:
+        # обоснование догоняет уже отправленное объявление: дописываем его в сообщение с оценкой
+        reason = await scorer.explain(sr.lm.text, criterion, key=dest_user_id)
+        if not reason or sent is None:
+            return
+        sr.reason = reason
+        await append_to_message(context.bot, dest_user_id, sent.message_id, text, f"💬 {reason}", limiter=limiter)
+
+    def _on_sent(sr: ScoreResult, sent, text: str) -> None:
+        # первый проход дал только оценки: обоснования — для первых N отправленных (в фоне,
+        # не задерживая само объявление), остальным кнопка "Почему?"
+        nonlocal explained
+        if sr.unscored or sr.reason or explained >= LLM_REASONS_TOP_N:
+            return
+        explained += 1
+        reason_tasks.append(asyncio.create_task(_add_reason(sr, sent, text)))
+
+    async def _deliver(batch: List[ScoreResult]) -> None:
+        nonlocal sent_unscored
+        sent_unscored += sum(1 for sr in batch if sr.unscored)
+        await deliver_ranked(
+            context.bot, tele_client, None, dest_user_id, batch,
+            peers=peers, limiter=limiter,
+            markup=(lambda sr: why.markup(sr, criterion)) if why is not None else None,
+            bridge_cache=context.bot_data.get("bridge_cache"), on_sent=_on_sent,
+        )
+
+    unscored = 0
+    try:
+        # отмена (/cancel) прерывает этот цикл: генератор в finally снимает ещё не отправленные вызовы LLM
+        async for sr in iter_score_logical_messages(scorer, logical_msgs, criterion, user_key=dest_user_id):
+            job.check()
+            unscored += sr.unscored
+            ranker.push(sr)
+            ready = ranker.pop_ready()
+            if ready:
+                await _deliver(ready)
+            await progress.update(f"⏳ {job.label}: оценено {ranker.scored}/{total}, отправлено {ranker.delivered}")
+        await progress.update(f"✅ {job.label}: оценено {ranker.scored}/{total}", force=True)
+        job.check()
+
+        # медиа — пачкой в бридж, дальше по порядку рейтинга под лимитером Bot API
+        tail_items = ranker.drain()
+        if PREFILTER_MODE == "downrank" and not multi:
+            tail_items.extend(rejected)
+        await _deliver(tail_items)
+        # обоснования первых N дописываются в фоне; ждём их, чтобы «Готово» пришло последним
+        await asyncio.gather(*reason_tasks, return_exceptions=True)
+    finally:
+        for t in reason_tasks:
+            t.cancel()
+
+    done = f"Готово. Проанализировано {total + len(rejected) + shortlisted_out}"
+    if ranker.early:
+        done += (f". С оценкой от {PROGRESSIVE_THRESHOLD:.2f} отправлены сразу по готовности ({ranker.early}),"
+                 " остальные — в порядке убывания оценки.")
+    else:
+        done += " и отправлено в порядке убывания оценки."
+    if rejected:
+        done += f"\nОтсеяно фильтром без LLM: {len(rejected)}."
+    if shortlisted_out:
+        done += f"\nНе попали в шорт-лист (по локальному сходству): {shortlisted_out}."
+    if unscored:
+        done += f"\nБез оценки (LLM не ответил вовремя): {unscored}"
+        done += f" — отправлены после оценённых: {sent_unscored}." if sent_unscored else " — не вошли в лучшие."
+    if collapsed:
+        done += f"\nСхлопнуто повторов: {collapsed}."
+    if failed_chats:
+        done += "\nНе удалось прочитать: " + ", ".join(str(c) for c in failed_chats) + "."
+    METRICS.observe("search_total", time.perf_counter() - t_search)
+    await _safe_reply(update, done, reply_markup=MAIN_KB)
+
+
+async def why_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # кнопка "Почему?": обоснование генерируется только сейчас, по запросу
+    query = update.callback_query
+    why: Optional[WhyButtons] = context.bot_data.get("why")
+    # забираем кнопку только после удачного ответа: при сбое LLM её можно нажать ещё раз
+    item = why.get(query.data) if why is not None else None
+    if item is None:
+        await query.answer("Кнопка устарела — запусти поиск ещё раз.")
+        return
+    await query.answer("Спрашиваю LLM…")
+    METRICS.inc("why_clicks")
+    text, criterion = item
+    reason = await context.bot_data["llm_scorer"].explain(text, criterion, key=update.effective_user.id)
+    if not reason:
+        await query.message.reply_text("Не удалось получить обоснование, попробуй позже.")
+        return
+    why.pop(query.data)
+    try:
+        await query.edit_message_text(f"{query.message.text}\n💬 {reason}")
+    except BadRequest:
+        # сообщение слишком длинное или не текстовое — отвечаем отдельно
+        await query.message.reply_text(f"💬 {reason}", reply_to_message_id=query.message.message_id)
 
 
 # ---------- Сохранение фильтра ----------
@@ -152,15 +336,83 @@ async def handle_filter_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not text:
         await _safe_reply(update, "Пустой критерий не сохраняю. Возвращаю кнопки.", reply_markup=MAIN_KB)
         return ConversationHandler.END
-    from pathlib import Path
-
-    append_criterion(Path(FILTERS_PATH), text)
+    context.bot_data["criteria"].append(update.effective_user.id, text)
     await _safe_reply(update, "Критерий сохранён.", reply_markup=MAIN_KB)
     return ConversationHandler.END
 
 
+# ---------- Подписки (live watch) ----------
+async def watch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    watch = context.bot_data.get("watch_service")
+    if watch is None:
+        await _safe_reply(update, "Режим подписки недоступен (нет Telethon).", reply_markup=MAIN_KB)
+        return
+    args = list(context.args or [])
+    threshold = WATCH_DEFAULT_THRESHOLD
+    if len(args) > 1 and parse_threshold(args[-1]) is not None:
+        threshold = parse_threshold(args.pop())
+    chats = _parse_chat_identifiers(" ".join(args))
+    if not chats:
+        await _safe_reply(update, "Формат: /watch @chat [@chat2 ...] [порог 0..1 или 0..100]. Можно #набор.")
+        return
+
+    user_id = update.effective_user.id
+    added, failed = [], []
+    for ident in chats:
+        try:
+            chat_id = await watch.resolve_chat_id(ident)
+        except Exception as e:
+            log.info("watch: cannot resolve %s: %s", ident, e)
+            failed.append(str(ident))
+            continue
+        watch.store.add(Subscription(user_id=user_id, chat_id=chat_id, ident=str(ident), threshold=threshold))
+        added.append(str(ident))
+    text = f"Слежу за: {', '.join(added) or '—'} (порог {threshold:.2f}). Новые объявления оцениваются по последнему критерию."
+    if failed:
+        text += f"\nНе удалось найти: {', '.join(failed)}."
+    await _safe_reply(update, text, reply_markup=MAIN_KB)
+
+
+async def unwatch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    watch = context.bot_data.get("watch_service")
+    if watch is None:
+        await _safe_reply(update, "Режим подписки недоступен (нет Telethon).", reply_markup=MAIN_KB)
+        return
+    user_id = update.effective_user.id
+    chats = _parse_chat_identifiers(" ".join(context.args or []))
+    removed = 0
+    if not chats:
+        removed = watch.store.remove(user_id)
+    else:
+        subs = {s.ident: s.chat_id for s in watch.store.for_user(user_id)}
+        for ident in chats:
+            if str(ident) in subs:
+                removed += watch.store.remove(user_id, subs[str(ident)])
+    await _safe_reply(update, f"Подписок снято: {removed}.", reply_markup=MAIN_KB)
+
+
+async def watches_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    watch = context.bot_data.get("watch_service")
+    subs = watch.store.for_user(update.effective_user.id) if watch is not None else []
+    if not subs:
+        await _safe_reply(update, "Подписок нет. /watch @chat [порог]", reply_markup=MAIN_KB)
+        return
+    lines = [f"• {s.ident} — порог {s.threshold:.2f}" for s in subs]
+    await _safe_reply(update, "Подписки:\n" + "\n".join(lines), reply_markup=MAIN_KB)
+
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in config.ADMIN_USER_IDS:
+        await _safe_reply(update, "Команда только для админов.")
+        return
+    await _safe_reply(update, METRICS.render_text())
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await _safe_reply(update, "Отменено.", reply_markup=MAIN_KB)
+    # и выход из диалога, и остановка поисков пользователя (в очереди и запущенных)
+    jobs: Optional[JobScheduler] = context.bot_data.get("jobs")
+    n = await jobs.cancel(update.effective_user.id) if jobs is not None else 0
+    await _safe_reply(update, f"Отменено. Остановлено поисков: {n}." if n else "Отменено.", reply_markup=MAIN_KB)
     return ConversationHandler.END
 
 
@@ -183,5 +435,12 @@ def register_handlers(app: Application) -> None:
         persistent=False,
     )
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("watch", watch_cmd))
+    app.add_handler(CommandHandler("unwatch", unwatch_cmd))
+    app.add_handler(CommandHandler("watches", watches_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    # block=False: вызов LLM по кнопке не должен задерживать остальные апдейты
+    app.add_handler(CallbackQueryHandler(why_cb, pattern=f"^{WHY_PREFIX}", block=False))
     app.add_handler(conv_analyze)
     app.add_handler(conv_save)
+    app.add_handler(CommandHandler("cancel", cancel))  # вне диалога — остановить фоновые поиски
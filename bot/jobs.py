@@ -0,0 +1,160 @@
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+import itertools
+import logging
+import time
+
+from bot.progress import ProgressMessage
+
+log = logging.getLogger("rent-bot")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    label: str
+    run: Callable[["Job"], Awaitable[None]]
+    progress: ProgressMessage
+    state: str = "queued"                 # queued | running | done | cancelled | failed
+    created: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Task] = None
+    cancelled: bool = False
+
+    def check(self) -> None:
+        """Cooperative cancellation point for the job body."""
+        if self.cancelled:
+            raise JobCancelled()
+
+
+class JobScheduler:
+    """
+    In-process queue for heavy searches: at most `global_limit` jobs run at once and at most
+    `per_user_limit` per user; the next job is taken round-robin across users.
+    Each job owns one status message that shows its queue position and then its progress.
+    """
+    def __init__(self, *, global_limit: int = 3, per_user_limit: int = 1, per_user_queue_max: int = 3,
+                 progress_interval_s: float = 2.0):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.per_user_queue_max = per_user_queue_max
+        self.progress_interval_s = progress_interval_s
+        self._ids = itertools.count(1)
+        self._queues: Dict[int, Deque[Job]] = {}
+        self._rr: Deque[int] = deque()
+        self._running: Dict[int, List[Job]] = {}
+
+    @property
+    def running(self) -> int:
+        return sum(len(v) for v in self._running.values())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def jobs_of(self, user_id: int) -> List[Job]:
+        return list(self._running.get(user_id, [])) + list(self._queues.get(user_id, []))
+
+    async def submit(self, bot, chat_id: int, user_id: int, label: str,
+                     run: Callable[[Job], Awaitable[None]]) -> Optional[Job]:
+        """Queues a job; returns None if the user already has too many jobs waiting."""
+        if len(self._queues.get(user_id, ())) >= self.per_user_queue_max:
+            return None
+        progress = await ProgressMessage.send(bot, chat_id, f"🕒 {label}: в очереди…", interval_s=self.progress_interval_s)
+        job = Job(next(self._ids), user_id, label, run, progress)
+        q = self._queues.get(user_id)
+        if q is None:
+            q = self._queues[user_id] = deque()
+            self._rr.append(user_id)
+        q.append(job)
+        self._pump()
+        if job.state == "queued":
+            await self._show_positions(force=True)
+        return job
+
+    async def cancel(self, user_id: int) -> int:
+        """Cancels every queued and running job of the user. Returns how many were cancelled."""
+        n = 0
+        for job in list(self._queues.pop(user_id, ())):
+            job.cancelled = True
+            job.state = "cancelled"
+            await job.progress.update(f"⛔ {job.label}: отменено", force=True)
+            n += 1
+        if user_id in self._rr:
+            self._rr.remove(user_id)
+        for job in list(self._running.get(user_id, ())):
+            job.cancelled = True
+            if job.task is not None:
+                job.task.cancel()
+            n += 1
+        await self._show_positions()
+        return n
+
+    async def close(self) -> None:
+        for user_id in list(self._queues) + list(self._running):
+            await self.cancel(user_id)
+
+    def _pump(self) -> None:
+        # round-robin: по одному заданию от каждого пользователя, у кого есть свободный слот
+        skipped = 0
+        while self._rr and self.running < self.global_limit and skipped < len(self._rr):
+            user_id = self._rr[0]
+            self._rr.rotate(-1)
+            if len(self._running.get(user_id, ())) >= self.per_user_limit:
+                skipped += 1
+                continue
+            skipped = 0
+            q = self._queues[user_id]
+            job = q.popleft()
+            if not q:
+                del self._queues[user_id]
+                self._rr.remove(user_id)
+            self._start(job)
+
+    def _start(self, job: Job) -> None:
+        job.state = "running"
+        self._running.setdefault(job.user_id, []).append(job)
+        job.task = asyncio.get_running_loop().create_task(self._run(job))
+        job.task.add_done_callback(lambda _t: self._finished(job))
+
+    async def _run(self, job: Job) -> None:
+        try:
+            await job.run(job)
+            job.state = "done"
+        except (asyncio.CancelledError, JobCancelled):
+            job.state = "cancelled"
+            await job.progress.update(f"⛔ {job.label}: отменено", force=True)
+        except Exception:
+            job.state = "failed"
+            log.exception("Job %d (%s) of user %d failed", job.id, job.label, job.user_id)
+            await job.progress.update(f"❌ {job.label}: ошибка, попробуй ещё раз", force=True)
+
+    def _finished(self, job: Job) -> None:
+        # done-callback, а не finally: задание могли отменить до первого шага корутины
+        if job.state == "running":
+            job.state = "cancelled"
+        running = self._running.get(job.user_id, [])
+        if job in running:
+            running.remove(job)
+        if not running:
+            self._running.pop(job.user_id, None)
+        self._pump()
+        asyncio.get_running_loop().create_task(self._show_positions())
+
+    def _positions(self) -> List[Job]:
+        # порядок, в котором задания будут запущены: по кругу, по одному от пользователя;
+        # у кого слоты заняты — в конце круга
+        users = sorted(self._rr, key=lambda u: len(self._running.get(u, ())) >= self.per_user_limit)
+        queues = [list(self._queues[u]) for u in users]
+        return [j for rnd in itertools.zip_longest(*queues) for j in rnd if j is not None]
+
+    async def _show_positions(self, *, force: bool = False) -> None:
+        for pos, job in enumerate(self._positions(), 1):
+            await job.progress.update(f"🕒 {job.label}: в очереди, позиция {pos}", force=force)
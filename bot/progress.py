@@ -0,0 +1,42 @@
+from __future__ import annotations
+from typing import Optional
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+log = logging.getLogger("rent-bot")
+
+
+class ProgressMessage:
+    """One status message edited in place, at most once per `interval_s` (Bot API edit limits)."""
+    def __init__(self, bot, chat_id: int, message_id: int, *, interval_s: float = 2.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval_s = interval_s
+        self._last_text: Optional[str] = None
+        self._last_ts = 0.0
+
+    @classmethod
+    async def send(cls, bot, chat_id: int, text: str, *, interval_s: float = 2.0) -> "ProgressMessage":
+        msg = await bot.send_message(chat_id=chat_id, text=text)
+        pm = cls(bot, chat_id, msg.message_id, interval_s=interval_s)
+        pm._last_text = text
+        pm._last_ts = time.monotonic()
+        return pm
+
+    async def update(self, text: str, *, force: bool = False) -> None:
+        if text == self._last_text:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_ts < self.interval_s:
+            return
+        try:
+            await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
+        except (BadRequest, RetryAfter, TimedOut) as e:
+            # прогресс — косметика, поиск из-за него не роняем
+            log.debug("Progress edit failed: %s", e)
+            return
+        self._last_text = text
+        self._last_ts = now
@@ -0,0 +1,183 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import logging
+import sqlite3
+import time
+
+from core.filters import CriteriaStore
+from core.grouping import group_into_logical_messages
+from core.models import LogicalMessage, RawMessage
+from bot.delivery import deliver_ranked
+from transport.telethon_client import to_raw_message
+
+log = logging.getLogger("rent-bot")
+
+
+@dataclass
+class Subscription:
+    user_id: int
+    chat_id: int            # marked id (как event.chat_id)
+    ident: str              # как ввёл пользователь — для ссылок и форварда
+    threshold: float        # 0..1
+
+
+class SubscriptionStore:
+    """Watch subscriptions (user, chat, threshold) in SQLite, looked up by event chat id."""
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS subs ("
+            " user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, ident TEXT NOT NULL,"
+            " threshold REAL NOT NULL, ts REAL NOT NULL, PRIMARY KEY (user_id, chat_id))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS subs_chat ON subs(chat_id)")
+        self._db.commit()
+
+    def add(self, sub: Subscription) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO subs (user_id, chat_id, ident, threshold, ts) VALUES (?, ?, ?, ?, ?)",
+            (sub.user_id, sub.chat_id, sub.ident, sub.threshold, time.time()),
+        )
+        self._db.commit()
+
+    def remove(self, user_id: int, chat_id: Optional[int] = None) -> int:
+        if chat_id is None:
+            cur = self._db.execute("DELETE FROM subs WHERE user_id=?", (user_id,))
+        else:
+            cur = self._db.execute("DELETE FROM subs WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+        self._db.commit()
+        return cur.rowcount or 0
+
+    def for_user(self, user_id: int) -> List[Subscription]:
+        rows = self._db.execute("SELECT user_id, chat_id, ident, threshold FROM subs WHERE user_id=?", (user_id,))
+        return [Subscription(*r) for r in rows]
+
+    def for_chat(self, chat_id: int) -> List[Subscription]:
+        rows = self._db.execute("SELECT user_id, chat_id, ident, threshold FROM subs WHERE chat_id=?", (chat_id,))
+        return [Subscription(*r) for r in rows]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class AlbumAssembler:
+    """
+    Turns a stream of incoming messages into LogicalMessages. Telegram delivers an album as
+    several NewMessage events (sometimes several updates apart), so parts are buffered per
+    (chat, grouped_id) until no new part arrived for `settle_s`.
+    """
+    def __init__(self, emit: Callable[[int, LogicalMessage], Awaitable[None]], *, settle_s: float = 1.5):
+        self.emit = emit
+        self.settle_s = settle_s
+        self._parts: Dict[Tuple[int, int], List[RawMessage]] = {}
+        self._timers: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
+
+    def add(self, chat_id: int, raw: RawMessage) -> None:
+        if not raw.grouped_id:
+            for lm in group_into_logical_messages([raw]):
+                self._spawn(chat_id, lm)
+            return
+        key = (chat_id, raw.grouped_id)
+        self._parts.setdefault(key, []).append(raw)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(self.settle_s, self._flush, key)
+
+    def _flush(self, key: Tuple[int, int]) -> None:
+        self._timers.pop(key, None)
+        parts = self._parts.pop(key, [])
+        for lm in group_into_logical_messages(parts):
+            self._spawn(key[0], lm)
+
+    def _spawn(self, chat_id: int, lm: LogicalMessage) -> None:
+        task = asyncio.get_running_loop().create_task(self.emit(chat_id, lm))
+        task.add_done_callback(_log_task_error)
+
+
+def _log_task_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Watch delivery failed", exc_info=task.exception())
+
+
+class WatchService:
+    """
+    Live mode: every new post in a watched chat is scored once per distinct criterion
+    and pushed to each subscriber whose threshold it passes.
+    """
+    def __init__(
+        self, bot, th_client, scorer, store: SubscriptionStore, criteria: CriteriaStore,
+        *, limiter=None, settle_s: float = 1.5, bridge_cache=None,
+    ):
+        self.bot = bot
+        self.th_client = th_client
+        self.scorer = scorer
+        self.store = store
+        self.criteria = criteria
+        self.limiter = limiter
+        self.bridge_cache = bridge_cache
+        self.assembler = AlbumAssembler(self._on_post, settle_s=settle_s)
+        self.posts_scored = 0
+        self.posts_pushed = 0
+
+    async def resolve_chat_id(self, ident: Union[int, str]) -> int:
+        peers = getattr(self.th_client, "peers", None)
+        if peers is not None:
+            return (await peers.resolve(self.th_client.client, ident)).marked_id
+        return await self.th_client.client.get_peer_id(ident)
+
+    async def on_new_message(self, event) -> None:
+        # Telethon NewMessage handler; подписки проверяем до любой работы
+        if not self.store.for_chat(event.chat_id):
+            return
+        self.assembler.add(event.chat_id, to_raw_message(event.message))
+
+    async def _on_post(self, chat_id: int, lm: LogicalMessage) -> None:
+        if not (lm.text and lm.text.strip()):
+            return
+        subs = self.store.for_chat(chat_id)
+        if not subs:
+            return
+        lm.chat = subs[0].ident
+
+        # один вызов LLM на пост и критерий, сколько бы подписчиков его ни ждало
+        by_criterion: Dict[Optional[str], List[Subscription]] = {}
+        for sub in subs:
+            by_criterion.setdefault(self.criterion_for(sub.user_id), []).append(sub)
+
+        for criterion, group in by_criterion.items():
+            sr = await self.scorer.score(lm.text, criterion, key="watch")
+            sr.lm = lm
+            self.posts_scored += 1
+            if sr.unscored:
+                # LLM не ответил: score=0 — не оценка, даже подписчикам с порогом 0 не шлём
+                continue
+            passed = [sub for sub in group if sr.score >= sub.threshold]
+            if passed and not sr.reason:
+                # оценка шла без обоснования; раз пост уходит пользователям — объясняем один раз
+                sr.reason = await self.scorer.explain(lm.text, criterion, key="watch")
+            for sub in passed:
+                await deliver_ranked(
+                    self.bot, self.th_client.client, sub.ident, sub.user_id, [sr],
+                    peers=getattr(self.th_client, "peers", None), limiter=self.limiter,
+                    bridge_cache=self.bridge_cache,
+                )
+                self.posts_pushed += 1
+
+    def criterion_for(self, user_id: int) -> Optional[str]:
+        return self.criteria.latest(user_id)
+
+
+def parse_threshold(token: str) -> Optional[float]:
+    # "0.7", "70", "70%"
+    try:
+        val = float(token.rstrip("%").replace(",", "."))
+    except ValueError:
+        return None
+    if val > 1.0:
+        val /= 100.0
+    return val if 0.0 <= val <= 1.0 else None
@@ -0,0 +1,205 @@
+from __future__ import annotations
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+import asyncio
+import hmac
+import json
+import logging
+import time
+
+from core.metrics import METRICS
+
+log = logging.getLogger("rent-bot")
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1 << 20
+
+_STATUS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+def allowed_updates(app) -> List[str]:
+    """Update types the registered handlers can consume (walks into ConversationHandlers)."""
+    from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler
+
+    kinds: Set[str] = set()
+
+    def _walk(h) -> None:
+        if isinstance(h, ConversationHandler):
+            for sub in [*h.entry_points, *(x for hs in h.states.values() for x in hs), *h.fallbacks]:
+                _walk(sub)
+        elif isinstance(h, CallbackQueryHandler):
+            kinds.add("callback_query")
+        elif isinstance(h, (MessageHandler, CommandHandler)):
+            kinds.add("message")
+
+    for group in app.handlers.values():
+        for h in group:
+            _walk(h)
+    return sorted(kinds)
+
+
+def shard_key(data: Dict[str, Any]) -> int:
+    # апдейты одного чата/пользователя — в одну очередь, чтобы диалоги шли по порядку
+    for v in data.values():
+        if isinstance(v, dict):
+            chat = v.get("chat") or (v.get("message") or {}).get("chat")
+            if isinstance(chat, dict) and "id" in chat:
+                return int(chat["id"])
+            user = v.get("from")
+            if isinstance(user, dict) and "id" in user:
+                return int(user["id"])
+    return int(data.get("update_id", 0))
+
+
+class WebhookServer:
+    """
+    Local HTTP endpoint for Telegram webhooks (TLS is terminated in front of it).
+    Requires the secret token on every request, drops repeated update_ids, and puts updates into `workers`
+    bounded queues sharded by chat, so one chat is processed in order while different
+    chats run in parallel. A full queue answers 503: Telegram backs off and redelivers.
+    process(update_json) does the actual work (PTB: Update.de_json + app.process_update).
+    A keep-alive connection is closed after `idle_timeout_s` without a new request, and a request
+    whose headers/body do not arrive within `read_timeout_s` is dropped.
+    """
+    def __init__(
+        self, process: Callable[[Dict[str, Any]], Awaitable[None]], *, secret_token: str,
+        path: str = "/telegram", workers: int = 8, queue_max: int = 1000, dedup_window: int = 10_000,
+        idle_timeout_s: float = 75.0, read_timeout_s: float = 10.0,
+    ):
+        if not secret_token:
+            raise ValueError("webhook secret token is required")
+        self.process = process
+        self.secret_token = secret_token
+        self.idle_timeout_s = idle_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.path = path
+        self.dedup_window = dedup_window
+        per_queue = max(1, queue_max // max(1, workers))
+        self._queues: List["asyncio.Queue[Tuple[float, Dict[str, Any]]]"] = [
+            asyncio.Queue(per_queue) for _ in range(max(1, workers))
+        ]
+        self._seen: Set[int] = set()
+        self._seen_order: Deque[int] = deque()
+        self._workers: List[asyncio.Task] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def start(self, host: str, port: int) -> None:
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._worker(q)) for q in self._queues]
+        self._server = await asyncio.start_server(self._handle, host, port)
+        log.info("Webhook listening on http://%s:%d%s", host, port, self.path)
+
+    async def close(self, *, drain_s: float = 5.0) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # даём доработать уже принятым апдейтам: Telegram их повторно не пришлёт
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), drain_s)
+        except asyncio.TimeoutError:
+            log.warning("Webhook shutdown: %d updates left unprocessed", self.queued)
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def accept(self, data: Dict[str, Any]) -> int:
+        """Dedup + enqueue; returns the HTTP status to answer with."""
+        uid = data.get("update_id")
+        if not isinstance(uid, int):
+            return 400
+        if uid in self._seen:
+            self.duplicates += 1
+            METRICS.inc("webhook_duplicates")
+            return 200
+        q = self._queues[shard_key(data) % len(self._queues)]
+        try:
+            q.put_nowait((time.perf_counter(), data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            METRICS.inc("webhook_rejected")
+            return 503
+        self._seen.add(uid)
+        self._seen_order.append(uid)
+        if len(self._seen_order) > self.dedup_window:
+            self._seen.discard(self._seen_order.popleft())
+        self.received += 1
+        METRICS.inc("webhook_updates")
+        return 200
+
+    async def _worker(self, q: "asyncio.Queue[Tuple[float, Dict[str, Any]]]") -> None:
+        while True:
+            t_in, data = await q.get()
+            METRICS.observe("webhook_queue_wait", time.perf_counter() - t_in)
+            try:
+                with METRICS.timer("webhook_update"):
+                    await self.process(data)
+            except Exception:
+                log.exception("Webhook update %s failed", data.get("update_id"))
+            finally:
+                q.task_done()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 с keep-alive: Telegram держит соединения и шлёт по ним апдейты подряд
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.idle_timeout_s)
+                if not line:
+                    return
+                parts = line.decode("latin-1").split()
+                headers: Dict[str, str] = {}
+                while True:
+                    h = await asyncio.wait_for(reader.readline(), self.read_timeout_s)
+                    if not h.strip():
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    return
+                body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout_s) if length else b""
+                status = self._route(parts, headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, close=close)
+                if close:
+                    return
+        except asyncio.TimeoutError:
+            METRICS.inc("webhook_timeouts")
+            log.debug("Webhook connection timed out")
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            log.debug("Webhook connection dropped: %s", e)
+        finally:
+            writer.close()
+
+    def _route(self, parts: List[str], headers: Dict[str, str], body: bytes) -> int:
+        if len(parts) < 2 or parts[1].split("?", 1)[0] != self.path:
+            return 404
+        if parts[0] != "POST":
+            return 405
+        # compare_digest на str падает с TypeError на не-ASCII: сравниваем байты
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()):
+            METRICS.inc("webhook_unauthorized")
+            return 401
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        return self.accept(data) if isinstance(data, dict) else 400
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, *, close: bool = False) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {_STATUS.get(status, 'OK')}\r\nContent-Length: 0\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode()
+        )
+        await writer.drain()
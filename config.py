@@ -1,30 +1,153 @@
-import keyring
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+import threading
 
-# Telegram bot token
-BOT_TOKEN = keyring.get_password("rent-bot", "token")
+# Secrets live in keyring. They are read once, all lookups in parallel, on first access to any
+# of them (config.BOT_TOKEN etc. go through the module __getattr__ below) or via load_secrets().
+_SECRET_KEYS = {
+    # Telegram bot token
+    "BOT_TOKEN": ("rent-bot", "token"),
+    # Telethon credentials
+    "API_ID": ("telethon", "id"),
+    "API_HASH": ("telethon", "hash"),
+    "GEMINI_API_KEY": ("gemini", "yuri"),
+    # Bridge channel where Telethon forwards content before the bot copies to user
+    "BRIDGE_CHAT_ID": ("bridge", "id"),
+    "BRIDGE_CHAT_ID_NUMBER": ("bridge", "id-number"),
+    # admins for /stats, comma separated user ids
+    "ADMINS": ("rent-bot", "admins"),
+    # X-Telegram-Bot-Api-Secret-Token for webhook mode
+    "WEBHOOK_SECRET": ("rent-bot", "webhook-secret"),
+}
+_secrets: Optional[Dict[str, Optional[str]]] = None
+_secrets_lock = threading.Lock()
 
-# Telethon credentials
-API_ID = keyring.get_password("telethon", "id")
-API_HASH = keyring.get_password("telethon", "hash")
 
-GEMINI_API_KEY = keyring.get_password("gemini", "yuri")
+def load_secrets() -> Dict[str, Optional[str]]:
+    global _secrets
+    with _secrets_lock:  # at startup secrets and bot module imports are loaded from different threads
+        if _secrets is None:
+            import keyring  # importing keyring probes backends: not at module import time
+            with ThreadPoolExecutor(len(_SECRET_KEYS)) as ex:
+                values = list(ex.map(lambda k: keyring.get_password(*k), _SECRET_KEYS.values()))
+            _secrets = dict(zip(_SECRET_KEYS, values))
+    return _secrets
+
+
+def __getattr__(name: str):
+    if name == "ADMIN_USER_IDS":
+        return {int(x) for x in (load_secrets()["ADMINS"] or "").split(",") if x.strip()}
+    if name in _SECRET_KEYS:
+        return load_secrets()[name]
+    raise AttributeError(f"module 'config' has no attribute {name!r}")
+
 
 TELETHON_SESSION=""
 TELETHON_SESSION_FILE = "user_session.session"
 
-# Bridge channel where Telethon forwards content before the bot copies to user
-BRIDGE_CHAT_ID = keyring.get_password("bridge", "id")
-BRIDGE_CHAT_ID_NUMBER = keyring.get_password("bridge", "id-number")
-
 # How many logical "textful" posts to show in results
 TOP_K = 10
 
-# Read buffer from source before grouping/slicing (larger to ensure enough textful posts)
-FETCH_BUFFER_MIN = 200
-FETCH_BUFFER_MAX = 2000
-FETCH_BUFFER_MULT = 6
+# Named chat sets for multi-chat search: the user may type "#rentals" instead of a list of chats
+CHAT_SETS = {
+    # "rentals": ["@rentals_dn", "-1001234567890"],
+}
+# A FloodWait not longer than this is waited out once per chat; longer ones drop that chat from the search
+FLOODWAIT_MAX_WAIT_S = 30
+
+# History is streamed page by page until enough textful posts are grouped
+HISTORY_PAGE_SIZE = 100
+# Safety cap on raw messages scanned per search (chats that are mostly media/service messages)
+HISTORY_SCAN_MAX = 20000
+# If more than this many messages appeared since the cached high-water mark, the chat cache is rebuilt
+HISTORY_GAP_MAX = 5000
+# Deep reads go in id-range windows of ~one page, several in flight; per Telethon session at most
+# HISTORY_PARALLEL requests at once and HISTORY_RATE_PER_S per second (FloodWait pauses the whole session)
+HISTORY_PARALLEL = 4
+HISTORY_PREFETCH_WINDOWS = 4
+HISTORY_RATE_PER_S = 10.0
+
+# Local copy of chat history: only messages newer than the cached high-water mark are fetched
+MESSAGE_STORE_PATH = "data/messages.sqlite3"
+
+# Chat identifier -> input peer / username cache (warmed from dialogs at startup)
+PEER_CACHE_PATH = "data/peers.sqlite3"
+PEER_CACHE_TTL_S = 7 * 24 * 3600
+
+# (source chat, message id) -> copy already forwarded into the bridge: re-deliveries skip the forward
+BRIDGE_CACHE_PATH = "data/bridge.sqlite3"
+BRIDGE_CACHE_TTL_S = 30 * 24 * 3600
+
+# Progressive delivery: results at or above this score are sent while the rest is still being scored
+# (None: only results whose final place is already certain)
+PROGRESSIVE_THRESHOLD = 0.8
+PROGRESS_EDIT_INTERVAL_S = 2.0
+
+# Search jobs: how many run at once (overall / per user) and how many a user may queue
+JOBS_GLOBAL_LIMIT = 3
+JOBS_PER_USER_LIMIT = 1
+JOBS_PER_USER_QUEUE_MAX = 3
+
+# Live watch mode (/watch): subscriptions and how long to wait for the rest of an album
+WATCH_DB_PATH = "data/watch.sqlite3"
+WATCH_DEFAULT_THRESHOLD = 0.7
+WATCH_ALBUM_SETTLE_S = 1.5
+
+# Bot API pacing for result delivery (per destination chat and global, messages per second)
+BOT_SEND_RATE_PER_CHAT = 4.0
+BOT_SEND_BURST_PER_CHAT = 10
+BOT_SEND_RATE_GLOBAL = 25.0
 
 # Logging
 LOG_LEVEL = "INFO"
+# Share of LLM prompts/responses written to the DEBUG log (prompt bodies are large)
+LLM_LOG_SAMPLE_RATE = 0.05
+
+# Metrics: /stats for admins (ADMIN_USER_IDS, comma separated ids in keyring, see above)
+# and Prometheus text on a local port (0 disables it)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+FILTERS_PATH = "data/filters.json"  # legacy shared file: imported once into CRITERIA_DB_PATH
+CRITERIA_DB_PATH = "data/criteria.sqlite3"
+
+# Near-duplicate (repost) collapsing: SimHash over folded words (unigrams), persistent signature index
+DEDUP_ENABLED = True
+DEDUP_MAX_DISTANCE = 6        # SimHash bits; numbers and district must match exactly
+DEDUP_INDEX_PATH = "data/signatures.sqlite3"
+
+# Local pre-filter before LLM scoring: clear price/bedrooms/district mismatches skip the LLM.
+# "downrank" still delivers them last with score 0, "drop" does not deliver them at all.
+PREFILTER_MODE = "downrank"   # "off" | "downrank" | "drop"
+PREFILTER_PRICE_TOLERANCE = 0.1
+VND_PER_USD = 25_000
+
+# Local shortlist ("K OFFSET M"): scan up to this many posts, LLM-score only the M most similar
+SHORTLIST_MAX_SCAN = 1000
+
+# LLM score cache: in-memory LRU in front of an SQLite file
+SCORE_CACHE_PATH = "data/score_cache.sqlite3"
+SCORE_CACHE_MEM_SIZE = 4096
+SCORE_CACHE_TTL_S = 7 * 24 * 3600
+SCORE_CACHE_MAX_ROWS = 200_000
+
+# Score-first LLM: the first pass returns only a score via a JSON schema with a small output limit
+# (2.5-flash counts "thinking" against that limit, so scoring uses flash-lite without it);
+# reasons come from a separate call for the first N delivered items or the "Почему?" button
+LLM_SCORE_MODEL = "gemini-2.5-flash-lite"
+LLM_REASON_MODEL = "gemini-2.5-flash"
+LLM_SCORE_MAX_OUTPUT_TOKENS = 64          # per listing; multiplied by the batch size for batches
+LLM_REASON_MAX_OUTPUT_TOKENS = 2048
+LLM_REASONS_TOP_N = 5
+WHY_BUTTONS_MAX = 5000                    # how many recent "Почему?" buttons are remembered (in memory)
 
-FILTERS_PATH = "data/filters.json"
+# Ingress: "polling" (getUpdates) or "webhook" (local HTTP server behind a TLS proxy at WEBHOOK_URL).
+# Both subscribe only to the update types the registered handlers consume.
+INGRESS_MODE = "polling"
+WEBHOOK_URL = ""                    # public https address proxied to WEBHOOK_HOST:WEBHOOK_PORT
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8081
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_WORKERS = 8                 # parallel queues (updates of one chat always go to the same one)
+WEBHOOK_QUEUE_MAX = 1000            # beyond this we answer 503 and Telegram retries later
+WEBHOOK_MAX_CONNECTIONS = 40
@@ -0,0 +1,161 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import hashlib
+import sqlite3
+import time
+
+from core.models import LogicalMessage
+from core.text import words
+from core.prefilter import extract_districts
+
+BITS = 64
+MIN_WORDS = 8              # короткие тексты ("Сдано!") не сравниваем — слишком много ложных совпадений
+
+# (simhash по словам, хеш "фактов"). Факты — числа (цена, спальни, площадь) и район — должны совпасть
+# точно: иначе шаблонные объявления одного агентства про разные квартиры склеились бы.
+Signature = Tuple[int, int]
+
+
+def _h64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def signature(text: str) -> Optional[Signature]:
+    """SimHash over the folded words plus a hash of numbers and districts; None for texts too short to compare."""
+    toks = words(text)
+    if len(toks) < MIN_WORDS:
+        return None
+    nums = sorted(t for t in toks if t.isdigit())
+    counts = [0] * BITS
+    for t in toks:
+        if t.isdigit():
+            continue
+        h = _h64(t)
+        for bit in range(BITS):
+            counts[bit] += 1 if (h >> bit) & 1 else -1
+    sig = 0
+    for bit, c in enumerate(counts):
+        if c > 0:
+            sig |= 1 << bit
+    facts = nums + sorted(extract_districts(text))
+    return sig, _h64(" ".join(facts))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _signed(v: int) -> int:
+    # SQLite INTEGER — знаковый 64-бит
+    return v - (1 << 64) if v >= 1 << 63 else v
+
+
+def _unsigned(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
+
+
+class SignatureIndex:
+    """
+    Persistent index of already seen posts: (chat, msg_id) -> signature.
+    Candidates are looked up by the indexed facts hash, SimHash is compared in Python.
+    """
+    def __init__(self, path: Path, *, ttl_s: float = 30 * 24 * 3600):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_s = ttl_s
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sigs ("
+            " chat TEXT NOT NULL, msg_id INTEGER NOT NULL, sig INTEGER NOT NULL, nums INTEGER NOT NULL,"
+            " ts REAL NOT NULL, PRIMARY KEY (chat, msg_id)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sigs_nums ON sigs(nums)")
+        self._db.execute("DELETE FROM sigs WHERE ts < ?", (time.time() - ttl_s,))
+        self._db.commit()
+
+    def near(self, sig: Signature, max_distance: int) -> List[Tuple[str, int]]:
+        rows = self._db.execute("SELECT chat, msg_id, sig FROM sigs WHERE nums=?", (_signed(sig[1]),)).fetchall()
+        return [(r[0], r[1]) for r in rows if hamming(sig[0], _unsigned(r[2])) <= max_distance]
+
+    def add_many(self, items: List[Tuple[str, int, Signature]]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO sigs (chat, msg_id, sig, nums, ts) VALUES (?, ?, ?, ?, ?)",
+            [(chat, msg_id, _signed(sig[0]), _signed(sig[1]), now) for chat, msg_id, sig in items],
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def collapse_near_duplicates(
+    messages: List[LogicalMessage],
+    *,
+    chat: Optional[Union[int, str]] = None,
+    index: Optional[SignatureIndex] = None,
+    max_distance: int = 6,
+) -> List[LogicalMessage]:
+    """
+    Collapses near-duplicate textful posts (old->new input per chat) to one copy and sets
+    `reposts` to the number of other copies seen: in this batch and, with an index, in earlier
+    searches of any chat. Posts without text or too short to compare pass through untouched.
+    The source chat is lm.chat when set, otherwise `chat`. Message ids only order posts within
+    one chat, so the kept copy is the newest one in the first chat (in input order) that has a copy.
+    """
+    def _chat_key(lm: LogicalMessage) -> str:
+        return str(lm.chat if lm.chat is not None else chat).strip().lower()
+
+    sigs: List[Optional[Signature]] = [signature(lm.text) if lm.text else None for lm in messages]
+
+    # union-find внутри пачки; кандидаты — посты с теми же фактами
+    parent = list(range(len(messages)))
+
+    def _root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets: Dict[int, List[int]] = {}
+    for i, sig in enumerate(sigs):
+        if sig is None:
+            continue
+        bucket = buckets.setdefault(sig[1], [])
+        for j in bucket:
+            if hamming(sig[0], sigs[j][0]) <= max_distance:
+                parent[_root(i)] = _root(j)
+        bucket.append(i)
+
+    clusters: Dict[int, List[int]] = {}
+    for i, sig in enumerate(sigs):
+        if sig is not None:
+            clusters.setdefault(_root(i), []).append(i)
+
+    def _msg_id(lm: LogicalMessage) -> int:
+        return lm.caption_src_id or lm.ids[0]
+
+    # id сообщений нумеруются в каждом чате свои: между чатами сравнивать их нельзя, порядок чатов фиксирован
+    chat_order: Dict[str, int] = {}
+    for lm in messages:
+        chat_order.setdefault(_chat_key(lm), len(chat_order))
+
+    drop = set()
+    for members in clusters.values():
+        rep = min(members, key=lambda i: (chat_order[_chat_key(messages[i])], -messages[i].ids[0]))
+        own = {(_chat_key(messages[i]), _msg_id(messages[i])) for i in members}
+        seen_elsewhere = set()
+        if index is not None:
+            for i in members:
+                seen_elsewhere.update(k for k in index.near(sigs[i], max_distance) if k not in own)
+        messages[rep].reposts = len(members) - 1 + len(seen_elsewhere)
+        drop.update(i for i in members if i != rep)
+
+    if index is not None:
+        index.add_many([
+            (_chat_key(messages[i]), _msg_id(messages[i]), sigs[i]) for i in range(len(messages)) if sigs[i] is not None
+        ])
+
+    return [lm for i, lm in enumerate(messages) if i not in drop]
@@ -0,0 +1,252 @@
+from __future__ import annotations
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, TypeVar, TYPE_CHECKING
+import asyncio
+import logging
+import time
+
+from core.metrics import METRICS
+
+if TYPE_CHECKING:
+    from core.llm import LLMPolicy
+
+log = logging.getLogger("rent-bot")
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_s
+        self.burst = burst
+        self._clock = clock
+        self.tokens = float(burst)
+        self._ts = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def try_take(self, n: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n: float = 1.0) -> float:
+        self._refill()
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        # уводим бакет в минус: следующий токен появится не раньше чем через seconds;
+        # одновременные паузы не складываются, а сливаются в самую длинную
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    async def acquire(self, n: float = 1.0) -> None:
+        while not self.try_take(n):
+            await asyncio.sleep(self.wait_time(n))
+
+
+def is_throttle_error(exc: BaseException) -> bool:
+    # google.api_core.exceptions.ResourceExhausted / TooManyRequests и т.п. без импорта google в core
+    name = type(exc).__name__
+    if name in ("ResourceExhausted", "TooManyRequests", "RateLimitError"):
+        return True
+    text = str(exc).lower()
+    return "429" in text or "quota" in text or "rate limit" in text
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    # таймауты, 429 и 5xx/сетевые ошибки; ValueError (заблокированный/пустой ответ) и 4xx — нет
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)) or is_throttle_error(exc):
+        return True
+    name = type(exc).__name__
+    if name in ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout", "ServerError"):
+        return True
+    text = str(exc)
+    return any(code in text for code in ("500", "502", "503", "504"))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed calls and fails fast for `cooldown_s`;
+    after that calls go through again, and the first failure re-opens it.
+    """
+    def __init__(self, failures: int = 5, cooldown_s: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failures = failures
+        self.cooldown_s = cooldown_s
+        self._clock = clock
+        self.consecutive = 0
+        self.open_until = 0.0
+        self.opened = 0
+        self._open_event: Optional[asyncio.Event] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._clock() < self.open_until
+
+    async def wait_open(self) -> None:
+        """Returns when the breaker opens (used to drop calls still waiting in the dispatcher queue)."""
+        if self._open_event is None:
+            self._open_event = asyncio.Event()
+        if not self.is_open:
+            self._open_event.clear()
+        await self._open_event.wait()
+
+    def check(self) -> None:
+        if self.is_open:
+            raise CircuitOpenError(f"LLM circuit open for {self.open_until - self._clock():.0f}s more")
+
+    def success(self) -> None:
+        self.consecutive = 0
+
+    def failure(self) -> None:
+        self.consecutive += 1
+        if self.consecutive >= self.failures and not self.is_open:
+            self.open_until = self._clock() + self.cooldown_s
+            self.opened += 1
+            if self._open_event is not None:
+                self._open_event.set()
+            log.warning("LLM circuit breaker open for %.0fs after %d failures", self.cooldown_s, self.consecutive)
+
+
+class LLMDispatcher:
+    """
+    Process-wide gate for LLM calls:
+      - token bucket (policy.rate_per_s / policy.burst) limits request rate;
+      - adaptive in-flight window (AIMD) between policy.min_in_flight and policy.max_in_flight:
+        +1 per window of fast successes, *policy.aimd_decrease on errors or slow answers;
+      - waiters are queued per key (user id) and served round-robin, so one big search
+        does not starve a small one.
+    """
+    def __init__(self, policy: "LLMPolicy"):
+        self.policy = policy
+        self.bucket = TokenBucket(policy.rate_per_s, policy.burst)
+        self.limit = float(policy.initial_in_flight)
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
+        self.throttled = 0
+        self._queues: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self._rr: Deque[Hashable] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_decrease = 0.0
+
+    @property
+    def window(self) -> int:
+        return max(self.policy.min_in_flight, int(self.limit))
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for q in self._queues.values() for f in q if not f.done())
+
+    async def run(self, fn: Callable[[], Awaitable[T]], *, key: Hashable = None) -> T:
+        with METRICS.timer("llm_queue_wait"):
+            await self._acquire(key)
+        t0 = time.monotonic()
+        try:
+            res = await fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._on_error(e)
+            raise
+        else:
+            self._on_success(time.monotonic() - t0)
+            return res
+        finally:
+            self._release()
+
+    async def _acquire(self, key: Hashable) -> None:
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = deque()
+            self._rr.append(key)
+        q.append(fut)
+        self._pump()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже выдан, но нас отменили — возвращаем
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._pump()
+
+    def _pump(self) -> None:
+        while self._rr and self.in_flight < self.window:
+            key = self._rr[0]
+            q = self._queues[key]
+            while q and q[0].done():  # отменённые ожидания
+                q.popleft()
+            if not q:
+                self._rr.popleft()
+                del self._queues[key]
+                continue
+            if not self.bucket.try_take():
+                self._schedule(self.bucket.wait_time())
+                return
+            fut = q.popleft()
+            self._rr.rotate(-1)
+            if not q:
+                self._rr.pop()
+                del self._queues[key]
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+
+        def _fire() -> None:
+            self._timer = None
+            self._pump()
+
+        self._timer = loop.call_later(max(delay, 0.001), _fire)
+
+    def _on_success(self, latency: float) -> None:
+        self.completed += 1
+        if latency > self.policy.latency_target_s:
+            self._decrease("latency %.1fs" % latency)
+            return
+        self.limit = min(float(self.policy.max_in_flight), self.limit + self.policy.aimd_increase / max(self.limit, 1.0))
+
+    def _on_error(self, exc: BaseException) -> None:
+        self.errors += 1
+        if is_throttle_error(exc):
+            self.throttled += 1
+            self.bucket.pause(self.policy.throttle_pause_s)
+        self._decrease(type(exc).__name__)
+
+    def _decrease(self, why: str) -> None:
+        now = time.monotonic()
+        # не режем окно чаще, чем раз в cooldown: ошибки одной волны приходят пачкой
+        if now - self._last_decrease < self.policy.decrease_cooldown_s:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.policy.min_in_flight), self.limit * self.policy.aimd_decrease)
+        log.info("LLM dispatcher: window -> %d (%s)", self.window, why)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "window": self.window,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "errors": self.errors,
+            "throttled": self.throttled,
+        }
@@ -2,8 +2,16 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 import json
+import logging
+import sqlite3
+import threading
 from datetime import datetime, timezone
 
+log = logging.getLogger("rent-bot")
+
+# владелец критериев из старого общего filters.json (до появления хранилища по пользователям)
+LEGACY_USER_ID = 0
+
 def ensure_parent(path: Path) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -17,20 +25,75 @@ def read_filters(path: Path) -> List[Dict[str, Any]]:
     except Exception:
         return []
 
-def append_criterion(path: Path, criterion: str) -> None:
-    ensure_parent(path)
-    data = read_filters(path)
-    data.append({
-        "criterion": criterion,
-        "ts": datetime.now(timezone.utc).isoformat()
-    })
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def read_latest_criterion(path: Path) -> Optional[str]:
-    data = read_filters(path)
-    if not data:
-        return None
-    last = data[-1]
-    crit = last.get("criterion")
-    return crit if isinstance(crit, str) and crit.strip() else None
\ No newline at end of file
+
+class CriteriaStore:
+    """
+    Saved search criteria per user in SQLite: append-only history, the newest row per user
+    is the active one (indexed lookup, memoized until that user saves again).
+    Users without a criterion of their own fall back to the legacy global one.
+    """
+    def __init__(self, path: Path, *, legacy_json: Optional[Path] = None):
+        ensure_parent(path)
+        self._lock = threading.Lock()
+        self._latest: Dict[int, Optional[str]] = {}
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS criteria ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,"
+            " criterion TEXT NOT NULL, ts TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS criteria_user ON criteria(user_id, id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        if legacy_json is not None:
+            self._migrate(legacy_json)
+
+    def _migrate(self, path: Path) -> None:
+        # одноразово: старый общий JSON становится историей LEGACY_USER_ID
+        if self._db.execute("SELECT 1 FROM meta WHERE key='migrated_json'").fetchone():
+            return
+        rows = []
+        for entry in read_filters(path):
+            crit = entry.get("criterion") if isinstance(entry, dict) else None
+            if isinstance(crit, str) and crit.strip():
+                rows.append((LEGACY_USER_ID, crit, str(entry.get("ts") or "")))
+        with self._db:
+            self._db.executemany("INSERT INTO criteria (user_id, criterion, ts) VALUES (?, ?, ?)", rows)
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (str(path),))
+        if rows:
+            log.info("Migrated %d criteria from %s", len(rows), path)
+
+    def append(self, user_id: int, criterion: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO criteria (user_id, criterion, ts) VALUES (?, ?, ?)",
+                (user_id, criterion, datetime.now(timezone.utc).isoformat()),
+            )
+            self._db.commit()
+            self._latest.pop(user_id, None)
+
+    def latest(self, user_id: int) -> Optional[str]:
+        crit = self._own(user_id)
+        if crit is None and user_id != LEGACY_USER_ID:
+            crit = self._own(LEGACY_USER_ID)
+        return crit
+
+    def history(self, user_id: int, limit: int = 10) -> List[str]:
+        rows = self._db.execute(
+            "SELECT criterion FROM criteria WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit)
+        )
+        return [r[0] for r in rows]
+
+    def _own(self, user_id: int) -> Optional[str]:
+        if user_id in self._latest:
+            return self._latest[user_id]
+        with self._lock:
+            row = self._db.execute(
+                "SELECT criterion FROM criteria WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,)
+            ).fetchone()
+            crit = row[0] if row and row[0].strip() else None
+            self._latest[user_id] = crit
+        return crit
+
+    def close(self) -> None:
+        self._db.close()
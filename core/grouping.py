@@ -1,64 +1,171 @@
 from __future__ import annotations
-from typing import List, Dict
+from itertools import islice
+import operator
+from typing import AsyncIterable, AsyncIterator, List, Dict, Optional, Sequence, Tuple
 from .models import RawMessage, LogicalMessage
+from .metrics import METRICS
+
+def _album(gid: int, chunk_sorted: List[RawMessage]) -> LogicalMessage:
+    caption_item = next((c for c in chunk_sorted if c.text and c.text.strip()), None)
+    caption_text = caption_item.text if caption_item else None
+    caption_src_id = caption_item.id if caption_item else None
+    has_media = any(c.has_media for c in chunk_sorted)
+    return LogicalMessage(
+        ids=[c.id for c in chunk_sorted],
+        text=caption_text,
+        grouped_id=gid,
+        caption_src_id=caption_src_id,
+        has_media=has_media
+    )
+
+def _single(r: RawMessage) -> LogicalMessage:
+    caption_text = r.text if r.text and r.text.strip() else None
+    return LogicalMessage(
+        ids=[r.id],
+        text=caption_text,
+        grouped_id=None,
+        caption_src_id=r.id if caption_text else None,
+        has_media=r.has_media
+    )
 
 def group_into_logical_messages(raws: List[RawMessage]) -> List[LogicalMessage]:
+    """All logical posts old->new. Input in any order; new->old (as Telethon returns it) is not sorted."""
     if not raws:
         return []
-    by_group: Dict[int, List[RawMessage]] = {}
-    singles: List[RawMessage] = []
-    for r in raws:
-        if r.grouped_id:
-            by_group.setdefault(r.grouped_id, []).append(r)
-        else:
-            singles.append(r)
-
-    logical: List[LogicalMessage] = []
-
-    # albums
-    for gid, chunk in by_group.items():
-        chunk_sorted = sorted(chunk, key=lambda x: x.id)
-        caption_item = next((c for c in chunk_sorted if c.text and c.text.strip()), None)
-        caption_text = caption_item.text if caption_item else None
-        caption_src_id = caption_item.id if caption_item else None
-        has_media = any(c.has_media for c in chunk_sorted)
-        logical.append(LogicalMessage(
-            ids=[c.id for c in chunk_sorted],
-            text=caption_text,
-            grouped_id=gid,
-            caption_src_id=caption_src_id,
-            has_media=has_media
-        ))
-
-    # singles
-    for r in singles:
-        caption_text = r.text if r.text and r.text.strip() else None
-        logical.append(LogicalMessage(
-            ids=[r.id],
-            text=caption_text,
-            grouped_id=None,
-            caption_src_id=r.id if caption_text else None,
-            has_media=r.has_media
-        ))
-
-    logical.sort(key=lambda lm: lm.ids[0])  # old -> new
-    return logical
+    with METRICS.timer("grouping"):
+        return _group_desc(_as_desc_columns(raws))
 
 def slice_logical_by_offset_limit_textful(items: List[LogicalMessage], *, limit: int, offset: int) -> List[LogicalMessage]:
     if limit <= 0 or not items:
         return []
-    # items are old->new; work in new->old order to interpret offset from the end
-    desc = list(reversed(items))
+    with METRICS.timer("slicing"):
+        return _slice(items, limit, offset)
+
+def _slice(items: List[LogicalMessage], limit: int, offset: int) -> List[LogicalMessage]:
+    # items are old->new; walk new->old (без копии списка) to interpret offset from the end
     picked_desc: List[LogicalMessage] = []
     skipped_textful = 0
     taken_textful = 0
 
-    for lm in desc:
+    for lm in reversed(items):
         has_text = bool(lm.text and lm.text.strip())
         if has_text and skipped_textful < offset:
             skipped_textful += 1
             continue
-        if has_text and taken_textful >= limit:
+        picked_desc.append(lm)
+        if has_text:
+            taken_textful += 1
+        if taken_textful >= limit:
+            break
+
+    picked_desc.reverse()
+    return picked_desc
+
+_Columns = Tuple[Sequence[int], Sequence[int], Sequence[Optional[str]], Sequence[int]]
+
+def _as_desc_columns(raws: List[RawMessage]) -> _Columns:
+    # колонки — обычные списки (индексация без упаковки int)
+    cols: _Columns = ([r.id for r in raws], [r.grouped_id or 0 for r in raws], [r.text for r in raws], [r.has_media for r in raws])
+    ids = cols[0]
+    if all(map(operator.gt, ids, islice(ids, 1, None))):
+        return cols
+    # не new->old (например, части альбома в порядке прихода) — один раз сортируем вход
+    order = sorted(range(len(ids)), key=ids.__getitem__, reverse=True)
+    return tuple([col[i] for i in order] for col in cols)  # type: ignore[return-value]
+
+def _group_desc(cols: _Columns) -> List[LogicalMessage]:
+    """
+    Single pass over strictly new->old columns (id, grouped id or 0, text, has media). A post's place in the result is its oldest
+    message, so an album's entry moves down every time an older part of it shows up
+    (the old entry becomes a hole) — for contiguous albums that never happens.
+    Entries: >= 0 — index of a single message, < 0 — ~album number.
+    """
+    ids, gids, texts, media = cols
+    entries: List[Optional[int]] = []
+    append = entries.append
+    album_of: Dict[int, int] = {}
+    parts: List[List[int]] = []     # индексы сообщений альбома, new->old
+    entry_pos: List[int] = []
+
+    for i, gid in enumerate(gids):
+        if not gid:
+            append(i)
+            continue
+        a = album_of.get(gid)
+        if a is None:
+            album_of[gid] = a = len(parts)
+            parts.append([i])
+            entry_pos.append(len(entries))
+            append(~a)
+            continue
+        parts[a].append(i)
+        if entry_pos[a] != len(entries) - 1:
+            entries[entry_pos[a]] = None
+            entry_pos[a] = len(entries)
+            append(~a)
+
+    picked_desc: List[LogicalMessage] = []
+    pick = picked_desc.append
+    for e in entries:
+        if e is None:
+            continue
+        if e >= 0:
+            t = texts[e]
+            caption = t if t and t.strip() else None
+            mid = ids[e]
+            pick(LogicalMessage([mid], caption, None, mid if caption else None, bool(media[e])))
+        else:
+            idx = parts[~e]
+            idx.reverse()
+            cap_idx = next((j for j in idx if texts[j] and texts[j].strip()), -1)
+            caption = texts[cap_idx] if cap_idx >= 0 else None
+            pick(LogicalMessage(
+                [ids[j] for j in idx], caption, gids[idx[0]],
+                ids[cap_idx] if caption else None, any(media[j] for j in idx),
+            ))
+
+    picked_desc.reverse()
+    return picked_desc
+
+# ---------- streaming (history comes new -> old) ----------
+
+async def stream_logical_messages(raws: AsyncIterable[RawMessage]) -> AsyncIterator[LogicalMessage]:
+    """
+    Incremental grouper over a new->old stream: singles are yielded at once,
+    an album as soon as the next message does not belong to it.
+    Yields logical posts new->old.
+    """
+    gid: Optional[int] = None
+    chunk: List[RawMessage] = []
+    async for r in raws:
+        if r.grouped_id and r.grouped_id == gid:
+            chunk.append(r)
+            continue
+        if chunk:
+            yield _album(gid, chunk[::-1])
+            gid, chunk = None, []
+        if r.grouped_id:
+            gid, chunk = r.grouped_id, [r]
+        else:
+            yield _single(r)
+    if chunk:
+        yield _album(gid, chunk[::-1])
+
+async def take_textful(logical_desc: AsyncIterable[LogicalMessage], *, limit: int, offset: int) -> List[LogicalMessage]:
+    """
+    Streaming counterpart of slice_logical_by_offset_limit_textful: consumes new->old logical posts
+    only until `limit` textful posts after `offset` are taken. Returns old->new.
+    """
+    picked_desc: List[LogicalMessage] = []
+    if limit <= 0:
+        return picked_desc
+    skipped_textful = 0
+    taken_textful = 0
+
+    async for lm in logical_desc:
+        has_text = bool(lm.text and lm.text.strip())
+        if has_text and skipped_textful < offset:
+            skipped_textful += 1
             continue
         picked_desc.append(lm)
         if has_text:
@@ -16,12 +16,16 @@ def _build_tme_c_link_from_numeric(chat_id: int, msg_id: int) -> str:
     internal = abs_id[3:] if abs_id.startswith("100") else abs_id
     return f"https://t.me/c/{internal}/{msg_id}"
 
-async def build_origin_link(tele_client, from_chat_identifier: Union[int, str], original_msg_id: int) -> Optional[str]:
+async def build_origin_link(tele_client, from_chat_identifier: Union[int, str], original_msg_id: int, peers=None) -> Optional[str]:
+    """peers: optional PeerCache — username is taken from it instead of a get_entity call."""
     if isinstance(from_chat_identifier, str) and from_chat_identifier.startswith("@"):
         uname = from_chat_identifier[1:]
         return f"https://t.me/{uname}/{original_msg_id}"
 
-    uname = await _resolve_username_with_telethon(tele_client, from_chat_identifier)
+    if peers is not None:
+        uname = await peers.username(tele_client, from_chat_identifier)
+    else:
+        uname = await _resolve_username_with_telethon(tele_client, from_chat_identifier)
     if uname:
         return f"https://t.me/{uname}/{original_msg_id}"
 
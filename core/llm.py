@@ -1,51 +1,394 @@
 from __future__ import annotations
-from typing import Callable, Any, Optional, List
+from typing import Awaitable, Callable, Any, AsyncIterator, Optional, List, Hashable, Dict, Tuple
 from dataclasses import dataclass
 import json
 import asyncio
+import logging
+import random
 
 from core.models import LogicalMessage, ScoreResult
+from core.score_cache import ScoreCache
+from core.metrics import METRICS, Histogram
+from core.normalize import fit_search_budget, prepare_listing
+from core.dispatcher import CircuitBreaker, CircuitOpenError, LLMDispatcher, is_retryable_error
+
+log = logging.getLogger("rent-bot")
 
 @dataclass
 class LLMPolicy:
-    # reserved for future knobs (timeouts, retries, etc.)
-    pass
+    # rate limit (token bucket), общий на процесс
+    rate_per_s: float = 4.0
+    burst: int = 8
+    # adaptive in-flight window (AIMD)
+    initial_in_flight: int = 4
+    min_in_flight: int = 1
+    max_in_flight: int = 16
+    aimd_increase: float = 1.0          # +1 к окну за "окно" успешных ответов
+    aimd_decrease: float = 0.5          # окно *= 0.5 при ошибке или медленном ответе
+    latency_target_s: float = 15.0      # ответ дольше — считаем перегрузкой
+    decrease_cooldown_s: float = 2.0
+    throttle_pause_s: float = 5.0       # пауза бакета после 429/quota
+    # сколько объявлений упаковывать в один запрос (score_many); <=1 — по одному
+    batch_size: int = 10
+    # дедлайны: на один вызов модели и на всю оценку поиска (None — без общего дедлайна)
+    call_timeout_s: float = 60.0
+    search_deadline_s: Optional[float] = 300.0
+    # повторы на таймаутах/429/5xx: пауза uniform(0, min(retry_max_s, retry_base_s * 2**n))
+    max_retries: int = 2
+    retry_base_s: float = 1.0
+    retry_max_s: float = 10.0
+    # hedging: дублирующий запрос, если ответа нет дольше p95 (но не раньше hedge_min_delay_s)
+    hedge: bool = False
+    hedge_min_delay_s: float = 5.0
+    # circuit breaker: после N неудач подряд — сразу "без оценки" в течение cooldown
+    breaker_failures: int = 5
+    breaker_cooldown_s: float = 30.0
+    # токен-бюджеты промпта (оценка core.normalize.estimate_tokens): на объявление и на весь поиск;
+    # при нехватке объявление ужимается, но не ниже listing_min_tokens
+    listing_max_tokens: int = 400
+    search_max_tokens: Optional[int] = 60_000
+    listing_min_tokens: int = 80
 
 class LLMScorer:
     """
     send_fn: async (text:str, criterion:Optional[str]) -> Union[str, dict, number-like]
       Допускаем, что модель может вернуть просто число (строкой или числом) 0..100.
-      Также поддерживаем JSON {"score": 0..1|0..100, "reason": "..."}.
+      Также поддерживаем JSON {"score": 0..1|0..100, "reason": "..."} (reason необязателен).
+    batch_send_fn: async (items: List[(id:str, text:str)], criterion) -> str | list
+      Ответ — JSON-массив [{"id": ..., "score": ...}, ...] по одному на объявление (reason — по желанию).
+    reason_fn: async (text, criterion) -> str — короткое обоснование оценки; зовётся лениво
+      (explain), только для того, что пользователь действительно увидит.
+    cache: optional ScoreCache; успешно разобранные ответы кешируются по (текст, критерий).
+    Тексты перед оценкой нормализуются и укладываются в токен-бюджеты policy (core.normalize);
+    ключ кеша — нормализованный текст, так что косметические варианты объявления делят запись.
+    Все вызовы send_fn идут через один LLMDispatcher (rate limit + AIMD + очередь по key),
+    с дедлайном, повторами, hedging и circuit breaker из policy. Если оценку получить
+    не удалось, результат помечается unscored (а не 0).
     """
-    def __init__(self, send_fn: Callable[[str, Optional[str]], Any], policy: Optional[LLMPolicy] = None):
+    def __init__(
+        self,
+        send_fn: Callable[[str, Optional[str]], Any],
+        policy: Optional[LLMPolicy] = None,
+        cache: Optional[ScoreCache] = None,
+        batch_send_fn: Optional[Callable[[List[Tuple[str, str]], Optional[str]], Any]] = None,
+        reason_fn: Optional[Callable[[str, Optional[str]], Awaitable[Any]]] = None,
+    ):
         self.send_fn = send_fn
+        self.batch_send_fn = batch_send_fn
+        self.reason_fn = reason_fn
         self.policy = policy or LLMPolicy()
+        self.cache = cache
+        self.dispatcher = LLMDispatcher(self.policy)
+        self.breaker = CircuitBreaker(self.policy.breaker_failures, self.policy.breaker_cooldown_s)
+        self._latency = Histogram(window=512)
 
-    async def score(self, text: str, criterion: Optional[str]) -> ScoreResult:
-        body = await self.send_fn(text or "", criterion)
-        # try raw number first
-        raw_score = None
-        reason = None
-        if isinstance(body, (int, float)):
-            raw_score = float(body)
-        elif isinstance(body, str):
-            # может быть просто число или JSON
-            s = body.strip()
+    async def score_many(self, texts: List[str], criterion: Optional[str], *, key: Hashable = None) -> List[ScoreResult]:
+        """
+        Scores texts in batches of policy.batch_size (one LLM request per batch).
+        Entries the model dropped or mangled are re-sent in halves; a batch of one
+        falls back to score().
+        """
+        results: List[Optional[ScoreResult]] = [None] * len(texts)
+        async for i, sr in self.iter_score_many(texts, criterion, key=key):
+            results[i] = sr
+        return results  # type: ignore[return-value]
+
+    async def iter_score_many(
+        self, texts: List[str], criterion: Optional[str], *, key: Hashable = None
+    ) -> AsyncIterator[Tuple[int, ScoreResult]]:
+        """Same as score_many, but yields (index, result) as soon as each result is known."""
+        p = self.policy
+        texts = [prepare_listing(t, p.listing_max_tokens) for t in texts]
+        pending: List[int] = []
+        for i, t in enumerate(texts):
+            hit = self.cache.get(t, criterion) if self.cache is not None else None
+            if hit is not None:
+                METRICS.inc("llm_cache_hits")
+                yield i, ScoreResult(lm=None, score=hit[0], reason=hit[1])
+            else:
+                pending.append(i)
+        if not pending:
+            return
+        # бюджет поиска — только на то, что реально уйдёт в модель; в кеш кладём по texts
+        prompts = dict(zip(pending, fit_search_budget([texts[i] for i in pending], p.search_max_tokens, p.listing_min_tokens)))
+
+        size = max(1, self.policy.batch_size)
+        if self.batch_send_fn is None or size == 1:
+            chunks = [[i] for i in pending]
+        else:
+            chunks = [pending[j:j + size] for j in range(0, len(pending), size)]
+
+        done: "asyncio.Queue[Any]" = asyncio.Queue()
+
+        async def _run(idxs: List[int]) -> None:
+            if len(idxs) == 1:
+                i = idxs[0]
+                done.put_nowait((i, await self._score_uncached(prompts[i], criterion, key, cache_text=texts[i])))
+                return
+            items = [(str(i), prompts[i]) for i in idxs]
             try:
-                raw_score = float(s)
-            except Exception:
+                body = await self._call(lambda: self.batch_send_fn(items, criterion), key, len(items))
+            except Exception as e:
+                log.warning("LLM batch of %d failed, left unscored: %r", len(idxs), e)
+                METRICS.inc("llm_unscored", len(idxs))
+                for i in idxs:
+                    done.put_nowait((i, _unscored()))
+                return
+            parsed = _parse_batch_body(body)
+            missing: List[int] = []
+            for i in idxs:
+                got = parsed.get(str(i))
+                if got is None:
+                    missing.append(i)
+                    continue
+                score01 = _normalize_score_to_01(got[0])
+                if self.cache is not None:
+                    self.cache.put(texts[i], criterion, score01, got[1])
+                done.put_nowait((i, ScoreResult(lm=None, score=score01, reason=got[1])))
+            if missing:
+                METRICS.inc("llm_split_retries")
+                half = (len(missing) + 1) // 2
+                await asyncio.gather(*(_run(part) for part in (missing[:half], missing[half:]) if part))
+
+        async def _guarded(idxs: List[int]) -> None:
+            try:
+                await _run(idxs)
+            except Exception as e:
+                done.put_nowait(e)
+
+        tasks = [asyncio.create_task(_guarded(c)) for c in chunks]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.policy.search_deadline_s if self.policy.search_deadline_s else None
+        left = set(pending)
+        try:
+            while left:
                 try:
-                    data = json.loads(s)
-                    raw_score, reason = _extract_score_reason(data)
-                except Exception:
-                    raw_score = 0.0
-        elif isinstance(body, dict):
-            raw_score, reason = _extract_score_reason(body)
-        else:
-            raw_score = 0.0
+                    item = await asyncio.wait_for(done.get(), None if deadline is None else max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    # общий дедлайн поиска: что не успели — без оценки, зависшие вызовы снимаем
+                    log.warning("LLM search deadline hit, %d items left unscored", len(left))
+                    METRICS.inc("llm_deadline_hits")
+                    METRICS.inc("llm_unscored", len(left))
+                    for i in sorted(left):
+                        yield i, _unscored()
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                left.discard(item[0])
+                yield item
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def score(self, text: str, criterion: Optional[str], *, key: Hashable = None) -> ScoreResult:
+        text = prepare_listing(text, self.policy.listing_max_tokens)
+        if self.cache is not None:
+            hit = self.cache.get(text, criterion)
+            if hit is not None:
+                METRICS.inc("llm_cache_hits")
+                return ScoreResult(lm=None, score=hit[0], reason=hit[1])
+        return await self._score_uncached(text, criterion, key)
+
+    async def explain(self, text: str, criterion: Optional[str], *, key: Hashable = None) -> Optional[str]:
+        """
+        Reason for an already scored listing: from the cache if known, otherwise one
+        reason_fn call (stored next to the score). None if there is no reason_fn or it failed.
+        """
+        text = prepare_listing(text, self.policy.listing_max_tokens)
+        hit = self.cache.get(text, criterion) if self.cache is not None else None
+        if hit is not None and hit[1]:
+            return hit[1]
+        if self.reason_fn is None:
+            return None
+        try:
+            body = await self._call(lambda: self.reason_fn(text, criterion), key, 1)
+        except Exception as e:
+            log.warning("LLM reason call failed: %r", e)
+            return None
+        METRICS.inc("llm_reasons")
+        reason = _parse_reason(body)
+        if reason and hit is not None:
+            self.cache.set_reason(text, criterion, reason)
+        return reason
+
+    async def _score_uncached(
+        self, text: str, criterion: Optional[str], key: Hashable, *, cache_text: Optional[str] = None
+    ) -> ScoreResult:
+        try:
+            body = await self._call(lambda: self.send_fn(text, criterion), key, 1)
+        except Exception as e:
+            log.warning("LLM call failed, left unscored: %r", e)
+            METRICS.inc("llm_unscored")
+            return _unscored()
+        parsed = _parse_body(body)
+        if parsed is None:
+            METRICS.inc("llm_unparsed")
+            # не кешируем мусор (в следующий раз модель может ответить нормально) и не выдаём его за 0
+            return _unscored()
+        raw_score, reason = parsed
         score01 = _normalize_score_to_01(raw_score)
+        if self.cache is not None:
+            self.cache.put(text if cache_text is None else cache_text, criterion, score01, reason)
         return ScoreResult(lm=None, score=score01, reason=reason)
-       
+
+    async def _call(self, make: Callable[[], Awaitable[Any]], key: Hashable, items: int) -> Any:
+        """One logical LLM request: circuit breaker, per-call deadline, optional hedge, jittered retries."""
+        p = self.policy
+        for attempt in range(p.max_retries + 1):
+            self.breaker.check()
+            try:
+                body = await self._attempt(make, key, items)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                # breaker считает только сбои сервиса (таймауты/429/5xx), и один раз на логический вызов:
+                # отказ модели по содержанию (safety block и т.п.) — не повод глушить всех
+                if not is_retryable_error(e):
+                    raise
+                if attempt >= p.max_retries or self.breaker.is_open:
+                    self.breaker.failure()
+                    raise
+                METRICS.inc("llm_retries")
+                await asyncio.sleep(random.uniform(0, min(p.retry_max_s, p.retry_base_s * 2 ** attempt)))
+            else:
+                self.breaker.success()
+                return body
+        raise RuntimeError("unreachable")
+
+    async def _attempt(self, make: Callable[[], Awaitable[Any]], key: Hashable, items: int) -> Any:
+        async def once(started: asyncio.Event) -> Any:
+            async def go() -> Any:
+                # слот диспетчера получен: breaker мог открыться, пока ждали в очереди
+                self.breaker.check()
+                started.set()
+                loop = asyncio.get_running_loop()
+                t0 = loop.time()
+                body = await _timed_call(asyncio.wait_for(make(), self.policy.call_timeout_s), items)
+                self._latency.observe(loop.time() - t0)
+                return body
+
+            run = asyncio.create_task(self.dispatcher.run(go, key=key))
+            tripped = asyncio.create_task(self.breaker.wait_open())
+            try:
+                await asyncio.wait([run, tripped], return_when=asyncio.FIRST_COMPLETED)
+                if not run.done() and not started.is_set():
+                    # breaker открылся, пока вызов ждал в очереди — снимаем его, не тратя rate limit
+                    raise CircuitOpenError("LLM circuit opened while queued")
+                return await run
+            finally:
+                tripped.cancel()
+                run.cancel()
+
+        if not self.policy.hedge:
+            return await once(asyncio.Event())
+        started = asyncio.Event()
+        tasks = [asyncio.create_task(once(started))]
+        waiter = asyncio.create_task(started.wait())
+        try:
+            # задержку hedge считаем от начала вызова, а не от постановки в очередь
+            await asyncio.wait([tasks[0], waiter], return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay())
+            if not done:
+                # медленный хвост: второй такой же запрос, берём первый успешный ответ
+                METRICS.inc("llm_hedges")
+                tasks.append(asyncio.create_task(once(asyncio.Event())))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        return t.result()
+            raise tasks[0].exception()  # type: ignore[misc]
+        finally:
+            waiter.cancel()
+            for t in tasks:
+                t.cancel()
+
+    def _hedge_delay(self) -> float:
+        if self._latency.count < 20:
+            return max(self.policy.hedge_min_delay_s, self.policy.call_timeout_s / 2)
+        return max(self.policy.hedge_min_delay_s, self._latency.quantiles((0.95,))[0])
+
+
+def _unscored() -> ScoreResult:
+    return ScoreResult(lm=None, score=0.0, reason=None, unscored=True)
+
+
+async def _timed_call(coro: Awaitable[Any], items: int) -> Any:
+    # время самого вызова модели, без ожидания в очереди диспетчера
+    METRICS.inc("llm_calls")
+    METRICS.inc("llm_items", items)
+    try:
+        with METRICS.timer("llm_call"):
+            return await coro
+    except Exception:
+        METRICS.inc("llm_errors")
+        raise
+
+
+def _parse_body(body: Any) -> Optional[tuple[float, Optional[str]]]:
+    # try raw number first
+    if isinstance(body, (int, float)):
+        return float(body), None
+    if isinstance(body, str):
+        # может быть просто число или JSON
+        s = body.strip()
+        try:
+            return float(s), None
+        except Exception:
+            pass
+        try:
+            data = json.loads(s)
+        except Exception:
+            return None
+        return _extract_score_reason(data) if isinstance(data, dict) else None
+    if isinstance(body, dict):
+        return _extract_score_reason(body)
+    return None
+
+
+def _parse_batch_body(body: Any) -> Dict[str, Tuple[float, Optional[str]]]:
+    # {id: (raw_score, reason)}; битые элементы просто пропускаем — их переспросят
+    if isinstance(body, str):
+        s = body.strip()
+        if s.startswith("```"):
+            s = s.strip("`")
+            if s.lower().startswith("json"):
+                s = s[4:]
+        try:
+            body = json.loads(s)
+        except Exception:
+            return {}
+    if isinstance(body, dict):
+        body = body.get("items") or body.get("results") or []
+    if not isinstance(body, list):
+        return {}
+    out: Dict[str, Tuple[float, Optional[str]]] = {}
+    for item in body:
+        if not isinstance(item, dict) or item.get("id") is None:
+            continue
+        try:
+            val = float(item.get("score"))
+        except Exception:
+            continue
+        reason = item.get("reason")
+        if not isinstance(reason, str) or not reason.strip():
+            reason = None
+        out[str(item["id"])] = (val, reason)
+    return out
+
+
+def _parse_reason(body: Any) -> Optional[str]:
+    if isinstance(body, dict):
+        body = body.get("reason")
+    if isinstance(body, str) and body.strip().startswith("{"):
+        try:
+            body = json.loads(body).get("reason")
+        except Exception:
+            pass
+    return body.strip() if isinstance(body, str) and body.strip() else None
+
+
 def _extract_score_reason(data: dict) -> tuple[float, Optional[str]]:
     sc = data.get("score")
     try:
@@ -69,21 +412,25 @@ async def score_logical_messages(
     scorer: "LLMScorer",
     messages: List["LogicalMessage"],
     criterion: Optional[str],
-    spacing_ms: int = 100
+    *,
+    user_key: Hashable = None,
 ) -> List["ScoreResult"]:
-    loop = asyncio.get_running_loop()
-    t0 = loop.time()
-    spacing = spacing_ms / 1000.0
-
-    async def _score_one(lm: "LogicalMessage", i: int) -> "ScoreResult":
-        # точное расписание старта вызова относительно t0
-        target = t0 + i * spacing
-        now = loop.time()
-        if target > now:
-            await asyncio.sleep(target - now)
-        sr = await scorer.score(lm.text or "", criterion)
+    # темп и параллелизм задаёт scorer.dispatcher; user_key — для честной очереди между пользователями
+    # размер пачки — scorer.policy.batch_size
+    scored = await scorer.score_many([lm.text or "" for lm in messages], criterion, key=user_key)
+    for sr, lm in zip(scored, messages):
         sr.lm = lm
-        return sr
+    return scored
 
-    tasks = [asyncio.create_task(_score_one(lm, i)) for i, lm in enumerate(messages)]
-    return await asyncio.gather(*tasks)
+
+async def iter_score_logical_messages(
+    scorer: "LLMScorer",
+    messages: List["LogicalMessage"],
+    criterion: Optional[str],
+    *,
+    user_key: Hashable = None,
+) -> AsyncIterator["ScoreResult"]:
+    """Yields ScoreResults (with lm set) in completion order, not input order."""
+    async for i, sr in scorer.iter_score_many([lm.text or "" for lm in messages], criterion, key=user_key):
+        sr.lm = messages[i]
+        yield sr
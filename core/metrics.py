@@ -0,0 +1,140 @@
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("rent-bot")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Latency samples: exact count/sum plus the last `window` values for percentiles."""
+    def __init__(self, window: int = 2048):
+        self.count = 0
+        self.total = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self._recent.append(value)
+
+    def quantiles(self, qs: Tuple[float, ...] = QUANTILES) -> List[float]:
+        if not self._recent:
+            return [0.0 for _ in qs]
+        data = sorted(self._recent)
+        return [data[min(len(data) - 1, int(q * len(data)))] for q in qs]
+
+
+class Metrics:
+    """
+    In-process counters and latency histograms for the search pipeline.
+    Stage names: history_page, grouping, slicing, llm_call, bridge_forward, bot_send, ...
+    Collectors add gauges computed on demand (e.g. score cache stats).
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def inc(self, name: str, n: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def add_collector(self, fn: Callable[[], Dict[str, float]]) -> None:
+        self._collectors.append(fn)
+
+    def gauges(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for fn in self._collectors:
+            try:
+                out.update(fn())
+            except Exception as e:
+                log.debug("Metrics collector failed: %s", e)
+        return out
+
+    def render_text(self) -> str:
+        """Short human-readable summary for /stats."""
+        lines = [f"⏱ Аптайм: {int(time.time() - self.started)} c"]
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            p50, p95, p99 = h.quantiles()
+            lines.append(f"{name}: n={h.count} p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms p99={p99 * 1000:.0f}ms")
+        for name, val in sorted({**self.counters, **self.gauges()}.items()):
+            lines.append(f"{name}: {val:g}")
+        return "\n".join(lines)
+
+    def render_prometheus(self, prefix: str = "rentbot_") -> str:
+        out: List[str] = []
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            metric = f"{prefix}{name}_seconds"
+            out.append(f"# TYPE {metric} summary")
+            for q, v in zip(QUANTILES, h.quantiles()):
+                out.append(f'{metric}{{quantile="{q}"}} {v:.6f}')
+            out.append(f"{metric}_sum {h.total:.6f}")
+            out.append(f"{metric}_count {h.count}")
+        for name, val in sorted(self.counters.items()):
+            out.append(f"# TYPE {prefix}{name}_total counter")
+            out.append(f"{prefix}{name}_total {val:g}")
+        for name, val in sorted(self.gauges().items()):
+            out.append(f"# TYPE {prefix}{name} gauge")
+            out.append(f"{prefix}{name} {val:g}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+
+async def start_exporter(
+    host: str, port: int, metrics: Optional[Metrics] = None, *, read_timeout_s: float = 10.0
+) -> asyncio.AbstractServer:
+    """
+    Minimal HTTP endpoint serving metrics in Prometheus text format (any path).
+    A client that does not finish its request headers within `read_timeout_s` is disconnected.
+    """
+    metrics = metrics or METRICS
+
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # заголовки запроса не нужны — дочитываем до пустой строки и отвечаем
+            while (await asyncio.wait_for(reader.readline(), read_timeout_s)).strip():
+                pass
+            body = metrics.render_prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except Exception as e:
+            log.debug("Metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_handle, host, port)
+    log.info("Metrics exporter on http://%s:%d/metrics", host, port)
+    return server
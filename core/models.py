@@ -1,24 +1,27 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Union
 
-@dataclass
+@dataclass(slots=True)
 class RawMessage:
     id: int
     text: Optional[str] = None
     grouped_id: Optional[int] = None
     has_media: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class LogicalMessage:
     ids: List[int]                  # all message ids that belong to this logical post (album or single)
     text: Optional[str]             # caption/text of the logical post (None if no text)
     grouped_id: Optional[int]       # None for single, otherwise album id
     caption_src_id: Optional[int]   # which message id inside ids has the caption
     has_media: bool                 # whether there is at least one media in this logical post
+    reposts: int = 0                # how many near-duplicate copies were collapsed into this one
+    chat: Optional[Union[int, str]] = None  # source chat identifier (set when reading several chats)
 
 @dataclass
 class ScoreResult:
     lm: LogicalMessage
     score: float
     reason: Optional[str] = None
+    unscored: bool = False          # LLM не дал оценку (таймаут/ошибка/дедлайн); score тогда 0
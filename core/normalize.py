@@ -0,0 +1,179 @@
+from __future__ import annotations
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Set
+import math
+import re
+import unicodedata
+
+from core.metrics import METRICS
+from core.prefilter import extract_bedrooms, extract_districts, extract_prices, has_phone, mask_phones
+from core.text import fold
+
+# эмодзи и прочие пиктограммы: So + модификаторы цвета кожи, ZWJ, variation selectors
+_EMOJI_EXTRA = {0x200D, 0xFE0E, 0xFE0F, 0x20E3}
+_BULLET = re.compile(r"^[\s\-–—•·*>|+=_~.:;,!]+")
+_SPACES = re.compile(r"[ \t ]+")
+_HASHTAG = re.compile(r"#\w+")
+_TRAILING_TAGS = re.compile(r"(?:\s*#\w+){2,}\s*$")
+_AREA = re.compile(r"\d+\s*(?:m2|м2|m²|м²|кв\.?\s*м|sqm|sq\.?\s*m)")
+_CONTACT = re.compile(
+    r"(?:\+?\d[\d\s().-]{7,}\d|@\w{4,}|wa\.me/|t\.me/|zalo|whats\s?app|viber|telegram|телеграм|"
+    r"контакт|тел\.|звоните|пишите|call\b|contact)",
+    re.IGNORECASE,
+)
+_BOILERPLATE = re.compile(
+    r"(?:подпис\w+|subscribe|наш\w* канал|our channel|join us|больше (?:вариантов|объектов|предложений)|"
+    r"more (?:options|listings|apartments)|репост|share this|ставьте|не пропустите|агентство недвижимости|"
+    r"real estate agency|все объекты|all listings)",
+    re.IGNORECASE,
+)
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Rough SentencePiece-like estimate without a tokenizer: ~4 ASCII chars per token,
+    ~2.5 chars for Cyrillic/Vietnamese/emoji.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2.5)
+
+
+def _strip_emoji(s: str) -> str:
+    return "".join(
+        ch for ch in s
+        if not (unicodedata.category(ch) == "So" or ord(ch) in _EMOJI_EXTRA or 0x1F3FB <= ord(ch) <= 0x1F3FF)
+    )
+
+
+def has_facts(line: str) -> bool:
+    """Price, size (bedrooms / area) or location: the lines the model must see. Phone numbers are not facts."""
+    line = mask_phones(line)
+    return bool(extract_prices(line) or extract_bedrooms(line) or extract_districts(line) or _AREA.search(fold(line)))
+
+
+def _fact_tags(tags: List[str]) -> List[str]:
+    # из блока хештегов оставляем только то, что несёт район/размер/цену (#сонча, #2br)
+    return [t for t in tags if has_facts(t[1:].replace("_", " "))]
+
+
+@lru_cache(maxsize=8192)
+def normalize_listing(text: Optional[str]) -> str:
+    """
+    Strips what costs tokens but does not change the score: emoji, hashtag blocks,
+    repeated and extra contact lines, channel/agency boilerplate, duplicate lines and
+    whitespace. Fact-bearing hashtags are kept on one line at the end.
+    """
+    if not text:
+        return ""
+    out: List[str] = []
+    seen: Set[str] = set()
+    tags: List[str] = []
+    contact_seen = False
+    for raw in _strip_emoji(text).splitlines():
+        line = _SPACES.sub(" ", _BULLET.sub("", raw)).strip()
+        if not line:
+            continue
+        if all(tok.startswith("#") for tok in line.split()):
+            tags += _HASHTAG.findall(line)
+            continue
+        m = _TRAILING_TAGS.search(line)
+        if m:
+            tags += _HASHTAG.findall(m.group(0))
+            line = line[:m.start()].rstrip()
+        key = " ".join(fold(line).split())
+        if key in seen:
+            continue
+        seen.add(key)
+        # контакт распознаём до фактов: номер телефона в строке фактом не считается
+        contact = bool(_CONTACT.search(line) or has_phone(line))
+        facts = has_facts(line)
+        if not facts and _BOILERPLATE.search(line):
+            continue
+        if contact and not facts:
+            if contact_seen:
+                continue
+            contact_seen = True
+        out.append(line)
+    kept_tags = list(dict.fromkeys(_fact_tags(tags)))
+    if kept_tags:
+        out.append(" ".join(kept_tags))
+    return "\n".join(out)
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """
+    Fits text into max_tokens: price/size/location lines are taken first, then the rest
+    in order; the kept lines stay in their original order. The line that does not fit is
+    cut at a word boundary.
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lines = text.split("\n")
+    facts = [i for i, ln in enumerate(lines) if has_facts(ln)]
+    first = set(facts)
+    order = facts + [i for i in range(len(lines)) if i not in first]
+    kept: Dict[int, str] = {}
+    left = max_tokens - 1  # на "…"
+    for i in order:
+        cost = estimate_tokens(lines[i]) + 1
+        if cost <= left:
+            kept[i] = lines[i]
+            left -= cost
+            continue
+        if left > 4:
+            kept[i] = _cut(lines[i], left - 1)
+        break
+    return "\n".join(kept[i] for i in sorted(kept)) + "…"
+
+
+def _cut(line: str, max_tokens: int) -> str:
+    lo, hi = 0, len(line)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(line[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = line[:lo]
+    return cut.rsplit(" ", 1)[0] if " " in cut and lo < len(line) else cut
+
+
+def split_budget(costs: Sequence[int], total: int, floor: int = 0) -> List[int]:
+    """
+    Water-filling: listings cheaper than the fair share keep their full cost, the
+    rest get an equal share of what is left (never below floor).
+    """
+    budgets = list(costs)
+    if sum(budgets) <= total:
+        return budgets
+    left, n = total, len(budgets)
+    for i in sorted(range(len(budgets)), key=budgets.__getitem__):
+        share = max(floor, left // n)
+        budgets[i] = min(budgets[i], share)
+        left -= budgets[i]
+        n -= 1
+    return budgets
+
+
+def prepare_listing(text: Optional[str], max_tokens: int) -> str:
+    """Normalized listing within the per-listing budget; this is also what the score cache is keyed by."""
+    raw = estimate_tokens(text)
+    out = truncate_to_budget(normalize_listing(text), max_tokens)
+    METRICS.inc("llm_listing_tokens_raw", raw)
+    METRICS.inc("llm_tokens_saved", max(0, raw - estimate_tokens(out)))
+    return out
+
+
+def fit_search_budget(texts: List[str], total_tokens: Optional[int], floor: int) -> List[str]:
+    """Shrinks already prepared listings so that one search stays within total_tokens."""
+    if not total_tokens:
+        return texts
+    costs = [estimate_tokens(t) for t in texts]
+    budgets = split_budget(costs, total_tokens, floor)
+    out = [t if b >= c else truncate_to_budget(t, b) for t, c, b in zip(texts, costs, budgets)]
+    METRICS.inc("llm_tokens_saved", sum(costs) - sum(estimate_tokens(t) for t in out))
+    return out
@@ -0,0 +1,225 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+import re
+
+from core.models import LogicalMessage, ScoreResult
+from core.text import fold as _fold
+
+# Районы Дананга и их написания (после _fold: без диакритики, нижний регистр)
+DISTRICTS: Dict[str, Tuple[str, ...]] = {
+    "son_tra": ("son tra", "сон ча", "сонча", "сон тра", "man thai", "an hai", "phuoc my", "фуок ми"),
+    "hai_chau": ("hai chau", "хай чау", "хайчау"),
+    "ngu_hanh_son": ("ngu hanh son", "нгу хань шон", "нгу хань сон", "нгу хан сон", "marble mountains",
+                     "an thuong", "ан тхыонг", "ан туонг", "my an", "khue my"),
+    "thanh_khe": ("thanh khe", "тхань кхе", "тхань кхэ"),
+    "lien_chieu": ("lien chieu", "льен тьеу", "лиен чьеу"),
+    "cam_le": ("cam le", "кам ле"),
+}
+
+# число не должно быть хвостом другого числа или телефона ("+84 905...", "0905.123.456")
+_NUM = r"(?<![\d.,+])(\d+(?:[.,]\d+)*)"
+# 20m / 20 млн / 20tr / 20 trieu; "m" — только если дальше не расстояние ("500m to beach")
+_RE_MILLIONS = re.compile(
+    _NUM + r"\s*(m|mil|million|millions|tr|trieu|млн|миллион\w*|лям\w*)\b"
+    r"(?!\s*(?:to|from|walk|до|от|к|пешком|beach|пляж\w*|мор\w*|sea)\b)"
+)
+# голое "m" — это и метры ("45 m"): миллионами считаем, только если рядом есть слово про цену
+_RE_PRICE_CONTEXT = re.compile(
+    r"\b(?:vnd|dong|gia|price|rent|thue|budget|under|max|цена|стоимост\w*|аренд\w*|бюджет\w*|до|млн|tr|trieu)\b"
+    r"|/\s*(?:month|mo|thang|мес\w*)\b|\b(?:per|a) month\b|\bв месяц\b"
+)
+_RE_AREA_BEFORE = re.compile(r"(?:\bm2|m²|\bdt|\barea|площад\w*|\bкв\.?)[\s:.]*$")
+# 20.000.000 vnd / 20,000,000đ / 8000000 донгов; голая цепочка цифр — только с валютой
+_RE_FULL_VND = re.compile(
+    r"(?<![\d.,+])(?:(\d{1,3}(?:[.,]\d{3}){2,})(?![.,]?\d)\s*(?:vnd|dong|d|донг\w*)?"
+    r"|(\d{7,9})\s*(?:vnd|dong|d|донг\w*))\b"
+)
+# телефоны: +84 905 123 456 / 0905123456 / 090.512.3456 — ни цена, ни что-либо ещё
+_RE_PHONE = re.compile(
+    r"\+\d{1,3}[\s.-]?\(?\d{1,4}\)?(?:[\s.-]?\d{3,4}){1,3}(?!\d)"
+    r"|(?<![\d.,])0\d{2,3}(?:[\s.-]?\d{3}){2}\d?(?!\d)"
+)
+_RE_USD = re.compile(
+    r"\$\s*" + _NUM + r"|" + _NUM + r"\s*(?:\$|usd|долл\w*|dollar\w*|бакс\w*|у\.?е\.?)"
+)
+_LOWER_BOUND_MARKERS = (">", "от ", "from ", "min", "не меньше", "не дешевле", "at least", "over ")
+
+_NUM_WORDS = {
+    "одн": 1, "одно": 1, "дву": 2, "двух": 2, "двуш": 2, "тре": 3, "трех": 3, "треш": 3,
+    "четырех": 4, "пяти": 5,
+}
+_RE_BEDROOMS = re.compile(
+    r"\b(\d)\s*-?\s*(?:br|bed|beds|bedroom\w*|bd|pn|phong ngu|спал\w*|комн\w*|к\b)"
+)
+_RE_BEDROOM_WORDS = re.compile(r"\b(одн|одно|дву|двух|двуш|тре|трех|треш|четырех|пяти)(?:комнатн\w*|спальн\w*|ка\b|ку\b)")
+_RE_STUDIO = re.compile(r"\b(?:studio|студи\w*)\b")
+_RE_DISTRICTS: Dict[str, re.Pattern] = {
+    name: re.compile(r"\b(?:" + "|".join(re.escape(s) for s in spellings) + r")\b")
+    for name, spellings in DISTRICTS.items()
+}
+
+
+def _to_float(num: str) -> Optional[float]:
+    s = num.strip()
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", s):
+        s = re.sub(r"[.,]", "", s)  # разделители тысяч
+    else:
+        s = s.replace(",", ".")
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+@dataclass
+class Price:
+    amount: float      # в единицах валюты (VND / USD)
+    currency: str      # "VND" | "USD"
+    lower_bound: bool = False
+
+
+def has_phone(text: str) -> bool:
+    return _RE_PHONE.search(_fold(text or "")) is not None
+
+
+def mask_phones(text: str) -> str:
+    # только цифры, пробелы и "+.-()": на исходном тексте телефон находится так же, как после _fold
+    return _RE_PHONE.sub(" ", text or "")
+
+
+def extract_prices(text: str) -> List[Price]:
+    t = _fold(text or "")
+    out: List[Price] = []
+    taken: List[Tuple[int, int]] = [m.span() for m in _RE_PHONE.finditer(t)]
+
+    def _add(m: re.Match, amount: Optional[float], currency: str) -> None:
+        if amount is None or amount <= 0:
+            return
+        if any(a < m.end() and m.start() < b for a, b in taken):
+            return
+        taken.append((m.start(), m.end()))
+        before = t[max(0, m.start() - 12):m.start()]
+        out.append(Price(amount, currency, any(k in before for k in _LOWER_BOUND_MARKERS)))
+
+    for m in _RE_USD.finditer(t):
+        _add(m, _to_float(m.group(1) or m.group(2)), "USD")
+    for m in _RE_MILLIONS.finditer(t):
+        if m.group(2) == "m":
+            before = t[max(0, m.start() - 24):m.start()]
+            around = before + t[m.end():m.end() + 16]
+            if _RE_AREA_BEFORE.search(before) or not _RE_PRICE_CONTEXT.search(around):
+                continue
+        val = _to_float(m.group(1))
+        if val is not None and val < 200:  # аренда в миллионах донгов; больше — скорее не цена
+            _add(m, val * 1_000_000, "VND")
+    for m in _RE_FULL_VND.finditer(t):
+        _add(m, _to_float(m.group(1) or m.group(2)), "VND")
+    return out
+
+
+def extract_bedrooms(text: str) -> List[int]:
+    t = _fold(text or "")
+    found = [int(m.group(1)) for m in _RE_BEDROOMS.finditer(t) if 0 < int(m.group(1)) < 10]
+    found += [_NUM_WORDS[m.group(1)] for m in _RE_BEDROOM_WORDS.finditer(t)]
+    if _RE_STUDIO.search(t):
+        found.append(0)
+    return found
+
+
+def extract_districts(text: str) -> Set[str]:
+    t = _fold(text or "")
+    return {name for name, rx in _RE_DISTRICTS.items() if rx.search(t)}
+
+
+@dataclass
+class Constraints:
+    max_price: Optional[Price] = None
+    min_bedrooms: Optional[int] = None
+    districts: Set[str] = field(default_factory=set)
+
+    @property
+    def empty(self) -> bool:
+        return self.max_price is None and self.min_bedrooms is None and not self.districts
+
+
+def parse_criterion(criterion: Optional[str]) -> Constraints:
+    c = Constraints()
+    if not criterion:
+        return c
+    uppers = [p for p in extract_prices(criterion) if not p.lower_bound]
+    if uppers:
+        c.max_price = max(uppers, key=lambda p: _in_vnd(p, 1.0))
+    beds = [b for b in extract_bedrooms(criterion) if b > 0]
+    if beds:
+        c.min_bedrooms = min(beds)
+    c.districts = extract_districts(criterion)
+    return c
+
+
+def _in_vnd(p: Price, vnd_per_usd: float) -> float:
+    return p.amount * vnd_per_usd if p.currency == "USD" else p.amount
+
+
+def mismatch_reason(text: str, cons: Constraints, *, price_tolerance: float, vnd_per_usd: float) -> Optional[str]:
+    """Returns why the listing clearly fails the constraints, or None if it may match (unknowns never reject)."""
+    if cons.max_price is not None:
+        prices = [p for p in extract_prices(text) if not p.lower_bound]
+        if prices:
+            # берём самую низкую цену из объявления (бывают цены за 6/12 месяцев и т.п.)
+            cheapest = min(_in_vnd(p, vnd_per_usd) for p in prices)
+            limit = _in_vnd(cons.max_price, vnd_per_usd) * (1.0 + price_tolerance)
+            if cheapest > limit:
+                return f"цена {_fmt_vnd(cheapest)} > {_fmt_vnd(_in_vnd(cons.max_price, vnd_per_usd))}"
+    if cons.min_bedrooms is not None:
+        beds = extract_bedrooms(text)
+        if beds and max(beds) < cons.min_bedrooms:
+            return f"спален {max(beds)} < {cons.min_bedrooms}"
+    if cons.districts:
+        found = extract_districts(text)
+        if found and not (found & cons.districts):
+            return "район " + ", ".join(sorted(found))
+    return None
+
+
+def _fmt_vnd(v: float) -> str:
+    return f"{v / 1_000_000:g}m VND"
+
+
+@dataclass
+class PrefilterStats:
+    checked: int = 0
+    rejected: int = 0   # == сэкономленные вызовы LLM
+
+
+PREFILTER_STATS = PrefilterStats()
+
+
+def prefilter_logical_messages(
+    messages: List[LogicalMessage],
+    criterion: Optional[str],
+    *,
+    price_tolerance: float = 0.1,
+    vnd_per_usd: float = 25_000,
+) -> Tuple[List[LogicalMessage], List[ScoreResult]]:
+    """
+    Splits messages into (to be scored by LLM, rejected locally).
+    Rejected ones come back as ScoreResult with score 0 and the mismatch as reason.
+    """
+    cons = parse_criterion(criterion)
+    if cons.empty:
+        return list(messages), []
+    kept: List[LogicalMessage] = []
+    rejected: List[ScoreResult] = []
+    for lm in messages:
+        if not (lm.text and lm.text.strip()):
+            kept.append(lm)
+            continue
+        PREFILTER_STATS.checked += 1
+        why = mismatch_reason(lm.text, cons, price_tolerance=price_tolerance, vnd_per_usd=vnd_per_usd)
+        if why is None:
+            kept.append(lm)
+        else:
+            PREFILTER_STATS.rejected += 1
+            rejected.append(ScoreResult(lm=lm, score=0.0, reason=f"не подходит: {why}"))
+    return kept, rejected
@@ -0,0 +1,80 @@
+from __future__ import annotations
+import heapq
+from typing import List, Optional, Tuple
+
+from core.models import ScoreResult
+
+MAX_SCORE = 1.0
+
+
+def _rank(sr: ScoreResult) -> Tuple[bool, float]:
+    # неоценённые — после всех оценённых, даже с честным нулём
+    return (not sr.unscored, sr.score)
+
+
+class StreamingRanker:
+    """
+    Collects scores as they complete and tells which items may already be delivered:
+      - an item whose place in the final ranking is certain (nothing still unscored can beat it:
+        its score is MAX_SCORE, or everything is scored);
+      - an item at or above `threshold` (delivered early even if a later one may outrank it;
+        `early` counts those, so callers know the order was not strictly by score).
+    Unscored items rank after every scored one. At most `limit` items (default `total`) are ever
+    delivered: the rest are kept in a bounded min-heap and dropped as better ones push them out.
+    """
+    def __init__(self, total: int, *, threshold: Optional[float] = None, limit: Optional[int] = None):
+        self.total = total
+        self.threshold = threshold
+        self.limit = limit
+        self.scored = 0
+        self.delivered = 0
+        self.early = 0
+        self._seq = 0
+        self._ready: List[Tuple[Tuple[bool, float], int, ScoreResult]] = []
+        self._heap: List[Tuple[Tuple[bool, float], int, ScoreResult]] = []  # худший первым
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.scored
+
+    def _capacity(self) -> int:
+        cap = self.limit if self.limit is not None else self.total
+        return max(0, cap - self.delivered - len(self._ready))
+
+    def _is_ready_now(self, sr: ScoreResult) -> bool:
+        if sr.unscored:
+            return False
+        return sr.score >= MAX_SCORE or (self.threshold is not None and sr.score >= self.threshold)
+
+    def push(self, sr: ScoreResult) -> None:
+        self.scored += 1
+        self._seq += 1
+        entry = (_rank(sr), -self._seq, sr)   # при равной оценке раньше пришедший лучше
+        if self._is_ready_now(sr):
+            # такие всегда лучше всего, что лежит в куче (там только ниже порога)
+            if self._capacity() > 0:
+                self._ready.append(entry)
+        else:
+            heapq.heappush(self._heap, entry)
+        while len(self._heap) > self._capacity():
+            heapq.heappop(self._heap)
+
+    def pop_ready(self) -> List[ScoreResult]:
+        ready = sorted(self._ready, reverse=True)
+        self._ready.clear()
+        out = [t[2] for t in ready]
+        if self.remaining > 0:
+            self.early += sum(1 for sr in out if sr.score < MAX_SCORE)
+        else:
+            out += [t[2] for t in sorted(self._heap, reverse=True)]
+            self._heap.clear()
+        self.delivered += len(out)
+        return out
+
+    def drain(self) -> List[ScoreResult]:
+        out = [t[2] for t in sorted(self._ready, reverse=True)]
+        out += [t[2] for t in sorted(self._heap, reverse=True)]
+        self._ready.clear()
+        self._heap.clear()
+        self.delivered += len(out)
+        return out
@@ -0,0 +1,161 @@
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+import hashlib
+import sqlite3
+import time
+
+# (score01, reason)
+CachedScore = Tuple[float, Optional[str]]
+
+
+def normalize_for_key(text: Optional[str]) -> str:
+    # регистр и пробелы не должны влиять на ключ кеша
+    return " ".join((text or "").casefold().split())
+
+
+def _digest(s: str) -> str:
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    mem_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.mem_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ScoreCache:
+    """
+    Content-addressed cache of LLM scores: key = hash(normalized text) + hash(criterion).
+    Two tiers: in-memory LRU in front of an SQLite table that survives restarts.
+    path=None keeps only the memory tier.
+    """
+    EVICT_EVERY = 256  # how many writes between disk TTL/size sweeps
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        *,
+        mem_size: int = 4096,
+        ttl_s: float = 7 * 24 * 3600,
+        max_rows: int = 200_000,
+    ):
+        self.mem_size = mem_size
+        self.ttl_s = ttl_s
+        self.max_rows = max_rows
+        self.stats = CacheStats()
+        self._mem: "OrderedDict[Tuple[str, str], Tuple[float, float, Optional[str]]]" = OrderedDict()
+        self._writes_since_sweep = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                " text_hash TEXT NOT NULL, crit_hash TEXT NOT NULL,"
+                " score REAL NOT NULL, reason TEXT, ts REAL NOT NULL,"
+                " PRIMARY KEY (text_hash, crit_hash)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS scores_ts ON scores(ts)")
+            self._db.commit()
+
+    @staticmethod
+    def key(text: Optional[str], criterion: Optional[str]) -> Tuple[str, str]:
+        return _digest(normalize_for_key(text)), _digest(normalize_for_key(criterion))
+
+    def get(self, text: Optional[str], criterion: Optional[str]) -> Optional[CachedScore]:
+        k = self.key(text, criterion)
+        now = time.time()
+
+        hit = self._mem.get(k)
+        if hit is not None:
+            ts, score, reason = hit
+            if now - ts <= self.ttl_s:
+                self._mem.move_to_end(k)
+                self.stats.mem_hits += 1
+                return score, reason
+            del self._mem[k]
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT score, reason, ts FROM scores WHERE text_hash=? AND crit_hash=?", k
+            ).fetchone()
+            if row is not None and now - row[2] <= self.ttl_s:
+                self._remember(k, row[2], row[0], row[1])
+                self.stats.disk_hits += 1
+                return row[0], row[1]
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, text: Optional[str], criterion: Optional[str], score: float, reason: Optional[str]) -> None:
+        k = self.key(text, criterion)
+        now = time.time()
+        self._remember(k, now, score, reason)
+        self.stats.writes += 1
+        if self._db is None:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO scores (text_hash, crit_hash, score, reason, ts) VALUES (?, ?, ?, ?, ?)",
+            (*k, score, reason, now),
+        )
+        self._db.commit()
+        self._writes_since_sweep += 1
+        if self._writes_since_sweep >= self.EVICT_EVERY:
+            self.sweep()
+
+    def set_reason(self, text: Optional[str], criterion: Optional[str], reason: str) -> None:
+        """Attaches a lazily generated reason to an existing entry (the score is left as is)."""
+        k = self.key(text, criterion)
+        hit = self._mem.get(k)
+        if hit is not None:
+            self._mem[k] = (hit[0], hit[1], reason)
+        if self._db is not None:
+            self._db.execute("UPDATE scores SET reason=? WHERE text_hash=? AND crit_hash=?", (reason, *k))
+            self._db.commit()
+
+    def sweep(self) -> None:
+        """Drops expired rows and trims the disk tier down to max_rows (oldest first)."""
+        self._writes_since_sweep = 0
+        if self._db is None:
+            return
+        cur = self._db.execute("DELETE FROM scores WHERE ts < ?", (time.time() - self.ttl_s,))
+        removed = cur.rowcount or 0
+        (count,) = self._db.execute("SELECT COUNT(*) FROM scores").fetchone()
+        if count > self.max_rows:
+            cur = self._db.execute(
+                "DELETE FROM scores WHERE (text_hash, crit_hash) IN "
+                "(SELECT text_hash, crit_hash FROM scores ORDER BY ts LIMIT ?)",
+                (count - self.max_rows,),
+            )
+            removed += cur.rowcount or 0
+        self._db.commit()
+        self.stats.evictions += removed
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, k: Tuple[str, str], ts: float, score: float, reason: Optional[str]) -> None:
+        self._mem[k] = (ts, score, reason)
+        self._mem.move_to_end(k)
+        while len(self._mem) > self.mem_size:
+            self._mem.popitem(last=False)
+            self.stats.evictions += 1
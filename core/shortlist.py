@@ -0,0 +1,116 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence, Tuple
+import math
+import zlib
+
+from core.models import LogicalMessage
+from core.prefilter import extract_bedrooms, extract_districts
+from core.text import words
+
+try:
+    import numpy as np
+except ImportError:  # numpy не обязателен: та же математика на словарях
+    np = None
+
+N_FEATURES = 1 << 18
+
+
+def features(text: str) -> List[int]:
+    """
+    Hashed bag of features: folded unigrams, word bigrams and canonical facts
+    (district / bedroom count from core.prefilter, so "Сон Ча" matches "son_tra").
+    """
+    ws = words(text)
+    toks = ws + [f"{a} {b}" for a, b in zip(ws, ws[1:])]
+    toks += [f"district:{d}" for d in extract_districts(text)]
+    toks += [f"br:{n}" for n in extract_bedrooms(text)]
+    return [zlib.crc32(t.encode()) % N_FEATURES for t in toks]
+
+
+def rank_by_similarity(texts: Sequence[str], query: str) -> List[float]:
+    """
+    TF-IDF (sublinear tf, smoothed idf over texts + query) cosine similarity of every text
+    to the query, in input order.
+    """
+    docs = [features(t) for t in texts]
+    q = features(query)
+    if not docs or not q:
+        return [0.0] * len(docs)
+    if np is not None:
+        return _cosine_numpy(docs, q)
+    return _cosine_py(docs, q)
+
+
+def _cosine_numpy(docs: List[List[int]], q: List[int]) -> List[float]:
+    n_docs = len(docs)
+    doc_idx = np.repeat(np.arange(n_docs), [len(d) for d in docs])
+    feat = np.fromiter((f for d in docs for f in d), dtype=np.int64, count=len(doc_idx))
+    # (doc, feature) -> tf одним проходом через уникальные пары
+    pairs, tf = np.unique(doc_idx * N_FEATURES + feat, return_counts=True)
+    p_doc, p_feat = pairs // N_FEATURES, pairs % N_FEATURES
+    q_feat, q_tf = np.unique(np.asarray(q, dtype=np.int64), return_counts=True)
+
+    all_feat = np.concatenate([p_feat, q_feat])
+    uniq, inv = np.unique(all_feat, return_inverse=True)
+    df = np.bincount(inv, minlength=len(uniq))
+    idf = np.log((1.0 + n_docs + 1) / (1.0 + df)) + 1.0
+
+    w = (1.0 + np.log(tf)) * idf[inv[:len(p_feat)]]
+    qw_dense = np.zeros(len(uniq))
+    qw_dense[inv[len(p_feat):]] = (1.0 + np.log(q_tf)) * idf[inv[len(p_feat):]]
+
+    norms = np.sqrt(np.bincount(p_doc, weights=w * w, minlength=n_docs))
+    dots = np.bincount(p_doc, weights=w * qw_dense[inv[:len(p_feat)]], minlength=n_docs)
+    q_norm = math.sqrt(float((qw_dense * qw_dense).sum()))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sims = np.where(norms > 0, dots / (norms * q_norm), 0.0)
+    return sims.tolist()
+
+
+def _cosine_py(docs: List[List[int]], q: List[int]) -> List[float]:
+    tfs = [_counts(d) for d in docs]
+    q_tf = _counts(q)
+    df: Dict[int, int] = {}
+    for tf in tfs + [q_tf]:
+        for f in tf:
+            df[f] = df.get(f, 0) + 1
+    n = len(docs) + 1
+    idf = {f: math.log((1.0 + n) / (1.0 + c)) + 1.0 for f, c in df.items()}
+    qw = {f: (1.0 + math.log(c)) * idf[f] for f, c in q_tf.items()}
+    q_norm = math.sqrt(sum(v * v for v in qw.values()))
+    out: List[float] = []
+    for tf in tfs:
+        dot = norm = 0.0
+        for f, c in tf.items():
+            w = (1.0 + math.log(c)) * idf[f]
+            norm += w * w
+            dot += w * qw.get(f, 0.0)
+        out.append(dot / (math.sqrt(norm) * q_norm) if norm else 0.0)
+    return out
+
+
+def _counts(feats: List[int]) -> Dict[int, int]:
+    c: Dict[int, int] = {}
+    for f in feats:
+        c[f] = c.get(f, 0) + 1
+    return c
+
+
+def shortlist_logical_messages(
+    messages: List[LogicalMessage], criterion: Optional[str], top_m: int
+) -> Tuple[List[LogicalMessage], List[LogicalMessage]]:
+    """
+    Keeps the top_m posts most similar to the criterion (ties -> newer first), in their
+    original order; returns (kept, dropped). Without a criterion the newest top_m are kept.
+    """
+    if top_m <= 0 or len(messages) <= top_m:
+        return list(messages), []
+    if criterion and criterion.strip():
+        sims = rank_by_similarity([lm.text or "" for lm in messages], criterion)
+    else:
+        sims = [0.0] * len(messages)
+    order = sorted(range(len(messages)), key=lambda i: (sims[i], messages[i].ids[0]), reverse=True)
+    keep = set(order[:top_m])
+    kept = [lm for i, lm in enumerate(messages) if i in keep]
+    dropped = [lm for i, lm in enumerate(messages) if i not in keep]
+    return kept, dropped
@@ -0,0 +1,17 @@
+from __future__ import annotations
+from typing import List
+import re
+import unicodedata
+
+_WORD = re.compile(r"\w+")
+
+
+def fold(text: str) -> str:
+    # регистр, диакритика (вьетнамская тоже), "_" в названиях районов ("son_tra")
+    t = unicodedata.normalize("NFKD", text.casefold().replace("đ", "d"))
+    t = "".join(ch for ch in t if not unicodedata.combining(ch))
+    return re.sub(r"[_]+", " ", t)
+
+
+def words(text: str) -> List[str]:
+    return _WORD.findall(fold(text or ""))
@@ -1,22 +1,41 @@
 #!/usr/bin/env python3
 import asyncio
+import importlib
 import logging
-from typing import Union, Optional
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterator, Union, Optional, List, Tuple, TypedDict
 
-from telegram import Update
-from telegram.ext import Application
-from telegram.request import HTTPXRequest
-
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-
-from config import BOT_TOKEN, API_ID, API_HASH, TELETHON_SESSION, TELETHON_SESSION_FILE, LOG_LEVEL, GEMINI_API_KEY
-from transport.telethon_client import TelethonHistoryClient
-from bot.handlers import register_handlers
+# telegram / telethon / google.generativeai и модули бота импортируются в main():
+# параллельно с чтением секретов, а genai — вместе с подключением Telethon и PTB
+import config
+from config import TELETHON_SESSION, TELETHON_SESSION_FILE, LOG_LEVEL
+from config import MESSAGE_STORE_PATH, DEDUP_INDEX_PATH, PEER_CACHE_PATH, PEER_CACHE_TTL_S
+from config import BRIDGE_CACHE_PATH, BRIDGE_CACHE_TTL_S
+from config import WATCH_DB_PATH, WATCH_ALBUM_SETTLE_S, CRITERIA_DB_PATH, FILTERS_PATH
+from config import BOT_SEND_RATE_PER_CHAT, BOT_SEND_BURST_PER_CHAT, BOT_SEND_RATE_GLOBAL
+from config import JOBS_GLOBAL_LIMIT, JOBS_PER_USER_LIMIT, JOBS_PER_USER_QUEUE_MAX, PROGRESS_EDIT_INTERVAL_S
+from config import LLM_LOG_SAMPLE_RATE, METRICS_HOST, METRICS_PORT
+from config import INGRESS_MODE, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_WORKERS
+from config import WEBHOOK_QUEUE_MAX, WEBHOOK_MAX_CONNECTIONS
+from config import LLM_SCORE_MODEL, LLM_REASON_MODEL, LLM_SCORE_MAX_OUTPUT_TOKENS, LLM_REASON_MAX_OUTPUT_TOKENS, WHY_BUTTONS_MAX
+from config import SCORE_CACHE_PATH, SCORE_CACHE_MEM_SIZE, SCORE_CACHE_TTL_S, SCORE_CACHE_MAX_ROWS
+from core.filters import CriteriaStore
 from core.llm import LLMScorer, LLMPolicy
+from core.score_cache import ScoreCache
+from core.dedup import SignatureIndex
+from core.metrics import METRICS, start_exporter
+from core.prefilter import PREFILTER_STATS
 
-import google.generativeai as genai
-from google.generativeai.types import GenerationConfig
+HEAVY_MODULES = (
+    "telegram", "telegram.ext", "telegram.request", "telethon", "telethon.sessions",
+    "transport.telethon_client", "transport.message_store", "transport.peer_cache", "transport.bridge_cache",
+    "bot.handlers", "bot.delivery", "bot.explain", "bot.jobs", "bot.watch", "bot.webhook",
+)
 
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
@@ -36,57 +55,179 @@ async def on_error(update, context):
 
 # ---- implement your actual LLM call here ----
 
+DEFAULT_CRITERION = "2br son_tra price<=20m"
+
+
+class _Score(TypedDict):
+    score: int
+
+
+class _BatchScore(TypedDict):
+    id: str
+    score: int
+
+
 async def my_send_fn(text: str, criterion: Optional[str]) -> Union[str, dict, float, int]:
-    crit = criterion or "2br son_tra price<=20m"
+    crit = criterion or DEFAULT_CRITERION
+    prompt = f"""
+Ты специалист по подбору жилья. Тебе даются критерии и текст объявления. Определи, насколько подходит объявление под критерии:
+оценка от 0 до 100, где 100 — идеально подходит, 0 — совсем не подходит. Только оценка, без обоснования.
+Критерии: {crit}
+Текст объявления: {text}
+    """.strip()
+    return await call_llm_api(prompt, model=LLM_SCORE_MODEL, schema=_Score, max_output_tokens=LLM_SCORE_MAX_OUTPUT_TOKENS)
+
+
+async def my_batch_send_fn(items: List[Tuple[str, str]], criterion: Optional[str]) -> Union[str, list]:
+    crit = criterion or DEFAULT_CRITERION
+    listings = "\n\n".join(f"### id={item_id}\n{text}" for item_id, text in items)
     prompt = f"""
-Ты специалист по подбору жилья. Тебе даются критерии и текст объявления. Определи, насколько подходит объявление под критерии
-(оценка от 0 до 100, где 100 — идеально подходит, 0 — совсем не подходит) и добавь обоснование оценки. 
-В ответе в формате json два поля score и reason, без лишних символов. ```json и ``` вокруг не нужны.
+Ты специалист по подбору жилья. Тебе даются критерии и несколько объявлений, у каждого свой id.
+Для каждого объявления определи, насколько оно подходит под критерии: оценка от 0 до 100, где 100 — идеально подходит,
+0 — совсем не подходит. Ровно по одной оценке на каждое объявление, id как во входе, без обоснований.
+Критерии: {crit}
+Объявления:
+{listings}
+    """.strip()
+    return await call_llm_api(prompt, model=LLM_SCORE_MODEL, schema=list[_BatchScore],
+                              max_output_tokens=LLM_SCORE_MAX_OUTPUT_TOKENS * len(items))
+
+
+async def my_reason_fn(text: str, criterion: Optional[str]) -> str:
+    crit = criterion or DEFAULT_CRITERION
+    prompt = f"""
+Ты специалист по подбору жилья. Тебе даются критерии и текст объявления.
+В одном-двух предложениях объясни, чем объявление подходит или не подходит под критерии. Только текст объяснения.
 Критерии: {crit}
 Текст объявления: {text}
     """.strip()
-    return await call_llm_api(prompt)
+    return await call_llm_api(prompt, model=LLM_REASON_MODEL, max_output_tokens=LLM_REASON_MAX_OUTPUT_TOKENS)
+
+
+# genai настраивается и модели создаются один раз (init_llm), а не на каждый вызов
+_MODELS: Dict[str, Any] = {}
+
 
-async def call_llm_api(prompt: str) -> Union[str, dict, float, int]:
-    genai.configure(api_key=GEMINI_API_KEY)
+def init_llm(model_names: Tuple[str, ...] = (LLM_SCORE_MODEL, LLM_REASON_MODEL)) -> None:
+    import google.generativeai as genai  # тяжёлый импорт: на старте идёт в потоке, параллельно с Telegram
 
-    short_response_config = GenerationConfig(temperature=0.2, max_output_tokens=10000)
-    
-    modelG = genai.GenerativeModel('gemini-2.5-flash', generation_config=short_response_config)
+    genai.configure(api_key=config.GEMINI_API_KEY)
+    for name in model_names:
+        _MODELS[name] = genai.GenerativeModel(name)
 
-    log.info("Запрос к Gemini: %s", prompt)
-    response = await modelG.generate_content_async(prompt)
 
+@lru_cache(maxsize=64)
+def _generation_config(schema, max_output_tokens: int):
+    from google.generativeai.types import GenerationConfig
+
+    if schema is not None:
+        # structured output: модель обязана вернуть JSON ровно по схеме, разбирать "как получится" не нужно
+        return GenerationConfig(temperature=0.2, max_output_tokens=max_output_tokens,
+                                response_mime_type="application/json", response_schema=schema)
+    return GenerationConfig(temperature=0.2, max_output_tokens=max_output_tokens)
+
+
+async def call_llm_api(prompt: str, *, model: str, schema=None, max_output_tokens: int) -> Union[str, dict, float, int]:
+    if model not in _MODELS:
+        init_llm((model,))
+    modelG = _MODELS[model]
+
+    sampled = log.isEnabledFor(logging.DEBUG) and random.random() < LLM_LOG_SAMPLE_RATE
+    if sampled:
+        log.debug("Запрос к Gemini: %s", prompt)
+    response = await modelG.generate_content_async(prompt, generation_config=_generation_config(schema, max_output_tokens))
+
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        METRICS.inc("llm_prompt_tokens", getattr(usage, "prompt_token_count", 0) or 0)
+        METRICS.inc("llm_output_tokens", getattr(usage, "candidates_token_count", 0) or 0)
     try:
-        log.info("Ответ Gemini: %s", response.text)
         resp = response.text
-    except ValueError:
-        print("❌ GEMINI FALL!")
-        return "Ошибка анализа ("
+    except ValueError as e:
+        # пустой/заблокированный ответ: пусть LLMScorer пометит объявление "без оценки", а не 0
+        log.warning("Gemini returned no text: %s", e)
+        raise
+    if sampled:
+        log.debug("Ответ Gemini: %s", resp)
     return resp
 
 
-async def init_telethon() -> Optional[TelethonHistoryClient]:
-    if not API_ID or not API_HASH:
+async def init_telethon():
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+    from transport.telethon_client import TelethonHistoryClient
+    from transport.message_store import MessageStore
+    from transport.peer_cache import PeerCache
+
+    if not config.API_ID or not config.API_HASH:
         log.warning("API_ID/API_HASH not provided. Telethon disabled.")
         return None
     if TELETHON_SESSION:
-        client = TelegramClient(StringSession(TELETHON_SESSION), int(API_ID), API_HASH)
+        client = TelegramClient(StringSession(TELETHON_SESSION), int(config.API_ID), config.API_HASH)
     else:
-        client = TelegramClient(TELETHON_SESSION_FILE, int(API_ID), API_HASH)
+        client = TelegramClient(TELETHON_SESSION_FILE, int(config.API_ID), config.API_HASH)
     await client.connect()
     if not await client.is_user_authorized():
         log.warning("Telethon client is not authorized. History reading disabled.")
         await client.disconnect()
         return None
     log.info("Telethon connected and authorized.")
-    return TelethonHistoryClient(client)
+    peers = PeerCache(Path(PEER_CACHE_PATH), ttl_s=PEER_CACHE_TTL_S)
+    try:
+        await peers.warm(client)
+    except Exception as e:
+        log.warning("Peer cache warm-up failed: %s", e)
+    return TelethonHistoryClient(client, store=MessageStore(Path(MESSAGE_STORE_PATH)), peers=peers)
+
+
+def _import_heavy() -> None:
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+
+@contextmanager
+def _phase(phases: Dict[str, float], name: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = time.perf_counter() - t0
+
+
+async def _timed(phases: Dict[str, float], name: str, aw):
+    with _phase(phases, name):
+        return await aw
+
+
+async def init_ptb(app) -> None:
+    # initialize() сам делает get_me — это и есть пробный пинг
+    await app.initialize()
+    log.info("Bot connected as @%s (%s)", app.bot.username, app.bot.id)
 
 
 async def main():
-    if not BOT_TOKEN:
+    t_start = time.perf_counter()
+    phases: Dict[str, float] = {}
+    # секреты keyring и импорт telegram/telethon/модулей бота — одновременно, в потоках
+    await asyncio.gather(
+        _timed(phases, "secrets", asyncio.to_thread(config.load_secrets)),
+        _timed(phases, "imports", asyncio.to_thread(_import_heavy)),
+    )
+    if not config.BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is required")
 
+    from telegram import Update
+    from telegram.ext import Application
+    from telegram.request import HTTPXRequest
+    from telethon import events
+    from transport.bridge_cache import BridgeCache
+    from bot.handlers import register_handlers
+    from bot.delivery import ChatRateLimiter
+    from bot.explain import WhyButtons
+    from bot.jobs import JobScheduler
+    from bot.watch import SubscriptionStore, WatchService
+    from bot.webhook import WebhookServer, allowed_updates
+
     # Настраиваем httpx-клиент PTB с адекватными таймаутами и пулом
     request = HTTPXRequest(
         connect_timeout=15.0,
@@ -94,37 +235,154 @@ async def main():
         write_timeout=30.0,
     )
 
-    app = Application.builder().token(BOT_TOKEN).request(request).build()
+    app = Application.builder().token(config.BOT_TOKEN).request(request).build()
     register_handlers(app)
     app.add_error_handler(on_error)
 
-    th_client = await init_telethon()
+    # Telethon, Bot API и модели Gemini поднимаются одновременно
+    th_client, ptb_err, llm_err = await asyncio.gather(
+        _timed(phases, "telethon", init_telethon()),
+        _timed(phases, "ptb", init_ptb(app)),
+        _timed(phases, "llm", asyncio.to_thread(init_llm)),
+        return_exceptions=True,
+    )
+    if isinstance(ptb_err, BaseException):
+        if not isinstance(th_client, BaseException) and th_client:
+            await th_client.client.disconnect()
+        raise ptb_err
+    if isinstance(th_client, BaseException):
+        log.warning("Telethon init failed, history reading disabled: %s", th_client)
+        th_client = None
+    if isinstance(llm_err, BaseException):
+        log.warning("Gemini init failed, models will be built on first call: %s", llm_err)
     app.bot_data["telethon_client"] = th_client
 
-    scorer = LLMScorer(send_fn=my_send_fn, policy=LLMPolicy())
+    score_cache = ScoreCache(
+        Path(SCORE_CACHE_PATH),
+        mem_size=SCORE_CACHE_MEM_SIZE,
+        ttl_s=SCORE_CACHE_TTL_S,
+        max_rows=SCORE_CACHE_MAX_ROWS,
+    )
+    scorer = LLMScorer(send_fn=my_send_fn, policy=LLMPolicy(), cache=score_cache,
+                       batch_send_fn=my_batch_send_fn, reason_fn=my_reason_fn)
     app.bot_data["llm_scorer"] = scorer
+    app.bot_data["why"] = WhyButtons(WHY_BUTTONS_MAX)
 
-    await app.initialize()
-    try:
-        await app.start()
-        # Пробный пинг
+    app.bot_data["bot_limiter"] = ChatRateLimiter(
+        per_chat_rate=BOT_SEND_RATE_PER_CHAT, per_chat_burst=BOT_SEND_BURST_PER_CHAT, global_rate=BOT_SEND_RATE_GLOBAL
+    )
+
+    jobs = JobScheduler(
+        global_limit=JOBS_GLOBAL_LIMIT, per_user_limit=JOBS_PER_USER_LIMIT,
+        per_user_queue_max=JOBS_PER_USER_QUEUE_MAX, progress_interval_s=PROGRESS_EDIT_INTERVAL_S,
+    )
+    app.bot_data["jobs"] = jobs
+
+    criteria = CriteriaStore(Path(CRITERIA_DB_PATH), legacy_json=Path(FILTERS_PATH))
+    app.bot_data["criteria"] = criteria
+
+    bridge_cache = BridgeCache(Path(BRIDGE_CACHE_PATH), ttl_s=BRIDGE_CACHE_TTL_S)
+    app.bot_data["bridge_cache"] = bridge_cache
+
+    watch_store: Optional[SubscriptionStore] = None
+    if th_client:
+        watch_store = SubscriptionStore(Path(WATCH_DB_PATH))
+        watch = WatchService(
+            app.bot, th_client, scorer, watch_store, criteria,
+            limiter=app.bot_data["bot_limiter"], settle_s=WATCH_ALBUM_SETTLE_S, bridge_cache=bridge_cache,
+        )
+        th_client.client.add_event_handler(watch.on_new_message, events.NewMessage())
+        app.bot_data["watch_service"] = watch
+
+    dedup_index = SignatureIndex(Path(DEDUP_INDEX_PATH))
+    app.bot_data["dedup_index"] = dedup_index
+
+    def _gauges() -> dict:
+        st = score_cache.stats
+        out = {f"score_cache_{k}": getattr(st, k) for k in ("mem_hits", "disk_hits", "misses", "hit_rate")}
+        out.update({f"llm_dispatcher_{k}": v for k, v in scorer.dispatcher.snapshot().items()})
+        out["llm_breaker_open"] = int(scorer.breaker.is_open)
+        out["llm_breaker_opened"] = scorer.breaker.opened
+        out["jobs_running"] = jobs.running
+        out["jobs_queued"] = jobs.queued
+        if webhook is not None:
+            out["webhook_queued"] = webhook.queued
+        out["prefilter_checked"] = PREFILTER_STATS.checked
+        out["prefilter_rejected"] = PREFILTER_STATS.rejected
+        watch = app.bot_data.get("watch_service")
+        if watch is not None:
+            out["watch_posts_scored"] = watch.posts_scored
+            out["watch_posts_pushed"] = watch.posts_pushed
+        return out
+
+    webhook: Optional[WebhookServer] = None
+    if INGRESS_MODE == "webhook":
+        # без секрета любой, кто достучится до порта, мог бы подсовывать апдейты: генерируем свой на запуск
+        webhook_secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        if not config.WEBHOOK_SECRET:
+            log.info("WEBHOOK_SECRET is not set: using a random secret for this run")
+
+        async def _process(data: dict) -> None:
+            await app.process_update(Update.de_json(data, app.bot))
+
+        webhook = WebhookServer(_process, secret_token=webhook_secret, path=WEBHOOK_PATH,
+                                workers=WEBHOOK_WORKERS, queue_max=WEBHOOK_QUEUE_MAX)
+
+    METRICS.add_collector(_gauges)
+    exporter = None
+    if METRICS_PORT:
         try:
-            me = await app.bot.get_me()
-            log.info("Bot connected as @%s (%s)", me.username, me.id)
-        except Exception as e:
-            log.warning("Initial get_me failed: %s", e)
+            exporter = await start_exporter(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            # занятый порт метрик не повод не запускать бота
+            log.warning("Metrics exporter not started on %s:%d: %s", METRICS_HOST, METRICS_PORT, e)
 
-        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        with _phase(phases, "start"):
+            await app.start()
+            kinds = allowed_updates(app)
+            if webhook is not None:
+                await webhook.start(WEBHOOK_HOST, WEBHOOK_PORT)
+                await app.bot.set_webhook(
+                    WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=webhook_secret,
+                    allowed_updates=kinds, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                )
+            else:
+                await app.updater.start_polling(allowed_updates=kinds)
+            log.info("Ingress: %s, updates: %s", INGRESS_MODE, ", ".join(kinds))
+        total = time.perf_counter() - t_start
+        for name, dt in phases.items():
+            METRICS.observe(f"startup_{name}", dt)
+        METRICS.observe("startup_total", total)
+        log.info("Started in %.2fs: %s", total, ", ".join(f"{k} {v:.2f}s" for k, v in phases.items()))
         await asyncio.Event().wait()
     finally:
+        await jobs.close()
         if th_client:
             try:
                 await th_client.client.disconnect()
             except Exception:
                 pass
-        await app.updater.stop()
+            if th_client.store:
+                th_client.store.close()
+            if th_client.peers:
+                th_client.peers.close()
+        if webhook is not None:
+            await webhook.close()
+        if app.updater.running:
+            await app.updater.stop()
         await app.stop()
         await app.shutdown()
+        st = score_cache.stats
+        log.info("Score cache: %d hits (%d mem, %d disk), %d misses", st.hits, st.mem_hits, st.disk_hits, st.misses)
+        score_cache.close()
+        dedup_index.close()
+        bridge_cache.close()
+        criteria.close()
+        if exporter is not None:
+            exporter.close()
+        if watch_store:
+            watch_store.close()
 
 
 if __name__ == "__main__":
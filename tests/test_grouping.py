@@ -0,0 +1,103 @@
+import asyncio
+import random
+from typing import Dict, List
+
+from core.grouping import (
+    _album,
+    _single,
+    group_into_logical_messages,
+    slice_logical_by_offset_limit_textful,
+    stream_logical_messages,
+    take_textful,
+)
+from core.models import LogicalMessage, RawMessage
+
+
+def _history(rnd: random.Random, n: int) -> List[RawMessage]:
+    # new->old, albums contiguous; some captions missing, some media without text
+    out: List[RawMessage] = []
+    mid, gid = n * 3 + 10, 10 ** 12
+    album_p, bare_p, max_album = rnd.random() * 0.6, rnd.random() * 0.3, rnd.randint(1, 12)
+    while len(out) < n:
+        r = rnd.random()
+        if r < album_p:
+            size, gid = rnd.randint(1, max_album), gid + 1
+            caption_at = rnd.randrange(size) if rnd.random() > 0.3 else -1
+            for j in range(size):
+                out.append(RawMessage(mid, f"post {mid}" if j == caption_at else None, gid, True))
+                mid -= 1
+        elif r < album_p + bare_p:
+            out.append(RawMessage(mid, rnd.choice([None, "  "]), None, True))
+            mid -= 1
+        else:
+            out.append(RawMessage(mid, f"post {mid}", None, rnd.random() < 0.2))
+            mid -= 1
+    return out
+
+
+def _interleave(raws: List[RawMessage], rnd: random.Random) -> List[RawMessage]:
+    out = list(raws)
+    for i in range(1, len(out) - 1):
+        if out[i].grouped_id and rnd.random() < 0.05:
+            out[i], out[i + 1] = out[i + 1], out[i]
+    ids = sorted((r.id for r in out), reverse=True)
+    return [RawMessage(mid, r.text, r.grouped_id, r.has_media) for mid, r in zip(ids, out)]
+
+
+def reference_group(raws: List[RawMessage]) -> List[LogicalMessage]:
+    # the original implementation: dict of lists, sort albums and the whole result
+    by_group: Dict[int, List[RawMessage]] = {}
+    singles: List[RawMessage] = []
+    for r in raws:
+        if r.grouped_id:
+            by_group.setdefault(r.grouped_id, []).append(r)
+        else:
+            singles.append(r)
+    logical = [_album(gid, sorted(chunk, key=lambda x: x.id)) for gid, chunk in by_group.items()]
+    logical += [_single(r) for r in singles]
+    logical.sort(key=lambda lm: lm.ids[0])
+    return logical
+
+
+def reference_slice(items: List[LogicalMessage], *, limit: int, offset: int) -> List[LogicalMessage]:
+    picked_desc: List[LogicalMessage] = []
+    skipped = taken = 0
+    for lm in reversed(items):
+        has_text = bool(lm.text and lm.text.strip())
+        if has_text and skipped < offset:
+            skipped += 1
+            continue
+        picked_desc.append(lm)
+        if has_text:
+            taken += 1
+        if taken >= limit:
+            break
+    return picked_desc[::-1]
+
+
+async def _stream_slice(raws: List[RawMessage], limit: int, offset: int) -> List[LogicalMessage]:
+    async def _aiter():
+        for r in raws:
+            yield r
+    return await take_textful(stream_logical_messages(_aiter()), limit=limit, offset=offset)
+
+
+def test_group_matches_reference_in_any_input_order():
+    rnd = random.Random(0)
+    for case in range(200):
+        raws = _history(rnd, rnd.randint(0, 300))
+        variants = {"new->old": raws, "interleaved": _interleave(raws, rnd),
+                    "old->new": raws[::-1], "shuffled": rnd.sample(raws, len(raws))}
+        for name, v in variants.items():
+            assert group_into_logical_messages(v) == reference_group(v), f"case {case} ({name})"
+
+
+def test_streaming_slice_matches_group_then_slice():
+    rnd = random.Random(1)
+    for case in range(200):
+        raws = _history(rnd, rnd.randint(0, 300))
+        grouped = reference_group(raws)
+        for limit, offset in ((1, 0), (5, 3), (50, 0), (10 ** 6, 0), (rnd.randint(1, 40), rnd.randint(0, 40))):
+            want = reference_slice(grouped, limit=limit, offset=offset)
+            assert slice_logical_by_offset_limit_textful(grouped, limit=limit, offset=offset) == want
+            assert asyncio.run(_stream_slice(raws, limit, offset)) == want, f"case {case} K={limit} OFFSET={offset}"
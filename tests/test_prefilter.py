@@ -0,0 +1,28 @@
+from core.prefilter import extract_prices, mismatch_reason, parse_criterion
+
+
+def _amounts(text):
+    return [p.amount for p in extract_prices(text)]
+
+
+def test_bare_m_after_area_is_not_a_price():
+    assert _amounts("2br Son Tra, 45 m") == []
+    assert _amounts("Area 45 m, 2br") == []
+    assert _amounts("площадь 45 m, цена 12 млн") == [12_000_000]
+
+
+def test_bare_m_with_price_context_is_millions():
+    assert _amounts("Price: 8m") == [8_000_000]
+    assert _amounts("15m/month") == [15_000_000]
+    assert parse_criterion("2 спальни до 20m").max_price.amount == 20_000_000
+
+
+def test_area_listing_is_not_rejected_by_price():
+    cons = parse_criterion("2 спальни до 20 млн")
+    assert mismatch_reason("2br Son Tra, 45 m", cons, price_tolerance=0.1, vnd_per_usd=25_000) is None
+
+
+def test_phone_numbers_are_not_prices():
+    assert _amounts("Сдаётся 2-комнатная квартира в Сон Ча, звоните 0905123456") == []
+    assert _amounts("WhatsApp +84 905123456") == []
+    assert _amounts("20.000.000 vnd") == [20_000_000]
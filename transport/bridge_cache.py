@@ -0,0 +1,59 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+import sqlite3
+import time
+
+from transport.peer_cache import peer_key
+
+
+class BridgeCache:
+    """
+    (source chat, message id) -> id of its copy already forwarded into the bridge channel,
+    persisted in SQLite. A listing delivered to many users is forwarded once; callers
+    invalidate() an entry when the bridge copy turns out to be gone.
+    """
+    def __init__(self, path: Path, *, ttl_s: float = 30 * 24 * 3600):
+        self.ttl_s = ttl_s
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bridge ("
+            " chat TEXT NOT NULL, msg_id INTEGER NOT NULL, bridge_id INTEGER NOT NULL, ts REAL NOT NULL,"
+            " PRIMARY KEY (chat, msg_id)) WITHOUT ROWID"
+        )
+        self._db.execute("DELETE FROM bridge WHERE ts < ?", (time.time() - ttl_s,))
+        self._db.commit()
+
+    @staticmethod
+    def key(chat: Union[int, str], peers=None) -> str:
+        # @name и -100id одного канала должны давать один ключ: через кеш пиров, если он знает чат
+        info = peers.get(chat) if peers is not None else None
+        return peer_key(info.id) if info is not None else peer_key(chat)
+
+    def get_many(self, chat: str, msg_ids: Iterable[int]) -> Dict[int, int]:
+        ids = list(msg_ids)
+        if not ids:
+            return {}
+        rows = self._db.execute(
+            f"SELECT msg_id, bridge_id FROM bridge WHERE chat=? AND ts >= ? AND msg_id IN ({','.join('?' * len(ids))})",
+            (chat, time.time() - self.ttl_s, *ids),
+        )
+        return dict(rows)
+
+    def put_many(self, chat: str, pairs: List[Tuple[int, int]]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO bridge (chat, msg_id, bridge_id, ts) VALUES (?, ?, ?, ?)",
+            [(chat, mid, bid, now) for mid, bid in pairs],
+        )
+        self._db.commit()
+
+    def invalidate(self, chat: str, msg_ids: Iterable[int]) -> None:
+        self._db.executemany("DELETE FROM bridge WHERE chat=? AND msg_id=?", [(chat, mid) for mid in msg_ids])
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
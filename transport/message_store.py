@@ -0,0 +1,92 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Union
+import sqlite3
+import time
+
+from core.models import RawMessage
+
+
+@dataclass
+class CachedRange:
+    min_id: int          # все сообщения чата с id в [min_id, max_id] лежат в сторе
+    max_id: int
+    reached_start: bool  # старее min_id в чате ничего нет
+
+
+def chat_key(chat: Union[int, str]) -> str:
+    return str(chat).strip().lower()
+
+
+class MessageStore:
+    """
+    Local per-chat copy of history (RawMessage fields) in SQLite, keyed by (chat, message id).
+    For every chat it keeps the contiguous id range that is known to be complete,
+    so callers only need to fetch what lies outside of it. Callers pass one canonical key per chat
+    (TelethonHistoryClient uses peer_key of the resolved peer id), so aliases share one copy.
+    """
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " chat TEXT NOT NULL, id INTEGER NOT NULL,"
+            " text TEXT, grouped_id INTEGER, has_media INTEGER NOT NULL,"
+            " PRIMARY KEY (chat, id)) WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ranges ("
+            " chat TEXT PRIMARY KEY, min_id INTEGER NOT NULL, max_id INTEGER NOT NULL,"
+            " reached_start INTEGER NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def range(self, chat: Union[int, str]) -> Optional[CachedRange]:
+        row = self._db.execute(
+            "SELECT min_id, max_id, reached_start FROM ranges WHERE chat=?", (chat_key(chat),)
+        ).fetchone()
+        return CachedRange(row[0], row[1], bool(row[2])) if row else None
+
+    def add(self, chat: Union[int, str], raws: List[RawMessage], rng: CachedRange) -> None:
+        """Stores raws and replaces the chat's complete range with rng (caller guarantees contiguity)."""
+        key = chat_key(chat)
+        self._db.executemany(
+            "INSERT OR REPLACE INTO messages (chat, id, text, grouped_id, has_media) VALUES (?, ?, ?, ?, ?)",
+            [(key, r.id, r.text, r.grouped_id, int(r.has_media)) for r in raws],
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO ranges (chat, min_id, max_id, reached_start, updated) VALUES (?, ?, ?, ?, ?)",
+            (key, rng.min_id, rng.max_id, int(rng.reached_start), time.time()),
+        )
+        self._db.commit()
+
+    def newest(self, chat: Union[int, str], limit: int, *, before_id: Optional[int] = None) -> List[RawMessage]:
+        """Up to limit stored messages, new->old (like Telethon), optionally strictly older than before_id."""
+        key = chat_key(chat)
+        if before_id is None:
+            rows = self._db.execute(
+                "SELECT id, text, grouped_id, has_media FROM messages WHERE chat=? ORDER BY id DESC LIMIT ?",
+                (key, limit),
+            )
+        else:
+            rows = self._db.execute(
+                "SELECT id, text, grouped_id, has_media FROM messages WHERE chat=? AND id<? ORDER BY id DESC LIMIT ?",
+                (key, before_id, limit),
+            )
+        return [RawMessage(id=r[0], text=r[1], grouped_id=r[2], has_media=bool(r[3])) for r in rows]
+
+    def count(self, chat: Union[int, str]) -> int:
+        (n,) = self._db.execute("SELECT COUNT(*) FROM messages WHERE chat=?", (chat_key(chat),)).fetchone()
+        return n
+
+    def reset(self, chat: Union[int, str]) -> None:
+        key = chat_key(chat)
+        self._db.execute("DELETE FROM messages WHERE chat=?", (key,))
+        self._db.execute("DELETE FROM ranges WHERE chat=?", (key,))
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Union
+import asyncio
+import logging
+import sqlite3
+import time
+
+from telethon.tl.types import Channel, Chat, User, InputPeerChannel, InputPeerChat, InputPeerUser
+
+log = logging.getLogger("rent-bot")
+
+
+@dataclass
+class PeerInfo:
+    kind: str                   # "channel" | "chat" | "user"
+    id: int                     # Telethon id (без -100)
+    access_hash: Optional[int]
+    username: Optional[str]
+    ts: float
+
+    @property
+    def marked_id(self) -> int:
+        # Bot API / event.chat_id форма: -100xxx для каналов, -xxx для групп
+        if self.kind == "channel":
+            return int(f"-100{self.id}")
+        if self.kind == "chat":
+            return -self.id
+        return self.id
+
+    def input_peer(self):
+        if self.kind == "channel":
+            return InputPeerChannel(self.id, self.access_hash or 0)
+        if self.kind == "chat":
+            return InputPeerChat(self.id)
+        return InputPeerUser(self.id, self.access_hash or 0)
+
+
+def peer_key(ident: Union[int, str]) -> str:
+    """@username / username -> "@name"; Bot API ids (-100xxx, -xxx) and plain ids -> "id:xxx"."""
+    s = str(ident).strip()
+    if s.lstrip("-").isdigit():
+        if s.startswith("-100"):
+            s = s[4:]
+        return "id:" + s.lstrip("-")
+    return "@" + s.lstrip("@").lower()
+
+
+class PeerCache:
+    """
+    Chat identifier -> (input peer, username, numeric id), with TTL, persisted in SQLite.
+    Replaces per-call get_dialogs()/get_entity()/get_input_entity() round trips;
+    warm() fills it from one get_dialogs() at startup.
+    """
+    def __init__(self, path: Optional[Path] = None, *, ttl_s: float = 7 * 24 * 3600):
+        self.ttl_s = ttl_s
+        self._mem: Dict[str, PeerInfo] = {}
+        self._warmed_at = 0.0
+        self._warm_lock = asyncio.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS peers ("
+                " key TEXT PRIMARY KEY, kind TEXT NOT NULL, id INTEGER NOT NULL,"
+                " access_hash INTEGER, username TEXT, ts REAL NOT NULL)"
+            )
+            self._db.commit()
+            now = time.time()
+            for key, kind, pid, ah, uname, ts in self._db.execute("SELECT * FROM peers"):
+                if now - ts <= ttl_s:
+                    self._mem[key] = PeerInfo(kind, pid, ah, uname, ts)
+
+    async def warm(self, client) -> int:
+        """Caches every dialog of the account (one get_dialogs call). Returns how many peers were cached."""
+        n = 0
+        for d in await client.get_dialogs():
+            if self.remember(d.entity) is not None:
+                n += 1
+        self._warmed_at = time.time()
+        log.info("Peer cache warmed: %d dialogs", n)
+        return n
+
+    def remember(self, entity, *, also: Optional[str] = None) -> Optional[PeerInfo]:
+        if isinstance(entity, Channel):
+            kind = "channel"
+        elif isinstance(entity, Chat):
+            kind = "chat"
+        elif isinstance(entity, User):
+            kind = "user"
+        else:
+            return None
+        uname = getattr(entity, "username", None) or None
+        info = PeerInfo(kind, entity.id, getattr(entity, "access_hash", None), uname, time.time())
+        keys = [peer_key(entity.id)]
+        if uname:
+            keys.append(peer_key(uname))
+        if also and also not in keys:
+            keys.append(also)  # например, инвайт-ссылка, по которой резолвили
+        for k in keys:
+            self._mem[k] = info
+        if self._db is not None:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO peers (key, kind, id, access_hash, username, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                [(k, info.kind, info.id, info.access_hash, info.username, info.ts) for k in keys],
+            )
+            self._db.commit()
+        return info
+
+    def get(self, ident: Union[int, str]) -> Optional[PeerInfo]:
+        info = self._mem.get(peer_key(ident))
+        if info is not None and time.time() - info.ts > self.ttl_s:
+            return None
+        return info
+
+    async def resolve(self, client, ident: Union[int, str]) -> PeerInfo:
+        info = self.get(ident)
+        if info is not None:
+            return info
+        key = peer_key(ident)
+        if key.startswith("@"):
+            ent = await client.get_entity(str(ident).strip())  # исходная строка: инвайт-хеши регистрозависимы
+            info = self.remember(ent, also=key)
+            if info is not None:
+                return info
+        else:
+            # цифровой id можно найти только среди диалогов аккаунта; перечитываем не чаще раза в минуту.
+            # Одновременные промахи ждут один общий get_dialogs, а не шлют каждый свой
+            async with self._warm_lock:
+                info = self.get(ident)
+                if info is None and time.time() - self._warmed_at > 60:
+                    self._warmed_at = time.time()  # и неудачная попытка не повторяется всплеском
+                    await self.warm(client)
+                    info = self.get(ident)
+            if info is not None:
+                return info
+        raise ValueError(
+            "Chat id not found in entity cache. "
+            "Убедись, что этот аккаунт вступил в канал/чат, "
+            "или укажи @username/инвайт-ссылку в BRIDGE_CHAT."
+        )
+
+    async def input_entity(self, client, ident: Union[int, str]):
+        return (await self.resolve(client, ident)).input_peer()
+
+    async def username(self, client, ident: Union[int, str]) -> Optional[str]:
+        try:
+            return (await self.resolve(client, ident)).username
+        except Exception:
+            return None
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,26 +1,252 @@
 from __future__ import annotations
-from typing import List, Union
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Tuple, Union, Optional
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.tl.custom.message import Message as TLMessage
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import asyncio
+import math
+import time
+from config import HISTORY_PAGE_SIZE, HISTORY_GAP_MAX, FLOODWAIT_MAX_WAIT_S
+from config import HISTORY_PARALLEL, HISTORY_PREFETCH_WINDOWS, HISTORY_RATE_PER_S
+from core.dispatcher import TokenBucket
+from core.metrics import METRICS
 from core.models import RawMessage
+from transport.message_store import MessageStore, CachedRange
+from transport.peer_cache import PeerCache, peer_key
+
+
+def to_raw_message(m: TLMessage) -> RawMessage:
+    return RawMessage(
+        id=m.id,
+        text=(m.message or None),
+        grouped_id=getattr(m, "grouped_id", None),
+        has_media=bool(getattr(m, "media", None)),
+    )
+
+
+def _extends(cur: Optional[CachedRange], expected: Optional[CachedRange]) -> bool:
+    # cur — то, что сейчас в сторе; годится, если это expected, разве что досинкованный сверху
+    if cur is None or expected is None:
+        return cur is None and expected is None
+    return cur.min_id == expected.min_id and cur.max_id >= expected.max_id
+
 
 @dataclass
 class TelethonHistoryClient:
     client: TelegramClient
+    store: Optional[MessageStore] = None
+    peers: Optional[PeerCache] = None
+    page_size: int = HISTORY_PAGE_SIZE
+    parallel: int = HISTORY_PARALLEL
+    prefetch: int = HISTORY_PREFETCH_WINDOWS
+    rate_per_s: float = HISTORY_RATE_PER_S
+    flood_retries: int = 3
+    _slots: asyncio.Semaphore = field(init=False, repr=False)
+    _bucket: TokenBucket = field(init=False, repr=False)
+    _locks: Dict[str, asyncio.Lock] = field(init=False, repr=False, default_factory=dict)
+
+    def __post_init__(self) -> None:
+        # лимитер на сеанс Telethon: общий для всех чатов и поисков
+        self._slots = asyncio.Semaphore(self.parallel)
+        self._bucket = TokenBucket(self.rate_per_s, max(1, self.parallel))
 
     async def iter_messages(self, chat: Union[int, str], *, fetch: int) -> List[RawMessage]:
-        msgs: List[TLMessage] = []
-        async for m in self.client.iter_messages(chat, limit=fetch):
-            msgs.append(m)
+        """Newest `fetch` messages of the chat, new->old."""
         out: List[RawMessage] = []
-        out.extend(
-            RawMessage(
-                id=m.id,
-                text=(m.message or None),
-                grouped_id=getattr(m, "grouped_id", None),
-                has_media=bool(getattr(m, "media", None)),
-            )
-            for m in msgs
-        )
+        if fetch <= 0:
+            return out
+        stream = self.stream_messages(chat)
+        try:
+            async for r in stream:
+                out.append(r)
+                if len(out) >= fetch:
+                    break
+        finally:
+            await stream.aclose()
         return out
+
+    async def stream_messages(self, chat: Union[int, str]) -> AsyncIterator[RawMessage]:
+        """
+        Whole chat history new->old, produced page by page; stop iterating (and aclose) to stop paging.
+        With a store: messages above the cached high-water mark are synced first (min_id),
+        then the cached range is read locally, and only history older than it goes to Telegram.
+        """
+        if self.store is None:
+            async for page in self._ranged_pages(chat):
+                for r in page:
+                    yield r
+            return
+
+        key = await self._store_key(chat)
+        rng = await self._sync_newer(chat, key)
+
+        if rng is None:
+            # холодный старт: читаем сверху и наращиваем диапазон вниз постранично
+            top: Optional[int] = None
+            persist, expected = True, None
+            async for page in self._ranged_pages(chat):
+                top = top or page[0].id
+                if persist:
+                    expected = await self._commit(key, page, CachedRange(page[-1].id, top, False), expected)
+                    persist = expected is not None
+                for r in page:
+                    yield r
+            if persist:
+                await self._commit(key, [], CachedRange(0, top or 0, True), expected)
+            return
+
+        cursor = rng.max_id + 1
+        while True:
+            page = self.store.newest(key, self.page_size, before_id=cursor)
+            for r in page:
+                yield r
+            if page:
+                cursor = page[-1].id
+            if len(page) < self.page_size:
+                break
+
+        # пока мы читали, кеш чата могли сбросить или переписать: тогда дочитываем из Telegram без записи
+        persist, expected = _extends(self.store.range(key), rng), rng
+        if persist and rng.reached_start:
+            return
+        async for page in self._ranged_pages(chat, offset_id=rng.min_id if persist else cursor):
+            if persist:
+                expected = await self._commit(key, page, CachedRange(page[-1].id, rng.max_id, False), expected)
+                persist = expected is not None
+            for r in page:
+                yield r
+        if persist:
+            await self._commit(key, [], CachedRange(0, rng.max_id, True), expected)
+
+    async def _store_key(self, chat: Union[int, str]) -> str:
+        # @name, name, t.me/name и -100id одного чата — один ключ в сторе: по id из кеша пиров
+        if self.peers is not None:
+            return peer_key((await self.peers.resolve(self.client, chat)).id)
+        return peer_key(chat)
+
+    def _lock(self, key: str) -> asyncio.Lock:
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    async def _commit(
+        self, key: str, page: List[RawMessage], rng: CachedRange, expected: Optional[CachedRange]
+    ) -> Optional[CachedRange]:
+        """
+        Stores page and extends the chat range down to rng.min_id, but only if the stored range is still
+        the one this stream wrote last (a concurrent sync may only have raised max_id). Returns the range
+        written, or None when the cache was reset or rewritten meanwhile and nothing was stored.
+        """
+        async with self._lock(key):
+            cur = self.store.range(key)
+            if not _extends(cur, expected):
+                return None
+            if cur is not None:
+                rng = CachedRange(rng.min_id, max(rng.max_id, cur.max_id), rng.reached_start)
+            self.store.add(key, page, rng)
+            return rng
+
+    async def _sync_newer(self, chat: Union[int, str], key: str) -> Optional[CachedRange]:
+        # всё, что новее high-water mark; если разрыв слишком большой — кеш чата сбрасываем.
+        # Под замком чата: запись диапазонов другими потоками ждёт, пока сброс/досинк не закончится
+        async with self._lock(key):
+            rng = self.store.range(key)
+            if rng is None:
+                return None
+            seen = 0
+            top: Optional[int] = None
+            async for page in self._pages(chat, min_id=rng.max_id):
+                top = top or page[0].id
+                seen += len(page)
+                if seen > HISTORY_GAP_MAX:
+                    self.store.reset(key)
+                    return None
+                self.store.add(key, page, rng)
+            if top is None:
+                return rng
+            rng = CachedRange(rng.min_id, top, rng.reached_start)
+            self.store.add(key, [], rng)
+            return rng
+
+    async def _pages(self, chat: Union[int, str], *, min_id: int = 0) -> AsyncIterator[List[RawMessage]]:
+        # история новее min_id, страница за страницей подряд; каждая страница — окно через общий
+        # лимитер сеанса (слоты, бакет, FloodWait), как и у _ranged_pages
+        peer = await self.peers.input_entity(self.client, chat) if self.peers is not None else chat
+        upper = 0
+        while True:
+            page = await self._window(peer, upper, min_id, limit=self.page_size)
+            if page:
+                yield page
+            if len(page) < self.page_size:
+                return
+            upper = page[-1].id
+
+    async def _ranged_pages(self, chat: Union[int, str], *, offset_id: int = 0) -> AsyncIterator[List[RawMessage]]:
+        """
+        History older than offset_id (0 = from the top), new->old. The first page is read as is;
+        below it the ids are split into windows (lower, upper) sized from the observed id density
+        to hold about one page, and up to `prefetch` windows are fetched concurrently. A window never
+        returns more than one page; if it was denser than estimated, its rest is fetched next.
+        Pages come out in order; closing the generator cancels the windows still in flight.
+        """
+        peer = await self.peers.input_entity(self.client, chat) if self.peers is not None else chat
+        first = await self._window(peer, offset_id, 0, limit=self.page_size)
+        if not first:
+            return
+        yield first
+        if len(first) < self.page_size:
+            return
+        # плотность id: в каналах ~1, в личках/обычных группах id общие на аккаунт — окна шире
+        msgs, span_ids = len(first), (offset_id or first[0].id + 1) - first[-1].id
+        upper = first[-1].id
+        windows: Deque[Tuple[int, int, asyncio.Task]] = deque()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while upper > 1 and len(windows) < self.prefetch:
+                    density = msgs / max(1, span_ids)
+                    span = min(self.page_size * 1000, max(self.page_size, math.ceil(self.page_size / max(density, 1e-3))))
+                    lower = max(0, upper - span)
+                    windows.append((upper, lower, loop.create_task(
+                        self._window(peer, upper, lower, limit=self.page_size))))
+                    upper = lower + 1  # границы не включаются: id == lower достанется следующему окну
+                if not windows:
+                    return
+                hi, lo, task = windows.popleft()
+                page = await task
+                msgs += len(page)
+                if len(page) >= self.page_size and page[-1].id - lo > 1:
+                    # окно плотнее оценки и упёрлось в limit: остаток (lo, last) читаем раньше следующих окон
+                    last = page[-1].id
+                    span_ids += hi - last
+                    windows.appendleft((last, lo, loop.create_task(
+                        self._window(peer, last, lo, limit=self.page_size))))
+                else:
+                    span_ids += hi - lo - 1
+                if page:
+                    yield page
+        finally:
+            for _, _, t in windows:
+                t.cancel()
+
+    async def _window(self, peer, upper: int, lower: int, *, limit: Optional[int] = None) -> List[RawMessage]:
+        # сообщения с lower < id < upper (upper=0 — с самого верха).
+        # Короткие FloodWait (до flood_sleep_threshold клиента) Telethon пережидает сам; длиннее — доходят
+        # сюда: не дольше FLOODWAIT_MAX_WAIT_S пережидаем всем сеансом (пауза бакета), иначе отдаём наверх
+        for attempt in range(self.flood_retries + 1):
+            async with self._slots:
+                await self._bucket.acquire()
+                t0 = time.perf_counter()
+                try:
+                    page = [to_raw_message(m) async for m in self.client.iter_messages(
+                        peer, limit=limit, offset_id=upper, min_id=lower)]
+                except FloodWaitError as e:
+                    METRICS.inc("history_floodwaits")
+                    if attempt >= self.flood_retries or e.seconds > FLOODWAIT_MAX_WAIT_S:
+                        raise
+                    self._bucket.pause(e.seconds)
+                    continue
+            METRICS.observe("history_page", time.perf_counter() - t0)
+            METRICS.inc("history_messages", len(page))
+            return page
+        raise RuntimeError("unreachable")